@@ -0,0 +1,183 @@
+"""
+Reproducible bundling of the natifylambda Lambda asset.
+
+The same zip is used by `cdk synth` (NatifyStack) and by the release, which
+uploads it as natifylambda-<version>.zip for the downloader. Entries are
+sorted, timestamps and permissions are fixed and, on the Lambda runtime's
+Python version, bytecode is compiled with hash-based invalidation, so
+identical sources always produce an identical asset hash and CloudFormation
+does not redeploy the function.
+"""
+import argparse
+import hashlib
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipfile
+from pathlib import Path
+
+PACKAGE_NAME = 'natifylambda'
+ROOT_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_SOURCE_DIR = ROOT_DIR / PACKAGE_NAME
+DEFAULT_CACHE_DIR = ROOT_DIR / '.natify-cache'
+
+# Python version of the Lambda runtime in NatifyStack; bytecode compiled by any
+# other interpreter would be ignored by the runtime
+LAMBDA_PYTHON_VERSION = (3, 12)
+LAMBDA_CACHE_TAG = 'cpython-312'
+
+# Bump when the zip layout changes so stale cache entries are not reused
+BUNDLE_FORMAT_VERSION = '1'
+# The earliest timestamp a zip entry can hold
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+FILE_MODE = 0o644
+
+
+def compiles_bytecode():
+    """
+    Tells whether the running interpreter matches the Lambda runtime, so its bytecode
+    can be bundled. Other interpreters produce a source-only bundle.
+    """
+    return sys.version_info[:2] == LAMBDA_PYTHON_VERSION
+
+
+def list_source_files(source_dir):
+    """
+    Lists the files to bundle, relative to the source directory, in sorted order.
+    Bytecode caches are skipped since bytecode is compiled into the bundle.
+
+    :param source_dir: The directory of the natifylambda package.
+    :return: A sorted list of POSIX-style relative paths.
+    """
+    files = []
+    for path in Path(source_dir).rglob('*'):
+        if not path.is_file() or '__pycache__' in path.parts or path.suffix in ('.pyc', '.pyo'):
+            continue
+        files.append(path.relative_to(source_dir).as_posix())
+    return sorted(files)
+
+
+def content_hash(source_dir, files):
+    """
+    Hashes the bundle inputs: the relative path and content of every file, whether
+    bytecode for the Lambda runtime is included and the bundle format version.
+
+    :param source_dir: The directory of the natifylambda package.
+    :param files: The relative paths returned by list_source_files.
+    :return: The hex SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    bytecode = LAMBDA_CACHE_TAG if compiles_bytecode() else 'source-only'
+    digest.update(f"{BUNDLE_FORMAT_VERSION}\0{bytecode}\0".encode())
+    for rel_path in files:
+        digest.update(rel_path.encode() + b'\0')
+        digest.update((Path(source_dir) / rel_path).read_bytes())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _write_entry(zf, arcname, data):
+    info = zipfile.ZipInfo(arcname, date_time=FIXED_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = FILE_MODE << 16
+    info.create_system = 3  # Unix, so the permissions are honoured everywhere
+    zf.writestr(info, data)
+
+
+def write_bundle(source_dir, files, zip_path):
+    """
+    Writes the deterministic zip. Sources are stored under natifylambda/ to match
+    the `natifylambda.natifylambda.handler` handler. When running on the Lambda
+    runtime's Python version, each module is followed by its bytecode in
+    natifylambda/__pycache__ compiled with CHECKED_HASH invalidation so no source
+    mtime is embedded.
+
+    :param source_dir: The directory of the natifylambda package.
+    :param files: The relative paths returned by list_source_files.
+    :param zip_path: Where to write the zip file.
+    """
+    entries = {}
+    bytecode = compiles_bytecode()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for rel_path in files:
+            source_path = Path(source_dir) / rel_path
+            arcname = f"{PACKAGE_NAME}/{rel_path}"
+            entries[arcname] = source_path.read_bytes()
+            if not bytecode or source_path.suffix != '.py':
+                continue
+            rel = Path(rel_path)
+            pyc_arcname = (
+                Path(PACKAGE_NAME) / rel.parent / '__pycache__'
+                / f"{rel.stem}.{LAMBDA_CACHE_TAG}.pyc"
+            ).as_posix()
+            cfile = Path(tmp_dir) / pyc_arcname
+            py_compile.compile(
+                str(source_path),
+                cfile=str(cfile),
+                dfile=arcname,
+                doraise=True,
+                invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+            )
+            entries[pyc_arcname] = cfile.read_bytes()
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for arcname in sorted(entries):
+            _write_entry(zf, arcname, entries[arcname])
+
+
+def bundle(source_dir=DEFAULT_SOURCE_DIR, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns the path of the bundled natifylambda zip, building it only if the
+    cache has no bundle for the current content hash.
+
+    :param source_dir: The directory of the natifylambda package.
+    :param cache_dir: The directory holding bundles keyed by content hash.
+    :return: The path of the zip file in the cache.
+    """
+    files = list_source_files(source_dir)
+    if not compiles_bytecode():
+        print(
+            f"Python {sys.version_info[0]}.{sys.version_info[1]} does not match the Lambda runtime "
+            f"{LAMBDA_PYTHON_VERSION[0]}.{LAMBDA_PYTHON_VERSION[1]}, bundling sources without bytecode; "
+            "the asset hash will differ from the release bundle",
+            file=sys.stderr
+        )
+    zip_path = Path(cache_dir) / f"{PACKAGE_NAME}-{content_hash(source_dir, files)}.zip"
+    if zip_path.exists():
+        print(f"Reusing cached bundle {zip_path}", file=sys.stderr)
+        return str(zip_path)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    # Write next to the final path and rename, so a concurrent or interrupted
+    # build never leaves a partial zip in the cache
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.zip.tmp')
+    os.close(fd)
+    try:
+        write_bundle(source_dir, files, tmp_path)
+        os.replace(tmp_path, zip_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"Bundled {len(files)} files into {zip_path}", file=sys.stderr)
+    return str(zip_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the reproducible natifylambda Lambda bundle.")
+    parser.add_argument('--output', help="Copy the bundle to this path, e.g. cdk.out/natifylambda-<version>.zip")
+    parser.add_argument('--cache-dir', default=str(DEFAULT_CACHE_DIR), help="Bundle cache directory.")
+    parser.add_argument('--require-bytecode', action='store_true',
+                        help="Fail unless running on the Lambda runtime's Python version, as for releases.")
+    args = parser.parse_args(argv)
+    if args.require_bytecode and not compiles_bytecode():
+        parser.error(f"Python {LAMBDA_PYTHON_VERSION[0]}.{LAMBDA_PYTHON_VERSION[1]} is required to build the release bundle")
+    zip_path = bundle(cache_dir=args.cache_dir)
+    if args.output:
+        shutil.copyfile(zip_path, args.output)
+        print(f"Copied {zip_path} to {args.output}", file=sys.stderr)
+    else:
+        print(zip_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,15 @@ from constructs import Construct
 
 
 class ContainerBuildStack(Stack):
+    # CodeBuild images used to build each architecture natively
+    BUILD_IMAGES = {
+        "amd64": codebuild.LinuxBuildImage.STANDARD_7_0,
+        "arm64": codebuild.LinuxArmBuildImage.AMAZON_LINUX_2_STANDARD_3_0,
+    }
+
+    # BuildKit cache directory kept between builds on the same CodeBuild host
+    LOCAL_BUILDKIT_CACHE_DIR = "/root/.buildkit-cache"
+
     def __init__(self, scope: Construct, id: str, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
@@ -28,37 +37,170 @@ class ContainerBuildStack(Stack):
             repo="natifylambda",
             oauth_token=SecretValue.secrets_manager("natifylambda/github-token"),
             output=source_output,
+            variables_namespace="Source",  # Exposes the commit SHA to the build actions
             branch="main",  # Optional: default is master
             trigger=codepipeline_actions.GitHubTrigger.POLL  # Optional: default is POLL
         )
 
-        # Define the build project
-        build_project = codebuild.PipelineProject(
-            self, "NatifyLambdaBuild",
-            project_name="NatifyLambdaBuild",
+        # Build each architecture natively, in parallel: amd64 on x86 and arm64 on Graviton
+        build_projects = {
+            arch: self.docker_build_project(ecr_repo, arch, build_image)
+            for arch, build_image in self.BUILD_IMAGES.items()
+        }
+        manifest_project = self.manifest_project(ecr_repo)
+
+        # Images are tagged by the commit SHA of the source revision
+        commit_sha_variables = {
+            'COMMIT_SHA': codebuild.BuildEnvironmentVariable(value=github_source_action.variables.commit_id)
+        }
+
+        # Define the pipeline
+        pipeline = codepipeline.Pipeline(
+            self, "NatifyLambdaPipeline",
+            pipeline_name="NatifyLambdaPipeline",
+            pipeline_type=codepipeline.PipelineType.V2,
+            stages=[
+                codepipeline.StageProps(
+                    stage_name="Source",
+                    actions=[github_source_action]
+                ),
+                codepipeline.StageProps(
+                    stage_name="Build",
+                    actions=[
+                        codepipeline_actions.CodeBuildAction(
+                            action_name=f"Build_{arch}",
+                            project=project,
+                            input=source_output,
+                            environment_variables=commit_sha_variables
+                        )
+                        for arch, project in build_projects.items()
+                    ]
+                ),
+                codepipeline.StageProps(
+                    stage_name="Manifest",
+                    actions=[
+                        codepipeline_actions.CodeBuildAction(
+                            action_name="Manifest",
+                            project=manifest_project,
+                            input=source_output,
+                            environment_variables=commit_sha_variables,
+                            outputs=[codepipeline.Artifact()]  # Optional: if you need the output as input for another action
+                        )
+                    ]
+                )
+            ]
+        )
+
+        # Grant permissions to the build projects to push to the ECR repository
+        for project in [*build_projects.values(), manifest_project]:
+            ecr_repo.grant_pull_push(project.role)
+
+    @staticmethod
+    def ecr_login_commands():
+        return [
+            'echo Logging in to Amazon ECR...',
+            'aws ecr get-login-password --region $AWS_DEFAULT_REGION'
+            ' | docker login --username AWS --password-stdin ${REPOSITORY_URI%%/*}',
+        ]
+
+    def docker_build_project(self, ecr_repo, arch, build_image):
+        """
+        Creates the CodeBuild project that builds and pushes the image for one architecture.
+        The BuildKit builder runs in its own container, so the Docker daemon's layer cache
+        does not apply to it. Layers are instead exported to a local BuildKit cache directory
+        kept between builds by the CodeBuild local custom cache, and to a registry cache
+        stored in ECR under the buildcache-<arch> tag for builds on a fresh host.
+
+        :param ecr_repo: The ECR repository to push the image and the build cache to.
+        :param arch: The Docker architecture, amd64 or arm64.
+        :param build_image: The CodeBuild image matching the architecture.
+        :return: The CodeBuild project.
+        """
+        cache_ref = f"$REPOSITORY_URI:buildcache-{arch}"
+        local_cache_dir = self.LOCAL_BUILDKIT_CACHE_DIR
+        return codebuild.PipelineProject(
+            self, f"NatifyLambdaBuild-{arch}",
+            project_name=f"NatifyLambdaBuild-{arch}",
             build_spec=codebuild.BuildSpec.from_object({
                 'version': '0.2',
+                'env': {
+                    'variables': {
+                        'DOCKER_BUILDKIT': '1'
+                    }
+                },
                 'phases': {
                     'pre_build': {
-                        'commands': [
-                            'echo Logging in to Amazon ECR...',
-                            '$(aws ecr get-login --no-include-email --region $AWS_DEFAULT_REGION)'
+                        'commands': self.ecr_login_commands() + [
+                            # The default docker driver cannot export a registry cache
+                            'docker buildx create --use --name natifylambda --driver docker-container',
                         ]
                     },
                     'build': {
                         'commands': [
                             'echo Build started on `date`',
-                            'echo Building the Docker image...',
-                            'docker build -t $REPOSITORY_URI:latest .',
+                            f'echo Building the {arch} Docker image...',
+                            f'docker buildx build --platform linux/{arch}'
+                            f' --cache-from type=local,src={local_cache_dir}'
+                            f' --cache-from type=registry,ref={cache_ref}'
+                            f' --cache-to type=local,dest={local_cache_dir}-new,mode=max'
+                            f' --cache-to type=registry,ref={cache_ref},mode=max,image-manifest=true,oci-mediatypes=true'
+                            f' --tag $REPOSITORY_URI:$COMMIT_SHA-{arch} --push .',
+                            # A local cache export only ever grows, so replace it instead of merging.
+                            # The cached path is a symlink to the CodeBuild cache store: replace its
+                            # contents, not the link itself, or the store is never updated.
+                            f'mkdir -p {local_cache_dir} && rm -rf {local_cache_dir}/*'
+                            f' && mv {local_cache_dir}-new/* {local_cache_dir}/ && rmdir {local_cache_dir}-new',
                         ]
                     },
                     'post_build': {
                         'commands': [
                             'echo Build completed on `date`',
-                            'echo Pushing the Docker image...',
-                            'docker push $REPOSITORY_URI:latest',
+                        ]
+                    }
+                },
+                'cache': {
+                    'paths': [f'{local_cache_dir}/**/*']
+                }
+            }),
+            environment=codebuild.BuildEnvironment(
+                build_image=build_image,
+                privileged=True,
+            ),
+            cache=codebuild.Cache.local(codebuild.LocalCacheMode.CUSTOM),
+            environment_variables={
+                'REPOSITORY_URI': codebuild.BuildEnvironmentVariable(value=ecr_repo.repository_uri)
+            }
+        )
+
+    def manifest_project(self, ecr_repo):
+        """
+        Creates the CodeBuild project that combines the per-architecture images into a
+        multi-arch manifest tagged with the commit SHA and latest.
+
+        :param ecr_repo: The ECR repository holding the per-architecture images.
+        :return: The CodeBuild project.
+        """
+        arch_images = ' '.join(f'$REPOSITORY_URI:$COMMIT_SHA-{arch}' for arch in self.BUILD_IMAGES)
+        return codebuild.PipelineProject(
+            self, "NatifyLambdaManifest",
+            project_name="NatifyLambdaManifest",
+            build_spec=codebuild.BuildSpec.from_object({
+                'version': '0.2',
+                'phases': {
+                    'pre_build': {
+                        'commands': self.ecr_login_commands()
+                    },
+                    'build': {
+                        'commands': [
+                            'echo Creating the multi-arch manifest...',
+                            'docker buildx imagetools create'
+                            f' --tag $REPOSITORY_URI:$COMMIT_SHA --tag $REPOSITORY_URI:latest {arch_images}',
+                        ]
+                    },
+                    'post_build': {
+                        'commands': [
                             'echo Writing image definitions file...',
-                            'printf \'[{"name":"natifylambda","imageUri":"%s"}]\' $REPOSITORY_URI:latest > imagedefinitions.json'
+                            'printf \'[{"name":"natifylambda","imageUri":"%s"}]\' $REPOSITORY_URI:$COMMIT_SHA > imagedefinitions.json'
                         ]
                     }
                 },
@@ -69,38 +211,10 @@ class ContainerBuildStack(Stack):
                 }
             }),
             environment=codebuild.BuildEnvironment(
-                build_image=codebuild.LinuxBuildImage.STANDARD_5_0,
-                privileged=True,
+                build_image=codebuild.LinuxBuildImage.STANDARD_7_0,
             ),
             environment_variables={
                 'REPOSITORY_URI': codebuild.BuildEnvironmentVariable(value=ecr_repo.repository_uri)
             }
         )
 
-        # Define the pipeline
-        pipeline = codepipeline.Pipeline(
-            self, "NatifyLambdaPipeline",
-            pipeline_name="NatifyLambdaPipeline",
-            pipeline_type=codepipeline.PipelineType.V2,
-            stages=[
-                codepipeline.StageProps(
-                    stage_name="Source",
-                    actions=[github_source_action]
-                ),
-                codepipeline.StageProps(
-                    stage_name="Build",
-                    actions=[
-                        codepipeline_actions.CodeBuildAction(
-                            action_name="Build",
-                            project=build_project,
-                            input=source_output,
-                            outputs=[codepipeline.Artifact()]  # Optional: if you need the output as input for another action
-                        )
-                    ]
-                )
-            ]
-        )
-
-        # Grant permissions to the build project to push to the ECR repository
-        ecr_repo.grant_pull_push(build_project.role)
-
@@ -1,14 +1,10 @@
 from aws_cdk import (
     Stack,
-    aws_s3 as s3,
     aws_iam as iam,
     aws_lambda as lambda_,
-    aws_events as events,
-    aws_events_targets as targets,
-    aws_stepfunctions as sfn,
-    aws_stepfunctions_tasks as tasks,
+    CustomResource,
+    CfnOutput,
     Duration,
-    RemovalPolicy
 )
 from constructs import Construct
 from natifylambda import __version__ as natifylambda_version
@@ -17,8 +13,10 @@ class DownloaderLambdaStack(Stack):
     def __init__(self, scope: Construct, id: str, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
-        # Define the function name early on so it can be reused
-        function_name = f"downloader_lambda_{natifylambda_version.replace('.', '_')}"
+        # The name does not contain the version: replacing the function would change the
+        # ServiceToken of the custom resource, which CloudFormation does not allow. A new
+        # version updates the Version property of the custom resource instead.
+        function_name = "downloader_lambda"
 
         # Define the IAM role for the downloader_lambda
         downloader_lambda_role = iam.Role(
@@ -30,10 +28,6 @@ class DownloaderLambdaStack(Stack):
                         iam.PolicyStatement(
                             actions=["s3:PutObject"],
                             resources=["arn:aws:s3:::cdk-hnb659fds-assets-*/*"]
-                        ),
-                        iam.PolicyStatement(
-                            actions=["lambda:PutFunctionConcurrency", "lambda:UpdateFunctionCode"],
-                            resources=[f"arn:aws:lambda:{self.region}:{self.account}:function:{function_name}"]
                         )
                     ]
                 )
@@ -51,67 +45,55 @@ class DownloaderLambdaStack(Stack):
             handler="index.handler",
             code=lambda_.InlineCode(self.get_lambda_code()),
             environment={
-                "BUCKET_NAME": f"cdk-hnb659fds-assets-{self.account}-{self.region}",
-                "NATIFYLAMBDA_VERSION": natifylambda_version
+                "BUCKET_NAME": f"cdk-hnb659fds-assets-{self.account}-{self.region}"
             },
             role=downloader_lambda_role,
-            timeout=Duration.seconds(10),
-            reserved_concurrent_executions=None,  # Use the unreserved account concurrency
+            timeout=Duration.seconds(60),
             function_name=function_name
         )
 
-        # Trigger the downloader_lambda immediately and only once using AWS Events Rule
-        rule = events.Rule(
-            self, "Rule",
-            schedule=events.Schedule.expression("rate(1 minute)"),
-            targets=[targets.LambdaFunction(downloader_lambda)]
-        )
-
-        # Define a no operation state machine that depends on the downloader_lambda
-        no_op_state = sfn.Pass(self, "NoOpState")
-        definition_body = sfn.DefinitionBody.from_chainable(no_op_state)
-        state_machine = sfn.StateMachine(
-            self, "NoOpStateMachine",
-            definition_body=definition_body,
-            state_machine_name=f"NoOpStateMachine_{natifylambda_version.replace('.', '_')}"
-        )
-
-        # Add dependency to ensure the state machine is provisioned after the downloader_lambda
-        state_machine.node.add_dependency(downloader_lambda)
-        
-        # Define a dummy S3 bucket that depends on the state_machine
-        # to slow down the deployment of the stack
-        dummy_bucket = s3.Bucket(
-            self, "NatifyDummyBucket",
-            bucket_name=f"natify-dummy-bucket-{self.account}-{self.region}-{natifylambda_version}",
-            removal_policy=RemovalPolicy.DESTROY
+        # Run the download exactly once per version as a custom resource. The stack
+        # only completes once the function has signalled that the artifact is in S3,
+        # so the NatifyStack can be deployed right after it.
+        download = CustomResource(
+            self, "NatifyLambdaArtifact",
+            service_token=downloader_lambda.function_arn,
+            resource_type="Custom::NatifyLambdaArtifact",
+            properties={
+                "Version": natifylambda_version
+            }
         )
 
-        # Add dependency to ensure the dummy bucket is provisioned after the state machine
-        dummy_bucket.node.add_dependency(state_machine)
+        CfnOutput(self, "NatifyLambdaArtifactKey", value=download.get_att_string("Key"))
 
     def get_lambda_code(self) -> str:
+        # cfnresponse is provided by CloudFormation for inline Lambda code
         return f"""
 import urllib.request
 import boto3
+import cfnresponse
 import os
 import datetime
 
 def handler(event, context):
-    print(f"Download started at: {{datetime.datetime.now()}}")
-    s3 = boto3.client('s3')
-    version = os.environ.get("NATIFYLAMBDA_VERSION", "default-version")
-    url = "https://github.com/fortran01/natifylambda/releases/download/v{{version}}/natifylambda-{{version}}.zip"
-    file_name = "/tmp/downloaded.zip"
-    urllib.request.urlretrieve(url.format(version=version), file_name)
-    print(f"Download completed at: {{datetime.datetime.now()}}")
-    bucket_name = os.environ.get("BUCKET_NAME", "default-bucket-name")
-    s3.upload_file(file_name, bucket_name, f"natifylambda-{{version}}.zip")
-    
-    # Disable the lambda function after its first run by setting concurrency to 0
-    lambda_client = boto3.client('lambda')
-    lambda_client.put_function_concurrency(
-        FunctionName=context.function_name,
-        ReservedConcurrentExecutions=0
-    )
+    version = event['ResourceProperties']['Version']
+    key = f"natifylambda-{{version}}.zip"
+    if event['RequestType'] == 'Delete':
+        # Keep the artifact, the NatifyStack may still use it
+        cfnresponse.send(event, context, cfnresponse.SUCCESS, {{'Key': key}}, physicalResourceId=key)
+        return
+    try:
+        print(f"Download started at: {{datetime.datetime.now()}}")
+        s3 = boto3.client('s3')
+        url = f"https://github.com/fortran01/natifylambda/releases/download/v{{version}}/{{key}}"
+        file_name = "/tmp/downloaded.zip"
+        urllib.request.urlretrieve(url, file_name)
+        print(f"Download completed at: {{datetime.datetime.now()}}")
+        bucket_name = os.environ.get("BUCKET_NAME", "default-bucket-name")
+        s3.upload_file(file_name, bucket_name, key)
+    except Exception as e:
+        print(f"Failed to download {{key}}: {{e}}")
+        cfnresponse.send(event, context, cfnresponse.FAILED, {{}}, physicalResourceId=key, reason=str(e))
+        return
+    cfnresponse.send(event, context, cfnresponse.SUCCESS, {{'Key': key}}, physicalResourceId=key)
         """
@@ -13,12 +13,22 @@ from aws_cdk import (
     aws_stepfunctions_tasks as tasks,
     aws_ec2 as ec2,
     aws_ssm as ssm,
+    aws_dynamodb as dynamodb,
+    RemovalPolicy,
+    CfnCondition,
     CfnOutput, # Added for CF output
+    Fn,
+    Token,
 )
 from constructs import Construct
 from natifylambda import __version__ as natifylambda_version
+from natifylambda.natifylambda import DEFAULT_DISTRIBUTED_MAP_TIMEOUT, RECONCILE_EVENT_NAMES
+from natifylambda import nat_agent
+from natifylambda.routes import DESCRIBE_BATCH_SIZE
+from cdk import asset_bundler
 import aws_cdk.aws_lambda_event_sources as lambda_event_sources
 import uuid
+from pathlib import Path
 
 class NatifyStack(Stack):
     def __init__(self, scope: Construct, id: str, **kwargs) -> None:
@@ -58,6 +68,89 @@ class NatifyStack(Stack):
         )
         availability_zone = availability_zone_param.value_as_string
 
+        # Optional CloudFormation parameters for the EC2 API token bucket shared by all
+        # natify invocations in the account, backed by an existing DynamoDB table
+        # with a string partition key named BucketKey
+        rate_limit_table_param = CfnParameter(
+            self, "RateLimitTableName",
+            type="String",
+            default="",
+            description="The DynamoDB table of the shared EC2 API token bucket, empty to disable rate limiting"
+        )
+        rate_limit_param = CfnParameter(
+            self, "RateLimitPerSecond",
+            type="Number",
+            default=4,
+            description="The mutating EC2 calls per second allowed across all natify invocations in the account"
+        )
+        rate_limit_burst_param = CfnParameter(
+            self, "RateLimitBurst",
+            type="Number",
+            default=100,
+            description="The capacity of the shared EC2 API token bucket"
+        )
+
+        # Optional CloudFormation parameter for the reachability probe run once the routes have converged
+        probe_eni_id_param = CfnParameter(
+            self, "ReachabilityProbeEniId",
+            type="String",
+            default="",
+            description="The ID of a test network interface in a private subnet to probe the route to the NAT instance from, empty to skip the probe"
+        )
+
+        # CloudFormation parameter for the gateway VPC endpoints taking S3 and DynamoDB traffic off the NAT instance
+        gateway_endpoints_param = CfnParameter(
+            self, "GatewayEndpoints",
+            type="String",
+            default="s3,dynamodb",
+            allowed_values=["s3,dynamodb", "s3", "dynamodb", ""],
+            description="The services to reach through gateway VPC endpoints on the private route tables, empty for none"
+        )
+
+        # CloudFormation parameters for updating very large route table sets
+        # through a Step Functions Distributed Map instead of a single Lambda invocation
+        route_update_mode_param = CfnParameter(
+            self, "RouteUpdateMode",
+            type="String",
+            default="Lambda",
+            allowed_values=["Lambda", "DistributedMap"],
+            description="Update the route tables in a single Lambda invocation, or in batches through a Distributed Map"
+        )
+        route_table_batch_size_param = CfnParameter(
+            self, "RouteTableBatchSize",
+            type="Number",
+            default=50,
+            min_value=1,
+            # describe_route_tables accepts at most this many route table IDs per call
+            max_value=DESCRIBE_BATCH_SIZE,
+            description="The number of route tables updated per Lambda invocation in DistributedMap mode"
+        )
+        map_max_concurrency_param = CfnParameter(
+            self, "MapMaxConcurrency",
+            type="Number",
+            default=20,
+            min_value=1,
+            description="The maximum number of concurrent Lambda invocations in DistributedMap mode"
+        )
+        # The whole execution, including the Distributed Map, must finish within the state
+        # machine timeout or finalize never runs. Each route table costs about 2 mutating
+        # EC2 calls (the journal tag and the route), so N route tables take about
+        # 2 * N / RateLimitPerSecond seconds: 5000 route tables at 4 calls per second need
+        # about 42 minutes, plus the 40 second wait and the finalize invocation.
+        map_timeout_param = CfnParameter(
+            self, "DistributedMapTimeoutSeconds",
+            type="Number",
+            default=DEFAULT_DISTRIBUTED_MAP_TIMEOUT,
+            min_value=300,
+            # Standard workflows run for at most a year, stay well below that
+            max_value=86400,
+            description="The state machine timeout in DistributedMap mode, about 2 * route tables / RateLimitPerSecond plus 5 minutes"
+        )
+        distributed_map_condition = CfnCondition(
+            self, "IsDistributedMapMode",
+            expression=Fn.condition_equals(route_update_mode_param.value_as_string, "DistributedMap")
+        )
+
         # SSM Parameter for VPC ID retrieval
         vpc_id_param = ssm.StringParameter.from_string_parameter_attributes(
             self, "VpcId",
@@ -113,6 +206,21 @@ class NatifyStack(Stack):
                                 "ec2:AuthorizeSecurityGroupIngress",
                                 "ec2:ModifyInstanceAttribute",
                                 "ec2:CreateRoute",
+                                "ec2:DeleteRoute",  # Restoring routes from the route journal
+                                "ec2:CreateTags",
+                                "ec2:DeleteTags",
+                                # Gateway endpoints for S3 and DynamoDB on the private route tables
+                                "ec2:CreateVpcEndpoint",
+                                "ec2:ModifyVpcEndpoint",
+                                # Reachability probe after the routes have converged
+                                "ec2:CreateNetworkInsightsPath",
+                                "ec2:DeleteNetworkInsightsPath",
+                                "ec2:StartNetworkInsightsAnalysis",
+                                "ec2:DeleteNetworkInsightsAnalysis",
+                                "ec2:Describe*",  # Reachability Analyzer reads the whole network path
+                                "tiros:CreateQuery",
+                                "tiros:GetQueryAnswer",
+                                "tiros:GetQueryExplanation",
                                 "lambda:PutFunctionConcurrency",  # Permission to update function concurrency
                                 "states:UpdateStateMachine",  # Added permission to disable the state machine
                                 "states:ListStateMachines",
@@ -120,12 +228,32 @@ class NatifyStack(Stack):
                                 "events:DisableRule"
                             ],
                             resources=["*"]
+                        ),
+                        iam.PolicyStatement(
+                            actions=[
+                                "dynamodb:GetItem",
+                                "dynamodb:PutItem"
+                            ],
+                            resources=[
+                                f"arn:{self.partition}:dynamodb:{self.region}:{self.account}:table/{rate_limit_table_param.value_as_string}"
+                            ]
                         )
                     ]
                 )
             }
         )
 
+        # Lease-based lock keeping overlapping invocations for the VPC from repeating the
+        # same work; expired leases and cached results are removed by time to live
+        idempotency_table = dynamodb.Table(
+            self, "IdempotencyTable",
+            partition_key=dynamodb.Attribute(name="LockKey", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        idempotency_table.grant(lambda_execution_role, "dynamodb:GetItem", "dynamodb:PutItem", "dynamodb:DeleteItem")
+
         # Define the Lambda function that uses the uploaded zip file as the code
         user_lambda = lambda_.Function(
             self, "UserLambdaFunction",
@@ -133,16 +261,25 @@ class NatifyStack(Stack):
             handler="natifylambda.natifylambda.handler",
             # The final stack will eventually use the uploaded zip file as the code
 #            code=lambda_.S3Code(bucket=s3_bucket, key=f"natifylambda-{natifylambda_version}.zip"),
-            # The following is for generating the assets
-            code=lambda_.Code.from_asset("natifylambda"),
+            # The following is for generating the assets, from the reproducible cached bundle
+            code=lambda_.Code.from_asset(asset_bundler.bundle()),
             role=lambda_execution_role,  # Assign the created IAM role to the Lambda function
-            timeout=Duration.seconds(20),
+            # Leaves room to wait for route convergence and the optional reachability probe
+            timeout=Duration.seconds(120),
             environment={
                 "VPC_NAME": vpc_name,
                 "VPC_ID": vpc_id,
                 "NAT_INSTANCE_ID": nat_instance.instance_id,
                 # We use Lambda to allow inbound traffic to the NAT instance
-                "NAT_SG_ID": nat_sg.security_group_id
+                "NAT_SG_ID": nat_sg.security_group_id,
+                "PROBE_ENI_ID": probe_eni_id_param.value_as_string,
+                "RATE_LIMIT_TABLE": rate_limit_table_param.value_as_string,
+                "RATE_LIMIT_PER_SECOND": rate_limit_param.value_as_string,
+                "RATE_LIMIT_BURST": rate_limit_burst_param.value_as_string,
+                "GATEWAY_ENDPOINTS": gateway_endpoints_param.value_as_string,
+                "IDEMPOTENCY_TABLE": idempotency_table.table_name,
+                # The lease taken in DistributedMap mode lasts as long as the execution may run
+                "DISTRIBUTED_MAP_TIMEOUT": map_timeout_param.value_as_string
             }
         )
 
@@ -157,7 +294,78 @@ class NatifyStack(Stack):
             input_path="$",  # Modified to pass the entire input
             result_path="$.Result"
         )
-        definition = sfn.DefinitionBody.from_chainable(wait_state.next(lambda_invoke_state))
+
+        # DistributedMap mode: take the idempotency lease of the execution, list the route
+        # tables and attach them to the gateway endpoints once, update them in batches with
+        # bounded concurrency, then run the remaining natify steps once and complete the lease.
+        # An execution that does not get the lease stops right away.
+        list_route_tables_state = tasks.LambdaInvoke(
+            self, "ListRouteTables",
+            lambda_function=user_lambda,
+            payload=sfn.TaskInput.from_object({
+                "action": "list_route_tables",
+                "execution_id": sfn.JsonPath.execution_id
+            }),
+            result_selector={
+                "LockStatus.$": "$.Payload.LockStatus",
+                "RouteTableIds.$": "$.Payload.RouteTableIds"
+            },
+            result_path="$.List"
+        )
+        update_route_tables_map = sfn.DistributedMap(
+            self, "UpdateRouteTablesMap",
+            items_path="$.List.RouteTableIds",
+            item_batcher=sfn.ItemBatcher(
+                max_items_per_batch=route_table_batch_size_param.value_as_number
+            ),
+            max_concurrency=map_max_concurrency_param.value_as_number,
+            result_path=sfn.JsonPath.DISCARD
+        )
+        update_route_tables_map.item_processor(tasks.LambdaInvoke(
+            self, "UpdateRouteTableBatch",
+            lambda_function=user_lambda,
+            payload=sfn.TaskInput.from_object({
+                "action": "update_route_tables",
+                "route_table_ids": sfn.JsonPath.list_at("$.Items")
+            })
+        ))
+        finalize_state = tasks.LambdaInvoke(
+            self, "FinalizeNatify",
+            lambda_function=user_lambda,
+            payload=sfn.TaskInput.from_object({
+                "action": "finalize",
+                "execution_id": sfn.JsonPath.execution_id
+            }),
+            result_path="$.Result"
+        )
+        # Give the lease up when a batch failed, so the next execution retries right away
+        update_route_tables_map.add_catch(
+            tasks.LambdaInvoke(
+                self, "ReleaseLock",
+                lambda_function=user_lambda,
+                payload=sfn.TaskInput.from_object({
+                    "action": "release_lock",
+                    "execution_id": sfn.JsonPath.execution_id
+                }),
+                result_path=sfn.JsonPath.DISCARD
+            ).next(sfn.Fail(self, "UpdateRouteTablesFailed")),
+            result_path="$.Error"
+        )
+        lease_choice = sfn.Choice(self, "LeaseChoice").when(
+            sfn.Condition.or_(
+                sfn.Condition.string_equals("$.List.LockStatus", "in_progress"),
+                sfn.Condition.string_equals("$.List.LockStatus", "cached")
+            ),
+            sfn.Succeed(self, "AlreadyReconciled")
+        ).otherwise(update_route_tables_map.next(finalize_state))
+        route_update_mode_choice = sfn.Choice(self, "RouteUpdateModeChoice").when(
+            sfn.Condition.and_(
+                sfn.Condition.is_present("$.mode"),
+                sfn.Condition.string_equals("$.mode", "DistributedMap")
+            ),
+            list_route_tables_state.next(lease_choice)
+        ).otherwise(lambda_invoke_state)
+        definition = sfn.DefinitionBody.from_chainable(wait_state.next(route_update_mode_choice))
         
         unique_id = str(uuid.uuid4())[:8]  # Truncate UUID to ensure length constraints
         state_machine_name = "NatifySM-" + unique_id
@@ -167,7 +375,13 @@ class NatifyStack(Stack):
             self, "StateMachine",
             state_machine_name=state_machine_name,
             definition_body=definition,
-            timeout=Duration.minutes(5)
+            # A single Lambda invocation fits in 5 minutes, a Distributed Map over thousands
+            # of route tables does not
+            timeout=Duration.seconds(Token.as_number(Fn.condition_if(
+                distributed_map_condition.logical_id,
+                map_timeout_param.value_as_number,
+                Duration.minutes(5).to_seconds()
+            )))
         )
 
         # Update the user_lambda environment to include STATE_MACHINE_ARN
@@ -180,12 +394,46 @@ class NatifyStack(Stack):
             self, "Rule",
             rule_name=event_rule_name,
             schedule=events.Schedule.expression("rate(1 minute)"),
-            targets=[targets.SfnStateMachine(state_machine)]
+            targets=[targets.SfnStateMachine(
+                state_machine,
+                input=events.RuleTargetInput.from_object({"mode": route_update_mode_param.value_as_string})
+            )]
         )
 
         # Inject the event rule name as an environment variable to the Lambda function
         user_lambda.add_environment("EVENT_RULE_NAME", event_rule_name)
 
+        # Incrementally reconcile subnets created, named as private or re-associated
+        # after the initial run. Requires a CloudTrail trail recording management events.
+        events.Rule(
+            self, "SubnetChangeRule",
+            event_pattern=events.EventPattern(
+                source=["aws.ec2"],
+                detail_type=["AWS API Call via CloudTrail"],
+                detail={
+                    "eventSource": ["ec2.amazonaws.com"],
+                    "eventName": [name for name in RECONCILE_EVENT_NAMES if name != "CreateTags"]
+                }
+            ),
+            targets=[targets.LambdaFunction(user_lambda)]
+        )
+        # Only tags on subnets, so tagging other resources does not invoke the function
+        events.Rule(
+            self, "SubnetTagRule",
+            event_pattern=events.EventPattern(
+                source=["aws.ec2"],
+                detail_type=["AWS API Call via CloudTrail"],
+                detail={
+                    "eventSource": ["ec2.amazonaws.com"],
+                    "eventName": ["CreateTags"],
+                    "requestParameters": {
+                        "resourcesSet": {"items": {"resourceId": [{"prefix": "subnet-"}]}}
+                    }
+                }
+            ),
+            targets=[targets.LambdaFunction(user_lambda)]
+        )
+
     def launch_nat_instance(self, vpc_id, nat_instance_type, public_subnet_id, availability_zone):
         # Lookup the VPC using the VPC ID
         vpc = ec2.Vpc.from_vpc_attributes(
@@ -214,5 +462,73 @@ class NatifyStack(Stack):
             associate_public_ip_address=True,
             source_dest_check=False # not working, we'll use Lambda to disable it
         )
+
+        # Allow the forwarding metrics agent to publish to its own namespace only
+        nat_instance.add_to_role_policy(iam.PolicyStatement(
+            actions=["cloudwatch:PutMetricData"],
+            resources=["*"],
+            conditions={"StringEquals": {"cloudwatch:namespace": nat_agent.NAMESPACE}}
+        ))
+        # Registers the instance with SSM, which installs the agent through State Manager
+        nat_instance.role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name("AmazonSSMManagedInstanceCore")
+        )
+        self.nat_agent_association(nat_instance)
         
         return nat_instance, nat_sg
+
+    def nat_agent_association(self, nat_instance):
+        """
+        Installs the forwarding metrics agent (natifylambda/nat_agent.py) on the NAT
+        instance as a systemd service, through an SSM State Manager association.
+
+        Unlike user data, this does not depend on the first boot: the association runs
+        on instances that are already deployed, as soon as their SSM agent registers, and
+        again whenever the agent changes, without stopping the instance. The agent source
+        is embedded in the SSM document, since the templates are deployed without CDK
+        assets; a changed agent replaces the document and so the association.
+
+        :param nat_instance: The NAT instance.
+        :return: The SSM association.
+        """
+        agent_source = Path(nat_agent.__file__).read_text()
+        document = ssm.CfnDocument(
+            self, "NatAgentDocument",
+            document_type="Command",
+            content={
+                "schemaVersion": "2.2",
+                "description": "Install the natifylambda NAT instance forwarding metrics agent",
+                "mainSteps": [{
+                    "action": "aws:runShellScript",
+                    "name": "InstallNatAgent",
+                    "inputs": {
+                        "runCommand": [
+                            "set -e",
+                            "dnf install -y python3-boto3 ethtool || yum install -y python3-boto3 ethtool",
+                            "mkdir -p /opt/natifylambda",
+                            f"cat > /opt/natifylambda/nat_agent.py <<'NAT_AGENT_EOF'\n{agent_source}NAT_AGENT_EOF",
+                            "cat > /etc/systemd/system/natify-nat-agent.service <<'UNIT_EOF'\n"
+                            "[Unit]\n"
+                            "Description=natifylambda NAT instance forwarding metrics agent\n"
+                            "After=network-online.target\n"
+                            "[Service]\n"
+                            f"ExecStart=/usr/bin/python3 /opt/natifylambda/nat_agent.py --region {self.region}\n"
+                            "Restart=always\n"
+                            "RestartSec=10\n"
+                            "[Install]\n"
+                            "WantedBy=multi-user.target\n"
+                            "UNIT_EOF",
+                            "systemctl daemon-reload",
+                            "systemctl enable natify-nat-agent.service",
+                            # Pick up a changed agent on instances where it already runs
+                            "systemctl restart natify-nat-agent.service",
+                        ]
+                    }
+                }]
+            }
+        )
+        return ssm.CfnAssociation(
+            self, "NatAgentAssociation",
+            name=document.ref,
+            targets=[ssm.CfnAssociation.TargetProperty(key="InstanceIds", values=[nat_instance.instance_id])]
+        )
@@ -0,0 +1,7 @@
+"""Allows running natifyLambda as `python -m natifylambda`."""
+import sys
+
+from natifylambda.cli import main
+
+if __name__ == '__main__':
+    sys.exit(main())
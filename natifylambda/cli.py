@@ -0,0 +1,182 @@
+"""Command line interface, running the natify functions directly against a VPC."""
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import boto3
+
+from natifylambda import __version__
+from natifylambda.ratelimit import (
+    DEFAULT_BUCKET_KEY,
+    DEFAULT_CAPACITY,
+    DEFAULT_RATE,
+    DynamoDBBucketStore,
+    RateLimitedClient,
+    TokenBucket,
+)
+from natifylambda.natifylambda import (
+    get_route_table_name,
+    get_route_target,
+    list_private_route_tables,
+    modify_security_group,
+    plan_default_route,
+    point_default_route_to_nat,
+    stop_nat_instance_source_dest_check,
+)
+from natifylambda.routes import describe_route_tables_by_id, get_default_route
+
+DEFAULT_PARALLELISM = 8
+DEFAULT_WATCH_INTERVAL = 60
+# Number of watch iterations between two full topology refreshes
+DEFAULT_TOPOLOGY_REFRESH = 10
+
+
+@contextmanager
+def timed(timings, phase):
+    """
+    Records the wall-clock duration of the enclosed block in timings[phase].
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - start
+
+
+def converge(ec2_client, route_tables, nat_instance_id, parallelism, plan):
+    """
+    Points the default route of every route table that does not already use the NAT
+    instance to it, updating up to `parallelism` route tables at the same time.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param route_tables: Route tables as returned by describe_route_tables.
+    :param nat_instance_id: The ID of the NAT instance.
+    :param parallelism: The maximum number of concurrent route updates.
+    :param plan: Only print the planned changes if True.
+    :return: A dict mapping each route table ID to its planned or applied action.
+    """
+    planned = {rt['RouteTableId']: plan_default_route(rt, nat_instance_id) for rt in route_tables}
+    for rt in route_tables:
+        action = planned[rt['RouteTableId']]
+        current = get_route_target(get_default_route(rt))
+        print(f"{'Plan' if plan else 'Route'}: {rt['RouteTableId']} ({get_route_table_name(rt)}) {current} -> {action}")
+    if plan:
+        return planned
+    pending = [rt for rt in route_tables if planned[rt['RouteTableId']] != "unchanged"]
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        applied = executor.map(lambda rt: point_default_route_to_nat(ec2_client, rt, nat_instance_id), pending)
+        planned.update(zip((rt['RouteTableId'] for rt in pending), applied))
+    return planned
+
+
+def print_timings(timings, summary):
+    phases = ', '.join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())
+    print(f"[{time.strftime('%H:%M:%S')}] {summary} ({phases})")
+
+
+def reconcile(ec2_client, args):
+    """
+    Runs one reconciliation of the VPC: route tables, then the NAT security group and
+    source/destination check when they are given and not in plan mode.
+    """
+    timings = {}
+    with timed(timings, 'topology'):
+        route_table_ids = list_private_route_tables(ec2_client, args.vpc_id)
+    with timed(timings, 'read'):
+        route_tables = describe_route_tables_by_id(ec2_client, route_table_ids)
+    with timed(timings, 'routes'):
+        actions = converge(ec2_client, route_tables, args.nat_instance_id, args.parallelism, args.plan)
+    if not args.plan:
+        if args.nat_sg_id:
+            with timed(timings, 'security_group'):
+                modify_security_group(ec2_client, args.nat_sg_id, args.vpc_id)
+        with timed(timings, 'source_dest_check'):
+            stop_nat_instance_source_dest_check(ec2_client, args.nat_instance_id)
+    changed = sum(1 for action in actions.values() if action != "unchanged")
+    print_timings(timings, f"{len(actions)} route tables, {changed} {'to change' if args.plan else 'changed'}")
+    return actions
+
+
+def watch(ec2_client, args):
+    """
+    Re-reconciles the route tables every `args.interval` seconds. The private route
+    table topology is cached and only refreshed every `args.refresh` iterations, so
+    a steady-state iteration costs one read of the cached route tables.
+    """
+    route_table_ids = None
+    iteration = 0
+    while True:
+        timings = {}
+        if route_table_ids is None or iteration % args.refresh == 0:
+            with timed(timings, 'topology'):
+                route_table_ids = list_private_route_tables(ec2_client, args.vpc_id)
+        with timed(timings, 'read'):
+            route_tables = describe_route_tables_by_id(ec2_client, route_table_ids)
+        with timed(timings, 'routes'):
+            drifted = [rt for rt in route_tables if plan_default_route(rt, args.nat_instance_id) != "unchanged"]
+            converge(ec2_client, drifted, args.nat_instance_id, args.parallelism, args.plan)
+        print_timings(timings, f"{len(route_tables)} route tables, {len(drifted)} drifted")
+        iteration += 1
+        if args.iterations and iteration >= args.iterations:
+            return
+        time.sleep(args.interval)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='natifylambda',
+        description="Route the private subnets of a VPC through a NAT instance."
+    )
+    parser.add_argument('--version', action='version', version=f"%(prog)s {__version__}")
+    parser.add_argument('--vpc-id', required=True, help="The ID of the VPC.")
+    parser.add_argument('--nat-instance-id', required=True, help="The ID of the NAT instance.")
+    parser.add_argument('--nat-sg-id', help="The ID of the NAT instance's security group to open to the VPC CIDR.")
+    parser.add_argument('--profile', help="AWS profile to use.")
+    parser.add_argument('--region', help="AWS region of the VPC.")
+    parser.add_argument('--parallelism', type=int, default=DEFAULT_PARALLELISM,
+                        help=f"Maximum number of concurrent route updates (default: {DEFAULT_PARALLELISM}).")
+    parser.add_argument('--plan', action='store_true', help="Print the planned route changes without applying them.")
+    parser.add_argument('--watch', action='store_true', help="Keep re-reconciling the route tables on an interval.")
+    parser.add_argument('--interval', type=float, default=DEFAULT_WATCH_INTERVAL,
+                        help=f"Seconds between two watch iterations (default: {DEFAULT_WATCH_INTERVAL}).")
+    parser.add_argument('--refresh', type=int, default=DEFAULT_TOPOLOGY_REFRESH,
+                        help=f"Watch iterations between two topology refreshes (default: {DEFAULT_TOPOLOGY_REFRESH}).")
+    parser.add_argument('--iterations', type=int, default=0, help="Stop watching after this many iterations.")
+    parser.add_argument('--rate-limit-table',
+                        help="DynamoDB table of the token bucket shared with concurrent natify runs.")
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE,
+                        help=f"Mutating EC2 calls per second allowed by the shared bucket (default: {DEFAULT_RATE}).")
+    parser.add_argument('--rate-limit-burst', type=float, default=DEFAULT_CAPACITY,
+                        help=f"Capacity of the shared bucket (default: {DEFAULT_CAPACITY}).")
+    args = parser.parse_args(argv)
+    if args.parallelism < 1 or args.refresh < 1:
+        parser.error("--parallelism and --refresh must be at least 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    session = boto3.Session(profile_name=args.profile, region_name=args.region)
+    ec2_client = session.client('ec2')
+    if args.rate_limit_table:
+        bucket = TokenBucket(
+            DynamoDBBucketStore(session.client('dynamodb'), args.rate_limit_table),
+            key=DEFAULT_BUCKET_KEY,
+            rate=args.rate_limit,
+            capacity=args.rate_limit_burst
+        )
+        ec2_client = RateLimitedClient(ec2_client, bucket)
+    try:
+        if args.watch:
+            watch(ec2_client, args)
+        else:
+            reconcile(ec2_client, args)
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
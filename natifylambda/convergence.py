@@ -0,0 +1,160 @@
+"""Waiting for route changes to take effect.
+
+create_route and replace_route return before the change is visible, so the
+route tables are read back until their default route is active and points
+to the NAT instance. Optionally, a Reachability Analyzer probe from a test
+ENI to the NAT instance confirms that the private route and the security
+group of the NAT instance let traffic reach it. Reachability Analyzer only
+treats an instance as the end of a path, not as a hop, so the probe cannot
+follow the traffic through the NAT instance to the internet gateway.
+"""
+import json
+import os
+import random
+import time
+
+from natifylambda.routes import describe_route_tables_by_id, get_default_route
+
+DEFAULT_CONVERGENCE_TIMEOUT = 10
+DEFAULT_PROBE_TIMEOUT = 120
+# Seconds of Lambda execution time kept free after waiting for convergence
+CONVERGENCE_TIME_MARGIN = 3
+INITIAL_DELAY = 0.25
+MAX_DELAY = 4
+
+
+def backoff_delays(initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY):
+    """
+    Yields exponentially growing delays with full jitter, capped at max_delay.
+    """
+    delay = initial_delay
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, max_delay)
+
+
+def is_route_converged(rt, nat_instance_id):
+    """
+    Tells whether the default route of the route table is active and points to the NAT instance.
+    """
+    default_route = get_default_route(rt)
+    return (
+        default_route is not None
+        and default_route.get('InstanceId') == nat_instance_id
+        and default_route.get('State', 'active') == 'active'
+    )
+
+
+def wait_for_route_convergence(ec2_client, route_table_ids, nat_instance_id, timeout=DEFAULT_CONVERGENCE_TIMEOUT,
+                               clock=time.monotonic, sleep=time.sleep):
+    """
+    Reads the route tables back in batches, with exponential backoff, until the default
+    route of each of them is active and points to the NAT instance.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param route_table_ids: The IDs of the route tables that were changed.
+    :param nat_instance_id: The ID of the NAT instance.
+    :param timeout: The maximum number of seconds to wait.
+    :return: A dict mapping each route table ID to the seconds it took to converge,
+        or None if it had not converged when the timeout expired.
+    """
+    start = clock()
+    converged = dict.fromkeys(route_table_ids)
+    pending = list(dict.fromkeys(route_table_ids))
+    delays = backoff_delays()
+    while pending:
+        for rt in describe_route_tables_by_id(ec2_client, pending):
+            if is_route_converged(rt, nat_instance_id):
+                converged[rt['RouteTableId']] = round(clock() - start, 3)
+        pending = [route_table_id for route_table_id in pending if converged[route_table_id] is None]
+        remaining = timeout - (clock() - start)
+        if not pending or remaining <= 0:
+            break
+        sleep(min(next(delays), remaining))
+    for route_table_id in pending:
+        print(f"Route table {route_table_id} did not converge within {timeout} seconds")
+    return converged
+
+
+def probe_reachability(ec2_client, source_eni_id, destination_id, timeout=DEFAULT_PROBE_TIMEOUT,
+                       clock=time.monotonic, sleep=time.sleep):
+    """
+    Runs a Reachability Analyzer analysis from a test ENI in a private subnet to the
+    destination, typically the NAT instance, and removes it afterwards.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param source_eni_id: The ID of the network interface to probe from.
+    :param destination_id: The ID of the destination resource.
+    :param timeout: The maximum number of seconds to wait for the analysis.
+    :return: A tuple of (True if a path was found, None if the analysis did not
+        finish in time, otherwise False; seconds the probe took).
+    """
+    start = clock()
+    path_id = ec2_client.create_network_insights_path(
+        Source=source_eni_id,
+        Destination=destination_id,
+        Protocol='tcp'
+    )['NetworkInsightsPath']['NetworkInsightsPathId']
+    analysis_id = None
+    try:
+        analysis_id = ec2_client.start_network_insights_analysis(
+            NetworkInsightsPathId=path_id
+        )['NetworkInsightsAnalysis']['NetworkInsightsAnalysisId']
+        delays = backoff_delays(initial_delay=1, max_delay=10)
+        while True:
+            analysis = ec2_client.describe_network_insights_analyses(
+                NetworkInsightsAnalysisIds=[analysis_id]
+            )['NetworkInsightsAnalyses'][0]
+            if analysis['Status'] != 'running':
+                reachable = analysis['Status'] == 'succeeded' and analysis.get('NetworkPathFound', False)
+                return reachable, round(clock() - start, 3)
+            remaining = timeout - (clock() - start)
+            if remaining <= 0:
+                print(f"Reachability analysis {analysis_id} did not finish within {timeout} seconds")
+                return None, round(clock() - start, 3)
+            sleep(min(next(delays), remaining))
+    finally:
+        try:
+            if analysis_id:
+                ec2_client.delete_network_insights_analysis(NetworkInsightsAnalysisId=analysis_id)
+            ec2_client.delete_network_insights_path(NetworkInsightsPathId=path_id)
+        except ec2_client.exceptions.ClientError as e:
+            print(f"Failed to clean up reachability probe {path_id}: {e}")
+
+
+def wait_for_convergence(ec2_client, route_table_ids, nat_instance_id, context=None):
+    """
+    Waits until the changed route tables are effective and measures how long each of them
+    took, bounded by the CONVERGENCE_TIMEOUT environment variable and by the remaining
+    execution time of the Lambda. If PROBE_ENI_ID is set, a reachability probe from that
+    network interface to the NAT instance then confirms that the private route reaches it.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param route_table_ids: The IDs of the route tables that were changed.
+    :param nat_instance_id: The ID of the NAT instance.
+    :param context: The Lambda context, if any.
+    :return: A dict with the seconds to convergence per route table, the time until all
+        of them were effective (None if some did not converge) and the probe result.
+    """
+    def remaining_time(timeout):
+        if context is None:
+            return timeout
+        return min(timeout, context.get_remaining_time_in_millis() / 1000 - CONVERGENCE_TIME_MARGIN)
+
+    timeout = float(os.environ.get('CONVERGENCE_TIMEOUT', DEFAULT_CONVERGENCE_TIMEOUT))
+    converged = wait_for_route_convergence(ec2_client, route_table_ids, nat_instance_id, timeout=remaining_time(timeout))
+    seconds = list(converged.values())
+    result = {
+        'route_tables': converged,
+        'time_to_effective': max(seconds, default=0) if None not in seconds else None
+    }
+    print(f"Route convergence: {json.dumps(result)}")
+
+    probe_eni_id = os.environ.get('PROBE_ENI_ID')
+    if probe_eni_id and result['time_to_effective'] is not None:
+        reachable, probe_seconds = probe_reachability(
+            ec2_client, probe_eni_id, nat_instance_id, timeout=remaining_time(float('inf'))
+        )
+        result['reachability'] = {'reachable': reachable, 'seconds': probe_seconds}
+        print(f"Reachability from {probe_eni_id} to {nat_instance_id}: {reachable} after {probe_seconds}s")
+    return result
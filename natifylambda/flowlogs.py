@@ -0,0 +1,397 @@
+"""Offline VPC Flow Log analyzer for the traffic of the NAT instance.
+
+Streams flow log files, plain or gzip, in chunks of records and aggregates
+them with NumPy, so memory depends on the chunk size, the number of tracked
+addresses and the time span of the logs, not on the log volume. It reports:
+
+- the top talkers (sources) and destinations by bytes,
+- the bytes sent to S3 and DynamoDB, which gateway VPC endpoints would take
+  off the NAT instance (see GatewayEndpoints in NatifyStack),
+- the peak packets and bits per second and the peak number of concurrent flows,
+- the smallest NatInstanceType whose baseline bandwidth and conntrack table fit
+  the peaks.
+
+The bytes and packets of each flow log record are spread evenly over the
+minutes between its start and end, so the per-second peaks are per-minute
+averages, assuming each flow kept a steady rate over its record, whatever the
+aggregation interval of the flow logs. Top-K totals are exact as long as fewer than `max_tracked` addresses
+are seen; beyond that, the lightest ones are pruned.
+
+NumPy is an optional dependency: pip install natifylambda[flowlogs]
+
+Usage:
+
+    python -m natifylambda.flowlogs --eni eni-0123 --ip-ranges ip-ranges.json --region us-west-2 logs/*.log.gz
+"""
+import argparse
+import gzip
+import ipaddress
+import json
+import sys
+from itertools import chain, islice
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Fields of the default (version 2) flow log format
+DEFAULT_FIELDS = (
+    'version', 'account-id', 'interface-id', 'srcaddr', 'dstaddr', 'srcport', 'dstport',
+    'protocol', 'packets', 'bytes', 'start', 'end', 'action', 'log-status',
+)
+REQUIRED_FIELDS = ('srcaddr', 'dstaddr', 'packets', 'bytes', 'start', 'end')
+DEFAULT_CHUNK_SIZE = 100000
+DEFAULT_MAX_TRACKED = 10000
+DEFAULT_TOP = 10
+# ip-ranges.json services that gateway VPC endpoints can serve, with their endpoint service
+GATEWAY_ENDPOINT_SERVICES = {'S3': 's3', 'DYNAMODB': 'dynamodb'}
+# Margin kept between the observed peaks and the capacity of the recommended instance type
+HEADROOM = 1.5
+# t4g instance types with their baseline network bandwidth in Gbps and memory in GiB.
+# The default nf_conntrack_max grows with the memory, up to 262144 entries.
+NAT_INSTANCE_TYPES = (
+    ('t4g.nano', 0.032, 0.5),
+    ('t4g.micro', 0.064, 1),
+    ('t4g.small', 0.128, 2),
+    ('t4g.medium', 0.256, 4),
+    ('t4g.large', 0.512, 8),
+    ('t4g.xlarge', 1.024, 16),
+    ('t4g.2xlarge', 2.048, 32),
+)
+CONNTRACK_ENTRIES_PER_GIB = 65536
+MAX_CONNTRACK_ENTRIES = 262144
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError("The flow log analyzer requires NumPy: pip install natifylambda[flowlogs]")
+
+
+def open_log(path):
+    """
+    Opens a flow log file as text, decompressing it if it is gzipped.
+    """
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+def read_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads a flow log file in chunks of records.
+
+    :param path: The path of the plain or gzipped flow log file.
+    :param chunk_size: The maximum number of records per chunk.
+    :return: A generator of (field names, 2-D array of record fields) tuples. The field
+        names come from the header line if the file has one, as in S3 deliveries,
+        otherwise the default format is assumed. Malformed, NODATA and SKIPDATA records are dropped.
+    """
+    require_numpy()
+    with open_log(path) as f:
+        first = f.readline()
+        fields = tuple(first.split())
+        lines = f
+        if 'srcaddr' not in fields:
+            fields = DEFAULT_FIELDS
+            lines = chain([first], f)
+        missing = [name for name in REQUIRED_FIELDS if name not in fields]
+        if missing:
+            raise ValueError(f"{path} has no {', '.join(missing)} field")
+        packets = fields.index('packets')
+        while True:
+            block = list(islice(lines, chunk_size))
+            if not block:
+                return
+            chunk = [record for record in (line.split() for line in block) if len(record) == len(fields)]
+            if not chunk:
+                continue
+            records = np.array(chunk)
+            # NODATA and SKIPDATA records have "-" instead of counters
+            records = records[records[:, packets] != '-']
+            if len(records):
+                yield fields, records
+
+
+def ipv4_to_int(addresses):
+    """
+    Converts an array of dotted IPv4 addresses to integers, -1 for anything else such as IPv6.
+    """
+    values = np.full(len(addresses), -1, dtype=np.int64)
+    for i, address in enumerate(addresses.tolist()):
+        parts = address.split('.')
+        if len(parts) == 4 and all(part.isdigit() for part in parts):
+            a, b, c, d = (int(part) for part in parts)
+            values[i] = (a << 24) | (b << 16) | (c << 8) | d
+    return values
+
+
+class PrefixMatcher:
+    """Finds the gateway endpoint service of IPv4 addresses from sorted, non-overlapping ranges."""
+
+    def __init__(self, ranges):
+        """
+        :param ranges: A list of (first address, last address, service) tuples, as integers.
+        """
+        self.services = sorted({service for _, _, service in ranges})
+        starts, ends, indexes = [], [], []
+        for first, last, service in sorted(ranges):
+            if ends and first <= ends[-1]:
+                # Nested or overlapping prefix, already covered by the previous range
+                ends[-1] = max(ends[-1], last)
+                continue
+            starts.append(first)
+            ends.append(last)
+            indexes.append(self.services.index(service))
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.indexes = np.array(indexes, dtype=np.int64)
+
+    def lookup(self, addresses):
+        """
+        :param addresses: An array of IPv4 addresses as integers.
+        :return: The index in self.services of the service of each address, -1 if none.
+        """
+        if not len(self.starts):
+            return np.full(len(addresses), -1, dtype=np.int64)
+        position = np.searchsorted(self.starts, addresses, side='right') - 1
+        clipped = np.clip(position, 0, None)
+        matched = (position >= 0) & (addresses >= 0) & (addresses <= self.ends[clipped])
+        return np.where(matched, self.indexes[clipped], -1)
+
+
+def load_endpoint_prefixes(ip_ranges, region=None):
+    """
+    Builds the PrefixMatcher of the services reachable through gateway VPC endpoints.
+
+    :param ip_ranges: The parsed ip-ranges.json published by AWS.
+    :param region: The region of the VPC, as gateway endpoints only serve their own region.
+    :return: A PrefixMatcher.
+    """
+    ranges = []
+    for prefix in ip_ranges.get('prefixes', []):
+        service = GATEWAY_ENDPOINT_SERVICES.get(prefix['service'])
+        if service is None or (region and prefix['region'] != region):
+            continue
+        network = ipaddress.IPv4Network(prefix['ip_prefix'])
+        ranges.append((int(network.network_address), int(network.broadcast_address), service))
+    return PrefixMatcher(ranges)
+
+
+class TopCounter:
+    """
+    Totals per key that keeps at most 2 * capacity keys, pruning back to the
+    `capacity` heaviest ones when full, so memory stays bounded.
+    """
+
+    def __init__(self, capacity=DEFAULT_MAX_TRACKED):
+        self.capacity = capacity
+        self.totals = {}
+
+    def add(self, keys, values):
+        for key, value in zip(keys.tolist(), values.tolist()):
+            self.totals[key] = self.totals.get(key, 0) + value
+        if len(self.totals) > 2 * self.capacity:
+            keys = list(self.totals)
+            values = np.array([self.totals[key] for key in keys])
+            keep = np.argpartition(values, -self.capacity)[-self.capacity:]
+            self.totals = {keys[i]: self.totals[keys[i]] for i in keep.tolist()}
+
+    def top(self, count):
+        return sorted(self.totals.items(), key=lambda item: (-item[1], item[0]))[:count]
+
+
+def add_by_key(totals, keys, weights=None):
+    """
+    Adds the weights, or the number of occurrences, of each key of an array to a dict of totals.
+    """
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=weights, minlength=len(unique))
+    for key, value in zip(unique.tolist(), sums.tolist()):
+        totals[key] = totals.get(key, 0) + value
+
+
+def spread_over_minutes(starts, ends):
+    """
+    Splits the [start, end] time span of each record into the minutes it overlaps.
+
+    :param starts: An array of record start times, in seconds since the epoch.
+    :param ends: An array of record end times, in seconds since the epoch.
+    :return: A tuple of (index of the record, minute, share of the record's time span in
+        that minute) arrays, with one item per record and minute. A record whose start
+        and end are equal falls entirely in its start minute.
+    """
+    ends = np.maximum(ends, starts)
+    first, last = starts // 60, ends // 60
+    spans = last - first + 1
+    records = np.repeat(np.arange(len(starts)), spans)
+    minutes = first[records] + np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    overlap = np.minimum(ends[records], (minutes + 1) * 60) - np.maximum(starts[records], minutes * 60)
+    durations = (ends - starts)[records]
+    shares = np.where(durations > 0, overlap / np.maximum(durations, 1), 1.0)
+    return records, minutes, shares
+
+
+def recommend_instance_type(peak_bps, peak_flows, headroom=HEADROOM):
+    """
+    Returns the smallest t4g instance type whose baseline bandwidth and default conntrack
+    table hold the peaks with the given headroom, or the largest one if none does.
+    """
+    for name, gbps, memory in NAT_INSTANCE_TYPES:
+        conntrack_max = min(int(memory * CONNTRACK_ENTRIES_PER_GIB), MAX_CONNTRACK_ENTRIES)
+        if peak_bps * headroom <= gbps * 1e9 and peak_flows * headroom <= conntrack_max:
+            return name
+    return NAT_INSTANCE_TYPES[-1][0]
+
+
+class FlowLogAnalyzer:
+    """Aggregates flow log records of the NAT instance chunk by chunk."""
+
+    def __init__(self, eni=None, endpoint_prefixes=None, max_tracked=DEFAULT_MAX_TRACKED):
+        """
+        :param eni: The ID of the NAT instance's network interface, or None to keep every record.
+        :param endpoint_prefixes: A PrefixMatcher from load_endpoint_prefixes, or None.
+        :param max_tracked: The number of addresses tracked for the top talkers and destinations.
+        """
+        require_numpy()
+        self.eni = eni
+        self.endpoint_prefixes = endpoint_prefixes
+        self.records = 0
+        self.bytes = 0
+        self.packets = 0
+        self.talkers = TopCounter(max_tracked)
+        self.destinations = TopCounter(max_tracked)
+        self.endpoint_bytes = {}
+        self.bytes_per_minute = {}
+        self.packets_per_minute = {}
+        # Flows starting (+) and ending (-) in each minute, summed up to count the active ones
+        self.flow_changes = {}
+
+    def add(self, fields, records):
+        """
+        Aggregates a chunk of records as returned by read_chunks.
+        """
+        if self.eni:
+            if 'interface-id' not in fields:
+                raise ValueError("the flow logs have no interface-id field to filter on")
+            records = records[records[:, fields.index('interface-id')] == self.eni]
+        if not len(records):
+            return
+        column = {name: records[:, index] for index, name in enumerate(fields)}
+        byte_counts = column['bytes'].astype(np.int64)
+        packet_counts = column['packets'].astype(np.int64)
+        starts = column['start'].astype(np.int64)
+        ends = column['end'].astype(np.int64)
+        start_minutes, end_minutes = starts // 60, np.maximum(ends, starts) // 60
+
+        self.records += len(records)
+        self.bytes += int(byte_counts.sum())
+        self.packets += int(packet_counts.sum())
+        for counter, addresses in ((self.talkers, column['srcaddr']), (self.destinations, column['dstaddr'])):
+            unique, inverse = np.unique(addresses, return_inverse=True)
+            counter.add(unique, np.bincount(inverse, weights=byte_counts, minlength=len(unique)).astype(np.int64))
+        record_indexes, minutes, shares = spread_over_minutes(starts, ends)
+        add_by_key(self.bytes_per_minute, minutes, byte_counts[record_indexes] * shares)
+        add_by_key(self.packets_per_minute, minutes, packet_counts[record_indexes] * shares)
+        add_by_key(self.flow_changes, start_minutes)
+        add_by_key(self.flow_changes, end_minutes + 1, -np.ones(len(records)))
+
+        if self.endpoint_prefixes is not None:
+            # Match each address once, in both directions, as downloads come back from the service
+            addresses = np.concatenate([column['dstaddr'], column['srcaddr']])
+            unique, inverse = np.unique(addresses, return_inverse=True)
+            services = self.endpoint_prefixes.lookup(ipv4_to_int(unique))[inverse]
+            dst_services, src_services = services[:len(records)], services[len(records):]
+            record_services = np.where(dst_services >= 0, dst_services, src_services)
+            matched = record_services >= 0
+            sums = np.bincount(
+                record_services[matched], weights=byte_counts[matched],
+                minlength=len(self.endpoint_prefixes.services)
+            )
+            for service, value in zip(self.endpoint_prefixes.services, sums.tolist()):
+                self.endpoint_bytes[service] = self.endpoint_bytes.get(service, 0) + int(value)
+
+    def add_file(self, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        for fields, records in read_chunks(path, chunk_size):
+            self.add(fields, records)
+
+    def peak_concurrent_flows(self):
+        if not self.flow_changes:
+            return 0
+        minutes = sorted(self.flow_changes)
+        return int(max(np.cumsum([self.flow_changes[minute] for minute in minutes])))
+
+    def report(self, top=DEFAULT_TOP):
+        """
+        :return: A dict with the totals, top talkers and destinations, gateway endpoint
+            candidates, peaks and the recommended NatInstanceType.
+        """
+        peak_bps = max(self.bytes_per_minute.values(), default=0) * 8 / 60
+        peak_pps = max(self.packets_per_minute.values(), default=0) / 60
+        peak_flows = self.peak_concurrent_flows()
+        endpoint_bytes = sum(self.endpoint_bytes.values())
+        return {
+            'records': self.records,
+            'bytes': self.bytes,
+            'packets': self.packets,
+            'top_talkers': self.talkers.top(top),
+            'top_destinations': self.destinations.top(top),
+            'gateway_endpoint_bytes': dict(sorted(self.endpoint_bytes.items())),
+            'gateway_endpoint_share': round(endpoint_bytes / self.bytes, 4) if self.bytes else 0.0,
+            'peak_bps': round(peak_bps, 1),
+            'peak_pps': round(peak_pps, 1),
+            'peak_concurrent_flows': peak_flows,
+            'recommended_instance_type': recommend_instance_type(peak_bps, peak_flows),
+        }
+
+
+def print_report(report):
+    print(f"Records: {report['records']}, {report['bytes']} bytes, {report['packets']} packets")
+    for title, key in (("Top talkers", 'top_talkers'), ("Top destinations", 'top_destinations')):
+        print(f"{title}:")
+        for address, total in report[key]:
+            print(f"  {address:<40} {total} bytes")
+    if report['gateway_endpoint_bytes']:
+        print(f"Gateway endpoint candidates ({report['gateway_endpoint_share']:.1%} of the bytes):")
+        for service, total in report['gateway_endpoint_bytes'].items():
+            print(f"  {service:<40} {total} bytes")
+    print(f"Peak: {report['peak_bps'] / 1e6:.2f} Mbps, {report['peak_pps']:.0f} pps, "
+          f"{report['peak_concurrent_flows']} concurrent flows")
+    print(f"Recommended NatInstanceType: {report['recommended_instance_type']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze the VPC Flow Logs of the NAT instance.")
+    parser.add_argument('files', nargs='+', help="Flow log files, plain or gzipped.")
+    parser.add_argument('--eni', help="Only analyze the records of this network interface, e.g. the NAT instance's.")
+    parser.add_argument('--ip-ranges', help="Path of the AWS ip-ranges.json, to find gateway endpoint candidates.")
+    parser.add_argument('--region', help="Region of the VPC, for the gateway endpoint candidates.")
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help=f"Number of top talkers and destinations (default: {DEFAULT_TOP}).")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"Records read at a time (default: {DEFAULT_CHUNK_SIZE}).")
+    parser.add_argument('--max-tracked', type=int, default=DEFAULT_MAX_TRACKED,
+                        help=f"Addresses tracked for the top talkers and destinations (default: {DEFAULT_MAX_TRACKED}).")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+    args = parser.parse_args(argv)
+    if np is None:
+        parser.error("NumPy is required: pip install natifylambda[flowlogs]")
+
+    endpoint_prefixes = None
+    if args.ip_ranges:
+        with open(args.ip_ranges) as f:
+            endpoint_prefixes = load_endpoint_prefixes(json.load(f), args.region)
+    analyzer = FlowLogAnalyzer(args.eni, endpoint_prefixes, args.max_tracked)
+    for path in args.files:
+        analyzer.add_file(path, args.chunk_size)
+    report = analyzer.report(args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
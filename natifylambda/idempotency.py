@@ -0,0 +1,229 @@
+"""Lease-based lock keeping natify invocations for the same VPC from overlapping.
+
+The rate(1 minute) rule and Step Functions retries can start the handler while
+a previous run is still changing routes. The first invocation takes a lease on
+the VPC and NAT instance; a duplicate invocation returns right away, either
+reporting that the run is in progress or returning the result of the run that
+just completed. A lease whose holder crashed expires on its own. In the
+DistributedMap mode of the state machine, the lease is taken by the
+list_route_tables step and completed by the finalize step, so that it covers
+the whole execution rather than a single invocation.
+
+The lock lives in a DynamoDB table with a string partition key named LockKey
+and time to live enabled on the ExpiresAt attribute, updated with conditional
+writes. Expiry is checked by the conditions, time to live only removes old
+items. LocalLockStore is an in-memory stand-in with the same semantics, for
+tests and single-process use.
+"""
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+# Seconds a completed result is returned to duplicate invocations
+DEFAULT_RESULT_TTL = 60
+# Seconds added to the remaining Lambda execution time when taking a lease
+LEASE_MARGIN = 30
+# Attempts to take a lease that is released or expires while it is being read
+MAX_ACQUIRE_ATTEMPTS = 3
+
+LockRecord = namedtuple('LockRecord', ['status', 'owner', 'expires_at', 'result'])
+
+
+class LocalLockStore:
+    """In-memory lock store, safe to share between threads."""
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._records.get(key)
+
+    def acquire(self, key, owner, expires_at, now):
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record.expires_at >= now:
+                return False
+            self._records[key] = LockRecord(IN_PROGRESS, owner, expires_at, None)
+            return True
+
+    def complete(self, key, owner, expires_at, result):
+        with self._lock:
+            record = self._records.get(key)
+            if record is None or record.owner != owner:
+                return False
+            self._records[key] = LockRecord(COMPLETED, owner, expires_at, result)
+            return True
+
+    def release(self, key, owner):
+        with self._lock:
+            record = self._records.get(key)
+            if record is None or record.owner != owner:
+                return False
+            del self._records[key]
+            return True
+
+
+class DynamoDBLockStore:
+    """Lock store backed by a DynamoDB table, shared by every invocation in the account."""
+
+    def __init__(self, dynamodb_client, table_name):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+
+    def get(self, key):
+        item = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={'LockKey': {'S': key}},
+            ConsistentRead=True
+        ).get('Item')
+        if item is None:
+            return None
+        result = json.loads(item['Result']['S']) if 'Result' in item else None
+        return LockRecord(item['LockStatus']['S'], item['LockOwner']['S'], int(item['ExpiresAt']['N']), result)
+
+    def _conditional(self, call, condition, values, **kwargs):
+        try:
+            call(
+                TableName=self.table_name,
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values,
+                **kwargs
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def _item(self, key, status, owner, expires_at, result=None):
+        item = {
+            'LockKey': {'S': key},
+            'LockStatus': {'S': status},
+            'LockOwner': {'S': owner},
+            'ExpiresAt': {'N': str(expires_at)}
+        }
+        if result is not None:
+            item['Result'] = {'S': json.dumps(result)}
+        return item
+
+    def acquire(self, key, owner, expires_at, now):
+        return self._conditional(
+            self.dynamodb_client.put_item,
+            'attribute_not_exists(LockKey) OR ExpiresAt < :now',
+            {':now': {'N': str(now)}},
+            Item=self._item(key, IN_PROGRESS, owner, expires_at)
+        )
+
+    def complete(self, key, owner, expires_at, result):
+        return self._conditional(
+            self.dynamodb_client.put_item,
+            'LockOwner = :owner',
+            {':owner': {'S': owner}},
+            Item=self._item(key, COMPLETED, owner, expires_at, result)
+        )
+
+    def release(self, key, owner):
+        return self._conditional(
+            self.dynamodb_client.delete_item,
+            'LockOwner = :owner',
+            {':owner': {'S': owner}},
+            Key={'LockKey': {'S': key}}
+        )
+
+
+class IdempotencyLock:
+    """
+    Runs a function at most once at a time per key, and hands its result to duplicate
+    invocations for `result_ttl` seconds after it completed.
+    """
+
+    def __init__(self, store, result_ttl=DEFAULT_RESULT_TTL, clock=time.time):
+        self.store = store
+        self.result_ttl = result_ttl
+        self.clock = clock
+
+    def acquire(self, key, lease_seconds, owner):
+        """
+        Takes a lease on the key, unless another invocation holds it.
+
+        :param key: The lock key, e.g. "<VPC ID>#<NAT instance ID>".
+        :param lease_seconds: How long the lease is held if it is never completed or released.
+        :param owner: A unique ID of the lease holder, e.g. the Lambda request ID.
+        :return: A tuple of ("acquired", None), ("cached", result of the run that just
+            completed) or ("in_progress", the LockRecord of the running one).
+        """
+        for _ in range(MAX_ACQUIRE_ATTEMPTS):
+            now = math.floor(self.clock())
+            if self.store.acquire(key, owner, now + math.ceil(lease_seconds), now):
+                return "acquired", None
+            record = self.store.get(key)
+            if record is None or record.expires_at < now:
+                # Released or expired between the two calls, try to take it again
+                continue
+            if record.status == COMPLETED:
+                print(f"Returning the result of {record.owner} for {key}")
+                return "cached", record.result
+            print(f"{key} is being reconciled by {record.owner} until {record.expires_at}")
+            return "in_progress", record
+        raise RuntimeError(f"Could not take or read the lease on {key}")
+
+    def complete(self, key, owner, result):
+        """
+        Stores the result of the run holding the lease, handed to duplicate invocations for
+        `result_ttl` seconds.
+        """
+        if not self.store.complete(key, owner, math.floor(self.clock()) + self.result_ttl, result):
+            print(f"Lease on {key} expired before {owner} completed")
+
+    def release(self, key, owner):
+        """
+        Gives the lease up without a result, so the next invocation can retry right away.
+        """
+        if not self.store.release(key, owner):
+            print(f"Lease on {key} was no longer held by {owner}")
+
+    def run(self, key, function, lease_seconds, owner=None):
+        """
+        Runs the function under a lease on the key, unless another invocation holds it.
+
+        :param key: The lock key, e.g. "<VPC ID>#<NAT instance ID>".
+        :param function: The function to run, returning a JSON-serializable result.
+        :param lease_seconds: How long the lease is held if this invocation never completes.
+        :param owner: A unique ID of this invocation, e.g. the Lambda request ID.
+        :return: A tuple of ("executed", result of the function), ("cached", result of
+            the run that just completed) or ("in_progress", the LockRecord of the running one).
+        """
+        owner = owner or str(uuid.uuid4())
+        status, value = self.acquire(key, lease_seconds, owner)
+        if status != "acquired":
+            return status, value
+        try:
+            result = function()
+        except Exception:
+            self.release(key, owner)
+            raise
+        self.complete(key, owner, result)
+        return "executed", result
+
+
+def lock_from_environment(dynamodb_client_factory):
+    """
+    Builds the idempotency lock from the IDEMPOTENCY_TABLE and IDEMPOTENCY_RESULT_TTL
+    environment variables.
+
+    :param dynamodb_client_factory: A callable returning a DynamoDB client.
+    :return: The IdempotencyLock, or None if IDEMPOTENCY_TABLE is not set.
+    """
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if not table_name:
+        return None
+    return IdempotencyLock(
+        DynamoDBLockStore(dynamodb_client_factory(), table_name),
+        result_ttl=int(os.environ.get('IDEMPOTENCY_RESULT_TTL', DEFAULT_RESULT_TTL))
+    )
@@ -0,0 +1,284 @@
+"""Forwarding metrics agent for the NAT instance.
+
+Samples how close the NAT instance is to its limits and publishes it as
+high-resolution CloudWatch metrics:
+
+- conntrack table fill, from /proc/sys/net/netfilter/nf_conntrack_{count,max}
+- dropped packets of the egress interface, from /proc/net/dev
+- per-CPU receive softirq load and backlog drops, from /proc/softirqs and
+  /proc/net/softnet_stat
+- ENA allowance-exceeded counters, from `ethtool -S`
+
+Counters are published as the delta since the previous sample. Samples are
+buffered and flushed in batched PutMetricData calls. The agent only uses the
+standard library and boto3, and is installed by NatifyStack through an SSM
+State Manager association on the NAT instance.
+"""
+import argparse
+import subprocess
+import time
+import urllib.request
+from pathlib import Path
+
+import boto3
+
+NAMESPACE = 'NatifyLambda/NatInstance'
+DEFAULT_SAMPLE_INTERVAL = 5
+DEFAULT_FLUSH_INTERVAL = 60
+# Maximum number of metric data items per PutMetricData call
+MAX_METRICS_PER_CALL = 1000
+# Metric data items kept while CloudWatch cannot be reached, the oldest are dropped first
+MAX_BUFFERED_METRICS = 10 * MAX_METRICS_PER_CALL
+# Counters of the ENA driver telling how often a limit of the instance was hit
+ENA_ALLOWANCE_COUNTERS = (
+    'bw_in_allowance_exceeded',
+    'bw_out_allowance_exceeded',
+    'pps_allowance_exceeded',
+    'conntrack_allowance_exceeded',
+    'linklocal_allowance_exceeded',
+)
+IMDS_URL = 'http://169.254.169.254/latest'
+
+
+def parse_conntrack(count_text, max_text):
+    """
+    Returns the conntrack gauges from the contents of nf_conntrack_count and nf_conntrack_max.
+    """
+    count, maximum = int(count_text), int(max_text)
+    return {
+        'ConntrackCount': count,
+        'ConntrackMax': maximum,
+        'ConntrackUsedPercent': round(100.0 * count / maximum, 2) if maximum else 0.0,
+    }
+
+
+def parse_default_interface(route_text):
+    """
+    Returns the interface of the IPv4 default route from the contents of /proc/net/route,
+    or None if there is no default route.
+    """
+    for line in route_text.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) > 1 and fields[1] == '00000000':
+            return fields[0]
+    return None
+
+
+def parse_net_dev(text):
+    """
+    Returns the packet and drop counters of each interface from the contents of /proc/net/dev.
+    """
+    interfaces = {}
+    for line in text.splitlines()[2:]:
+        name, _, counters = line.partition(':')
+        values = [int(value) for value in counters.split()]
+        interfaces[name.strip()] = {
+            'rx_packets': values[1],
+            'rx_drop': values[3],
+            'tx_packets': values[9],
+            'tx_drop': values[11],
+        }
+    return interfaces
+
+
+def parse_softnet_stat(text):
+    """
+    Returns, per CPU, the packets processed, the packets dropped because the backlog
+    was full and the times the softirq ran out of budget, from /proc/net/softnet_stat.
+    """
+    cpus = []
+    for line in text.splitlines():
+        fields = [int(value, 16) for value in line.split()]
+        cpus.append({'processed': fields[0], 'dropped': fields[1], 'time_squeeze': fields[2]})
+    return cpus
+
+
+def parse_softirqs(text, name='NET_RX'):
+    """
+    Returns the per-CPU count of the given softirq from the contents of /proc/softirqs.
+    """
+    for line in text.splitlines()[1:]:
+        label, _, counts = line.partition(':')
+        if label.strip() == name:
+            return [int(count) for count in counts.split()]
+    return []
+
+
+def parse_ethtool_stats(text):
+    """
+    Returns the ENA allowance-exceeded counters found in the output of `ethtool -S`.
+    Drivers other than ENA do not have them, so the result may be empty.
+    """
+    stats = {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition(':')
+        if sep and key in ENA_ALLOWANCE_COUNTERS:
+            stats[key] = int(value)
+    return stats
+
+
+def read_sample(interface, proc=Path('/proc'), run=subprocess.run):
+    """
+    Reads one sample of the gauges and cumulative counters of the NAT instance.
+
+    :param interface: The egress interface, e.g. ens5.
+    :param proc: The root of the proc filesystem.
+    :param run: The function running ethtool.
+    :return: A tuple of (gauges, counters), each a dict mapping (metric name, CPU or None) to a value.
+    """
+    netfilter = proc / 'sys/net/netfilter'
+    gauges = {}
+    if (netfilter / 'nf_conntrack_count').exists():
+        conntrack = parse_conntrack(
+            (netfilter / 'nf_conntrack_count').read_text(), (netfilter / 'nf_conntrack_max').read_text()
+        )
+        gauges.update({(name, None): value for name, value in conntrack.items()})
+
+    counters = {}
+    dev = parse_net_dev((proc / 'net/dev').read_text()).get(interface, {})
+    counters.update({
+        ('RxPackets', None): dev.get('rx_packets', 0),
+        ('RxDropped', None): dev.get('rx_drop', 0),
+        ('TxPackets', None): dev.get('tx_packets', 0),
+        ('TxDropped', None): dev.get('tx_drop', 0),
+    })
+    for cpu, stat in enumerate(parse_softnet_stat((proc / 'net/softnet_stat').read_text())):
+        counters[('SoftnetDropped', str(cpu))] = stat['dropped']
+        counters[('SoftnetTimeSqueeze', str(cpu))] = stat['time_squeeze']
+    for cpu, count in enumerate(parse_softirqs((proc / 'softirqs').read_text())):
+        counters[('NetRxSoftirqs', str(cpu))] = count
+
+    try:
+        ethtool = run(['ethtool', '-S', interface], check=True, capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Failed to read ENA statistics of {interface}: {e}")
+        ethtool = ''
+    for key, value in parse_ethtool_stats(ethtool).items():
+        counters[(''.join(part.capitalize() for part in key.split('_')), None)] = value
+    return gauges, counters
+
+
+def counter_deltas(previous, current):
+    """
+    Returns the increase of each counter since the previous sample. Counters that went
+    down, e.g. after a driver reset, or that are new are skipped.
+    """
+    return {
+        key: value - previous[key]
+        for key, value in current.items()
+        if key in previous and value >= previous[key]
+    }
+
+
+def build_metric_data(values, instance_id, timestamp, unit):
+    """
+    Builds the high-resolution PutMetricData items of one sample.
+
+    :param values: A dict mapping (metric name, CPU or None) to a value.
+    :param instance_id: The ID of the NAT instance, used as the InstanceId dimension.
+    :param timestamp: The time of the sample, in seconds since the epoch.
+    :param unit: The CloudWatch unit of the values, or a callable returning it from the metric name.
+    :return: A list of metric data items.
+    """
+    metric_data = []
+    for (name, cpu), value in sorted(values.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+        dimensions = [{'Name': 'InstanceId', 'Value': instance_id}]
+        if cpu is not None:
+            dimensions.append({'Name': 'Cpu', 'Value': cpu})
+        metric_data.append({
+            'MetricName': name,
+            'Dimensions': dimensions,
+            'Timestamp': timestamp,
+            'Value': value,
+            'Unit': unit(name) if callable(unit) else unit,
+            'StorageResolution': 1,
+        })
+    return metric_data
+
+
+def gauge_unit(name):
+    return 'Percent' if name.endswith('Percent') else 'Count'
+
+
+def publish(cloudwatch_client, metric_data, namespace=NAMESPACE):
+    """
+    Publishes the metric data in as few PutMetricData calls as possible.
+
+    :return: The number of calls made.
+    """
+    calls = 0
+    for i in range(0, len(metric_data), MAX_METRICS_PER_CALL):
+        cloudwatch_client.put_metric_data(Namespace=namespace, MetricData=metric_data[i:i + MAX_METRICS_PER_CALL])
+        calls += 1
+    return calls
+
+
+def get_instance_id():
+    """
+    Returns the ID of the instance the agent runs on, from the instance metadata service (IMDSv2).
+    """
+    token_request = urllib.request.Request(
+        f"{IMDS_URL}/api/token", method='PUT', headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'}
+    )
+    with urllib.request.urlopen(token_request, timeout=2) as response:
+        token = response.read().decode()
+    id_request = urllib.request.Request(
+        f"{IMDS_URL}/meta-data/instance-id", headers={'X-aws-ec2-metadata-token': token}
+    )
+    with urllib.request.urlopen(id_request, timeout=2) as response:
+        return response.read().decode()
+
+
+def run(cloudwatch_client, instance_id, interface, sample_interval, flush_interval,
+        sample=read_sample, clock=time.time, sleep=time.sleep, iterations=0):
+    """
+    Samples every `sample_interval` seconds and flushes the buffered metric data every
+    `flush_interval` seconds, until `iterations` samples were taken if it is not 0.
+    """
+    previous = None
+    buffered = []
+    last_flush = clock()
+    iteration = 0
+    while True:
+        now = clock()
+        gauges, counters = sample(interface)
+        buffered += build_metric_data(gauges, instance_id, now, gauge_unit)
+        if previous is not None:
+            buffered += build_metric_data(counter_deltas(previous, counters), instance_id, now, 'Count')
+        previous = counters
+        iteration += 1
+        done = iterations and iteration >= iterations
+        if buffered and (done or now - last_flush >= flush_interval):
+            try:
+                publish(cloudwatch_client, buffered)
+                buffered = []
+            except Exception as e:
+                # Keep the samples for the next flush rather than stopping the agent
+                print(f"Failed to publish {len(buffered)} metric data items: {e}")
+                buffered = buffered[-MAX_BUFFERED_METRICS:]
+            last_flush = now
+        if done:
+            return
+        sleep(sample_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Publish NAT instance forwarding metrics to CloudWatch.")
+    parser.add_argument('--interface', help="Egress interface (default: the interface of the default route).")
+    parser.add_argument('--region', help="AWS region of the instance.")
+    parser.add_argument('--sample-interval', type=float, default=DEFAULT_SAMPLE_INTERVAL,
+                        help=f"Seconds between two samples (default: {DEFAULT_SAMPLE_INTERVAL}).")
+    parser.add_argument('--flush-interval', type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help=f"Seconds between two PutMetricData flushes (default: {DEFAULT_FLUSH_INTERVAL}).")
+    args = parser.parse_args(argv)
+    interface = args.interface or parse_default_interface(Path('/proc/net/route').read_text())
+    if interface is None:
+        parser.error("no default route found, use --interface")
+    instance_id = get_instance_id()
+    print(f"Publishing forwarding metrics of {instance_id} ({interface}) to {NAMESPACE}")
+    run(boto3.client('cloudwatch', region_name=args.region), instance_id, interface,
+        args.sample_interval, args.flush_interval)
+
+
+if __name__ == '__main__':
+    main()
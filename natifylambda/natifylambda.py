@@ -2,6 +2,57 @@
 import json
 import boto3
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from natifylambda.convergence import wait_for_convergence
+from natifylambda.idempotency import LEASE_MARGIN, lock_from_environment
+from natifylambda.ratelimit import RateLimitedClient, bucket_from_environment
+from natifylambda.routes import describe_route_tables_by_id, get_default_route
+
+# CloudTrail API calls that can introduce a private subnet or route table
+# which is not yet routed through the NAT instance
+RECONCILE_EVENT_NAMES = (
+    'CreateSubnet',
+    'CreateTags',
+    'AssociateRouteTable',
+    'ReplaceRouteTableAssociation',
+)
+
+# Tag on each route table recording the target of its default route before
+# natifylambda changed it, e.g. "NatGatewayId=nat-0123" or "none"
+JOURNAL_TAG_KEY = 'natifylambda:previous-default-route'
+NO_PREVIOUS_ROUTE = 'none'
+# Route target attributes, in the order they are preferred when restoring
+ROUTE_TARGET_KEYS = (
+    'InstanceId',
+    'NatGatewayId',
+    'TransitGatewayId',
+    'GatewayId',
+    'VpcPeeringConnectionId',
+    'NetworkInterfaceId',
+    'EgressOnlyInternetGatewayId',
+    'LocalGatewayId',
+    'CarrierGatewayId',
+    'CoreNetworkArn',
+)
+RESTORE_MAX_WORKERS = 16
+# Services reached through gateway VPC endpoints instead of the NAT instance by default
+DEFAULT_GATEWAY_ENDPOINT_SERVICES = ('s3', 'dynamodb')
+# Seconds a DistributedMap execution may run, see DistributedMapTimeoutSeconds in NatifyStack
+DEFAULT_DISTRIBUTED_MAP_TIMEOUT = 3600
+
+def get_private_subnet_name(subnet):
+    """
+    Returns the name of the subnet if it is a private subnet, i.e. its lowercased
+    Name tag contains "private", otherwise None.
+
+    :param subnet: A subnet as returned by describe_subnets.
+    :return: The subnet name, or None if the subnet is not private.
+    """
+    for tag in subnet.get('Tags', []):
+        if tag['Key'].lower() == 'name' and 'private' in tag['Value'].lower():
+            return tag['Value']
+    return None
 
 def get_private_subnets(ec2_client, vpc_id):
     """
@@ -12,16 +63,115 @@ def get_private_subnets(ec2_client, vpc_id):
     :param vpc_id: The ID of the VPC for which to retrieve private subnets.
     :return: A list of tuples containing subnet IDs and their names that are private within the specified VPC.
     """
-    subnets = ec2_client.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+    pages = ec2_client.get_paginator('describe_subnets').paginate(
+        Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]
+    )
     private_subnets_info = []
-    for subnet in subnets['Subnets']:
-        for tag in subnet['Tags']:
-            if tag['Key'].lower() == 'name' and 'private' in tag['Value'].lower():
-                private_subnets_info.append((subnet['SubnetId'], tag['Value']))
-                break
+    for subnet in (subnet for page in pages for subnet in page['Subnets']):
+        subnet_name = get_private_subnet_name(subnet)
+        if subnet_name is not None:
+            private_subnets_info.append((subnet['SubnetId'], subnet_name))
     return private_subnets_info
 
+def get_route_target(route):
+    """
+    Returns the target of a route as a journal entry, e.g. "NatGatewayId=nat-0123",
+    or "none" if there is no route.
+    """
+    if route is None:
+        return NO_PREVIOUS_ROUTE
+    for key in ROUTE_TARGET_KEYS:
+        if route.get(key):
+            return f"{key}={route[key]}"
+    return NO_PREVIOUS_ROUTE
+
+def plan_default_route(rt, nat_instance_id):
+    """
+    Tells what point_default_route_to_nat would do to a route table, without changing it.
+
+    :param rt: A route table as returned by describe_route_tables.
+    :param nat_instance_id: The ID of the NAT instance.
+    :return: "unchanged" if the default route already points to the NAT instance,
+        otherwise "modified" or "added" as returned by point_default_route_to_nat.
+    """
+    default_route = get_default_route(rt)
+    if default_route is None:
+        return "added"
+    if default_route.get('InstanceId') == nat_instance_id:
+        return "unchanged"
+    return "modified"
+
+def journal_default_route(ec2_client, rt, nat_instance_id):
+    """
+    Records the current target of the default route in the JOURNAL_TAG_KEY tag of the
+    route table, so it can be restored later. An existing journal entry is kept, as it
+    holds the target from before natifylambda first touched the route table, and a
+    default route already pointing to the NAT instance is not journaled.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param rt: A route table as returned by describe_route_tables.
+    :param nat_instance_id: The ID of the NAT instance.
+    :return: The journaled target, or None if nothing was written.
+    """
+    if any(tag['Key'] == JOURNAL_TAG_KEY for tag in rt.get('Tags', [])):
+        return None
+    previous_target = get_route_target(get_default_route(rt))
+    if previous_target == f"InstanceId={nat_instance_id}":
+        return None
+    ec2_client.create_tags(
+        Resources=[rt['RouteTableId']],
+        Tags=[{'Key': JOURNAL_TAG_KEY, 'Value': previous_target}]
+    )
+    return previous_target
+
+def point_default_route_to_nat(ec2_client, rt, nat_instance_id):
+    """
+    Points the default route (0.0.0.0/0) of a route table to the NAT instance,
+    replacing the existing default route or creating one if there is none.
+    The previous target is journaled first, see journal_default_route.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param rt: A route table as returned by describe_route_tables.
+    :param nat_instance_id: The ID of the NAT instance.
+    :return: "modified" if the default route was replaced, "added" if it was created.
+    """
+    journal_default_route(ec2_client, rt, nat_instance_id)
+    if get_default_route(rt) is not None:
+        # Modify the existing default route to point to the NAT instance
+        ec2_client.replace_route(
+            RouteTableId=rt['RouteTableId'], 
+            DestinationCidrBlock='0.0.0.0/0', 
+            InstanceId=nat_instance_id
+        )
+        return "modified"
+    # Create a new default route that points to the NAT instance
+    ec2_client.create_route(
+        RouteTableId=rt['RouteTableId'], 
+        DestinationCidrBlock='0.0.0.0/0', 
+        InstanceId=nat_instance_id
+    )
+    return "added"
+
+def get_route_table_name(rt):
+    """
+    Returns the Name tag of a route table, or "Unnamed" if it has none.
+    """
+    return next(
+        (tag['Value'] for tag in rt.get('Tags', []) if tag['Key'] == 'Name'), 
+        'Unnamed'
+    )
+
 def modify_route_tables(ec2_client, vpc_id, nat_instance_id):
+    """
+    Points the default route of the route table of every private subnet of the VPC
+    to the NAT instance.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param vpc_id: The ID of the VPC.
+    :param nat_instance_id: The ID of the NAT instance.
+    :return: A list of the IDs of the route tables whose default route was updated.
+    """
+    updated = []
     private_subnets_info = get_private_subnets(ec2_client, vpc_id)
     for subnet_id, subnet_name in private_subnets_info:
         print(f"Modifying route table for private subnet: {subnet_id} - {subnet_name}")
@@ -30,36 +180,332 @@ def modify_route_tables(ec2_client, vpc_id, nat_instance_id):
             Filters=[{'Name': 'association.subnet-id', 'Values': [subnet_id]}]
         )
         for rt in route_tables['RouteTables']:
-            # Retrieve route table name
-            rt_name = next(
-                (tag['Value'] for tag in rt['Tags'] if tag['Key'] == 'Name'), 
-                'Unnamed'
-            )
-            # Check if a route to 0.0.0.0/0 exists
-            routes = rt['Routes']
-            default_route_exists = any(
-                route.get('DestinationCidrBlock') == '0.0.0.0/0' for route in routes
-            )
-            if default_route_exists:
-                # Modify the existing default route to point to the NAT instance
-                ec2_client.replace_route(
-                    RouteTableId=rt['RouteTableId'], 
-                    DestinationCidrBlock='0.0.0.0/0', 
-                    InstanceId=nat_instance_id
-                )
-                action = "modified"
-            else:
-                # Create a new default route that points to the NAT instance
-                ec2_client.create_route(
-                    RouteTableId=rt['RouteTableId'], 
-                    DestinationCidrBlock='0.0.0.0/0', 
-                    InstanceId=nat_instance_id
-                )
-                action = "added"
+            action = point_default_route_to_nat(ec2_client, rt, nat_instance_id)
             print(
                 f"Default route {action} for subnet: {subnet_id} to point to NAT instance: "
-                f"{nat_instance_id} in route table: {rt['RouteTableId']} ({rt_name})"
+                f"{nat_instance_id} in route table: {rt['RouteTableId']} ({get_route_table_name(rt)})"
             )
+            if rt['RouteTableId'] not in updated:
+                updated.append(rt['RouteTableId'])
+    return updated
+
+def list_private_route_tables(ec2_client, vpc_id):
+    """
+    Lists the route tables of the VPC that are associated with at least one private
+    subnet, reading all pages of the subnets and route tables of the VPC once each.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param vpc_id: The ID of the VPC.
+    :return: A sorted list of unique route table IDs.
+    """
+    private_subnet_ids = {subnet_id for subnet_id, _ in get_private_subnets(ec2_client, vpc_id)}
+    pages = ec2_client.get_paginator('describe_route_tables').paginate(
+        Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]
+    )
+    route_tables = [rt for page in pages for rt in page['RouteTables']]
+    return sorted(
+        rt['RouteTableId'] for rt in route_tables
+        if any(association.get('SubnetId') in private_subnet_ids for association in rt.get('Associations', []))
+    )
+
+def update_route_tables(ec2_client, vpc_id, route_table_ids, nat_instance_id):
+    """
+    Points the default route of a batch of route tables, as returned by
+    list_private_route_tables, to the NAT instance.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param vpc_id: The ID of the VPC, route tables outside of it are skipped.
+    :param route_table_ids: The IDs of the route tables in the batch.
+    :param nat_instance_id: The ID of the NAT instance.
+    :return: A list of the IDs of the route tables whose default route was updated.
+    """
+    if not route_table_ids:
+        return []
+    route_tables = describe_route_tables_by_id(ec2_client, route_table_ids)
+    updated = []
+    for rt in route_tables:
+        if rt['VpcId'] != vpc_id:
+            print(f"Route table {rt['RouteTableId']} is not in VPC {vpc_id}, skipping")
+            continue
+        action = point_default_route_to_nat(ec2_client, rt, nat_instance_id)
+        print(
+            f"Default route {action} to point to NAT instance: "
+            f"{nat_instance_id} in route table: {rt['RouteTableId']} ({get_route_table_name(rt)})"
+        )
+        updated.append(rt['RouteTableId'])
+    return updated
+
+def restore_route_table(ec2_client, rt):
+    """
+    Restores the default route of a route table to the target recorded in its journal
+    tag, then removes the tag.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param rt: A route table as returned by describe_route_tables, with a journal tag.
+    :return: "restored" if the previous target was put back, "deleted" if the route did not exist before.
+    """
+    previous_target = next(tag['Value'] for tag in rt['Tags'] if tag['Key'] == JOURNAL_TAG_KEY)
+    if previous_target == NO_PREVIOUS_ROUTE:
+        if get_default_route(rt) is not None:
+            ec2_client.delete_route(RouteTableId=rt['RouteTableId'], DestinationCidrBlock='0.0.0.0/0')
+        action = "deleted"
+    else:
+        key, value = previous_target.split('=', 1)
+        route_call = ec2_client.replace_route if get_default_route(rt) is not None else ec2_client.create_route
+        route_call(RouteTableId=rt['RouteTableId'], DestinationCidrBlock='0.0.0.0/0', **{key: value})
+        action = "restored"
+    ec2_client.delete_tags(Resources=[rt['RouteTableId']], Tags=[{'Key': JOURNAL_TAG_KEY}])
+    print(f"Default route {action} in route table: {rt['RouteTableId']} ({get_route_table_name(rt)}) from {previous_target}")
+    return action
+
+def restore_route_tables(ec2_client, vpc_id, max_workers=RESTORE_MAX_WORKERS):
+    """
+    Replays the route journal of every route table in the VPC concurrently, putting each
+    default route back to the target it had before natifylambda changed it.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param vpc_id: The ID of the VPC.
+    :param max_workers: The maximum number of route tables restored at the same time.
+    :return: A dict mapping each journaled route table ID to its restore action, or to the error message if it failed.
+    """
+    pages = ec2_client.get_paginator('describe_route_tables').paginate(
+        Filters=[
+            {'Name': 'vpc-id', 'Values': [vpc_id]},
+            {'Name': 'tag-key', 'Values': [JOURNAL_TAG_KEY]}
+        ]
+    )
+    route_tables = [rt for page in pages for rt in page['RouteTables']]
+
+    def restore(rt):
+        try:
+            return restore_route_table(ec2_client, rt)
+        except ec2_client.exceptions.ClientError as e:
+            print(f"Failed to restore route table {rt['RouteTableId']}: {e}")
+            return f"failed: {e.response['Error']['Code']}"
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        actions = list(executor.map(restore, route_tables))
+    return {rt['RouteTableId']: action for rt, action in zip(route_tables, actions)}
+
+def get_gateway_endpoint_services():
+    """
+    Returns the services listed in the comma-separated GATEWAY_ENDPOINTS environment
+    variable, DEFAULT_GATEWAY_ENDPOINT_SERVICES if it is not set, or none if it is empty.
+    """
+    services = os.environ.get('GATEWAY_ENDPOINTS')
+    if services is None:
+        return list(DEFAULT_GATEWAY_ENDPOINT_SERVICES)
+    return [service.strip() for service in services.split(',') if service.strip()]
+
+def ensure_gateway_endpoint(ec2_client, vpc_id, service_name, route_table_ids):
+    """
+    Attaches the route tables to the gateway VPC endpoint of the service, creating the
+    endpoint if the VPC has none. Route tables already attached to any gateway endpoint
+    of the service are left alone, as a route table can only route to one of them.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param vpc_id: The ID of the VPC.
+    :param service_name: The endpoint service name, e.g. "com.amazonaws.us-west-2.s3".
+    :param route_table_ids: The IDs of the private route tables.
+    :return: A tuple of (endpoint ID, "created", "attached" or "unchanged").
+    """
+    endpoints = [
+        endpoint for endpoint in ec2_client.describe_vpc_endpoints(
+            Filters=[
+                {'Name': 'vpc-id', 'Values': [vpc_id]},
+                {'Name': 'service-name', 'Values': [service_name]},
+                {'Name': 'vpc-endpoint-type', 'Values': ['Gateway']}
+            ]
+        )['VpcEndpoints']
+        if endpoint['State'].lower() not in ('deleting', 'deleted', 'failed', 'rejected')
+    ]
+    if not endpoints:
+        endpoint_id = ec2_client.create_vpc_endpoint(
+            VpcEndpointType='Gateway',
+            VpcId=vpc_id,
+            ServiceName=service_name,
+            RouteTableIds=route_table_ids
+        )['VpcEndpoint']['VpcEndpointId']
+        return endpoint_id, "created"
+    attached = {route_table_id for endpoint in endpoints for route_table_id in endpoint.get('RouteTableIds', [])}
+    missing = [route_table_id for route_table_id in route_table_ids if route_table_id not in attached]
+    endpoint_id = endpoints[0]['VpcEndpointId']
+    if not missing:
+        return endpoint_id, "unchanged"
+    ec2_client.modify_vpc_endpoint(VpcEndpointId=endpoint_id, AddRouteTableIds=missing)
+    return endpoint_id, "attached"
+
+def ensure_gateway_endpoints(ec2_client, vpc_id, route_table_ids, services, region):
+    """
+    Routes the traffic of the private route tables to the given services, S3 and DynamoDB
+    being the only ones with gateway endpoints, through gateway VPC endpoints rather than
+    the NAT instance. Failures are reported per service and do not stop natify.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param vpc_id: The ID of the VPC.
+    :param route_table_ids: The IDs of the route tables updated by natify.
+    :param services: The short service names, e.g. ["s3", "dynamodb"].
+    :param region: The region of the VPC.
+    :return: A dict mapping each service to its endpoint ID and action, or to the error message if it failed.
+    """
+    if not route_table_ids:
+        return {}
+    results = {}
+    for service in services:
+        service_name = f"com.amazonaws.{region}.{service}"
+        try:
+            endpoint_id, action = ensure_gateway_endpoint(ec2_client, vpc_id, service_name, sorted(set(route_table_ids)))
+        except ec2_client.exceptions.ClientError as e:
+            print(f"Failed to set up the gateway endpoint of {service_name}: {e}")
+            results[service] = f"failed: {e.response['Error']['Code']}"
+            continue
+        print(f"Gateway endpoint {endpoint_id} of {service_name} {action} for route tables: {', '.join(route_table_ids)}")
+        results[service] = {'VpcEndpointId': endpoint_id, 'action': action}
+    return results
+
+def reconcile_subnet(ec2_client, vpc_id, subnet_id, nat_instance_id):
+    """
+    Routes a single subnet through the NAT instance if it is a private subnet of the VPC.
+    Only the subnet and its route table are read. A subnet without an explicit association
+    uses the main route table of the VPC, which is only updated if its default route does
+    not go to an internet gateway, as it then also serves public subnets.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param vpc_id: The ID of the VPC managed by natifylambda.
+    :param subnet_id: The ID of the subnet to reconcile.
+    :param nat_instance_id: The ID of the NAT instance.
+    :return: A list of the IDs of the route tables whose default route was updated.
+    """
+    subnets = ec2_client.describe_subnets(SubnetIds=[subnet_id])['Subnets']
+    if not subnets or subnets[0]['VpcId'] != vpc_id:
+        print(f"Subnet {subnet_id} is not in VPC {vpc_id}, skipping")
+        return []
+    subnet_name = get_private_subnet_name(subnets[0])
+    if subnet_name is None:
+        print(f"Subnet {subnet_id} is not a private subnet, skipping")
+        return []
+    route_tables = ec2_client.describe_route_tables(
+        Filters=[{'Name': 'association.subnet-id', 'Values': [subnet_id]}]
+    )['RouteTables']
+    if not route_tables:
+        route_tables = ec2_client.describe_route_tables(
+            Filters=[
+                {'Name': 'vpc-id', 'Values': [vpc_id]},
+                {'Name': 'association.main', 'Values': ['true']}
+            ]
+        )['RouteTables']
+        default_route = get_default_route(route_tables[0]) if route_tables else None
+        if default_route is not None and default_route.get('GatewayId', '').startswith('igw-'):
+            print(f"Subnet {subnet_id} uses the main route table, which routes to an internet gateway, skipping")
+            return []
+    updated = []
+    for rt in route_tables:
+        action = point_default_route_to_nat(ec2_client, rt, nat_instance_id)
+        print(
+            f"Default route {action} for subnet: {subnet_id} ({subnet_name}) to point to NAT instance: "
+            f"{nat_instance_id} in route table: {rt['RouteTableId']} ({get_route_table_name(rt)})"
+        )
+        updated.append(rt['RouteTableId'])
+    return updated
+
+def reconcile_route_table(ec2_client, vpc_id, route_table_id, nat_instance_id):
+    """
+    Routes a single route table through the NAT instance if it is associated with
+    at least one private subnet of the VPC. Only the route table and its associated
+    subnets are read.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param vpc_id: The ID of the VPC managed by natifylambda.
+    :param route_table_id: The ID of the route table to reconcile.
+    :param nat_instance_id: The ID of the NAT instance.
+    :return: A list containing the route table ID if its default route was updated, otherwise empty.
+    """
+    route_tables = ec2_client.describe_route_tables(RouteTableIds=[route_table_id])['RouteTables']
+    if not route_tables or route_tables[0]['VpcId'] != vpc_id:
+        print(f"Route table {route_table_id} is not in VPC {vpc_id}, skipping")
+        return []
+    rt = route_tables[0]
+    subnet_ids = [
+        association['SubnetId'] for association in rt.get('Associations', [])
+        if association.get('SubnetId')
+    ]
+    if not subnet_ids:
+        print(f"Route table {route_table_id} is not associated with any subnet, skipping")
+        return []
+    subnets = ec2_client.describe_subnets(SubnetIds=subnet_ids)['Subnets']
+    private_subnet_ids = [
+        subnet['SubnetId'] for subnet in subnets if get_private_subnet_name(subnet) is not None
+    ]
+    if not private_subnet_ids:
+        print(f"Route table {route_table_id} is not associated with a private subnet, skipping")
+        return []
+    action = point_default_route_to_nat(ec2_client, rt, nat_instance_id)
+    print(
+        f"Default route {action} for subnets: {', '.join(private_subnet_ids)} to point to NAT instance: "
+        f"{nat_instance_id} in route table: {route_table_id} ({get_route_table_name(rt)})"
+    )
+    return [route_table_id]
+
+def is_reconcile_event(event):
+    """
+    Tells whether the Lambda event is an EventBridge CloudTrail event for one of
+    the EC2 API calls in RECONCILE_EVENT_NAMES.
+
+    :param event: The Lambda event.
+    :return: True if the event should trigger an incremental reconciliation.
+    """
+    return (
+        isinstance(event, dict)
+        and event.get('detail-type') == 'AWS API Call via CloudTrail'
+        and event.get('detail', {}).get('eventName') in RECONCILE_EVENT_NAMES
+    )
+
+def get_reconcile_targets(event):
+    """
+    Extracts the subnet and route table affected by a CloudTrail API call event.
+
+    :param event: An EventBridge CloudTrail event, see is_reconcile_event.
+    :return: A tuple of (subnet IDs, route table IDs) to reconcile.
+    """
+    detail = event['detail']
+    if detail.get('errorCode'):
+        # The API call failed, nothing has changed
+        return [], []
+    request = detail.get('requestParameters') or {}
+    response = detail.get('responseElements') or {}
+    event_name = detail['eventName']
+    if event_name == 'CreateSubnet':
+        return [response['subnet']['subnetId']], []
+    if event_name == 'CreateTags':
+        # A subnet named as private after it was created
+        resources = [item['resourceId'] for item in request.get('resourcesSet', {}).get('items', [])]
+        renamed = any(
+            tag['key'].lower() == 'name' and 'private' in tag.get('value', '').lower()
+            for tag in request.get('tagSet', {}).get('items', [])
+        )
+        return [r for r in resources if r.startswith('subnet-')] if renamed else [], []
+    # AssociateRouteTable and ReplaceRouteTableAssociation both carry the
+    # route table that is now in effect for the subnet
+    return [], [request['routeTableId']]
+
+def reconcile_from_event(ec2_client, event, vpc_id, nat_instance_id):
+    """
+    Incrementally reconciles only the subnet or route table touched by a CloudTrail
+    API call event, instead of walking every subnet of the VPC.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param event: An EventBridge CloudTrail event, see is_reconcile_event.
+    :param vpc_id: The ID of the VPC managed by natifylambda.
+    :param nat_instance_id: The ID of the NAT instance.
+    :return: A list of the IDs of the route tables whose default route was updated.
+    """
+    subnet_ids, route_table_ids = get_reconcile_targets(event)
+    updated = []
+    for subnet_id in subnet_ids:
+        updated.extend(reconcile_subnet(ec2_client, vpc_id, subnet_id, nat_instance_id))
+    for route_table_id in route_table_ids:
+        updated.extend(reconcile_route_table(ec2_client, vpc_id, route_table_id, nat_instance_id))
+    return updated
 
 def modify_security_group(ec2_client, nat_sg_id, vpc_id):
     """
@@ -135,6 +581,10 @@ def stop_nat_instance_source_dest_check(ec2_client, nat_instance_id):
 
 def handler(event, context):
     ec2_client = boto3.client('ec2')
+    # Draw mutating EC2 calls from the bucket shared by all concurrent invocations, if configured
+    bucket = bucket_from_environment(lambda: boto3.client('dynamodb'))
+    if bucket is not None:
+        ec2_client = RateLimitedClient(ec2_client, bucket)
     sfn_client = boto3.client('stepfunctions')
     events_client = boto3.client('events')  # Added for disabling the trigger
     vpc_id = os.environ.get('VPC_ID')
@@ -142,6 +592,8 @@ def handler(event, context):
     event_rule_name = os.environ.get('EVENT_RULE_NAME')
     nat_instance_id = os.environ.get('NAT_INSTANCE_ID')
     nat_sg_id = os.environ.get('NAT_SG_ID')
+    gateway_endpoint_services = get_gateway_endpoint_services()
+    region = os.environ.get('AWS_REGION')
     
     if not vpc_id or not nat_instance_id or not nat_sg_id:
         return {
@@ -149,22 +601,148 @@ def handler(event, context):
             'body': json.dumps('VPC ID, NAT instance ID, or NAT security group ID not found in environment variables')
         }
     
-    modify_route_tables(ec2_client, vpc_id, nat_instance_id)
-    modify_security_group(ec2_client, nat_sg_id, vpc_id)
-    disable_state_machine(sfn_client, state_machine_name, events_client, event_rule_name)
-    stop_nat_instance_source_dest_check(ec2_client, nat_instance_id)
+    # Explicit actions are sent by the restore operation and by the Distributed Map
+    # workflow of the state machine, see NatifyStack
+    action = event.get('action') if isinstance(event, dict) else None
+
+    # Keep overlapping full runs, from the schedule or from retries, from repeating the work
+    lock = lock_from_environment(lambda: boto3.client('dynamodb'))
+    lock_key = f"{vpc_id}#{nat_instance_id}"
+    # In DistributedMap mode, the lease spans the steps of one state machine execution
+    execution_id = event.get('execution_id') if isinstance(event, dict) else None
+
+    if action == 'list_route_tables':
+        lock_status = 'disabled'
+        if lock is not None:
+            lease_seconds = float(os.environ.get('DISTRIBUTED_MAP_TIMEOUT', DEFAULT_DISTRIBUTED_MAP_TIMEOUT))
+            lock_status, record = lock.acquire(lock_key, lease_seconds + LEASE_MARGIN, execution_id)
+            if lock_status != 'acquired':
+                # Another execution is updating the route tables or just did, skip the map
+                return {
+                    'statusCode': 202,
+                    'LockStatus': lock_status,
+                    'RouteTableIds': []
+                }
+        try:
+            route_table_ids = list_private_route_tables(ec2_client, vpc_id)
+            # Once for the whole list: concurrent batches would each create an endpoint
+            gateway_endpoints = ensure_gateway_endpoints(
+                ec2_client, vpc_id, route_table_ids, gateway_endpoint_services, region
+            )
+        except Exception:
+            if lock is not None:
+                lock.release(lock_key, execution_id)
+            raise
+        return {
+            'statusCode': 200,
+            'LockStatus': lock_status,
+            'RouteTableIds': route_table_ids,
+            'GatewayEndpoints': gateway_endpoints
+        }
+
+    if action == 'release_lock':
+        # The Distributed Map failed, let the next execution retry right away
+        if lock is not None:
+            lock.release(lock_key, execution_id)
+        return {'statusCode': 200}
+
+    if action == 'update_route_tables':
+        updated = update_route_tables(ec2_client, vpc_id, event.get('route_table_ids', []), nat_instance_id)
+        return {
+            'statusCode': 200,
+            'RouteTableIds': updated,
+            'Convergence': wait_for_convergence(ec2_client, updated, nat_instance_id, context)
+        }
+
+    if action == 'restore':
+        print(f"Restoring route tables of VPC {vpc_id} from the route journal")
+        restored = restore_route_tables(ec2_client, vpc_id)
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': 'Restore completed',
+                'details': {
+                    'route_tables': restored
+                }
+            })
+        }
+
+    if is_reconcile_event(event):
+        event_name = event['detail']['eventName']
+        print(f"Incremental reconciliation triggered by {event_name}")
+        updated = reconcile_from_event(ec2_client, event, vpc_id, nat_instance_id)
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': 'Reconciliation completed successfully',
+                'details': {
+                    'event_name': event_name,
+                    'route_tables': updated,
+                    'convergence': wait_for_convergence(ec2_client, updated, nat_instance_id, context),
+                    'gateway_endpoints': ensure_gateway_endpoints(
+                        ec2_client, vpc_id, updated, gateway_endpoint_services, region
+                    )
+                }
+            })
+        }
+
+    # The Distributed Map workflow has already updated the route tables in batches
+    # and only needs the remaining steps
+    def natify():
+        convergence = None
+        gateway_endpoints = None
+        if action != 'finalize':
+            updated = modify_route_tables(ec2_client, vpc_id, nat_instance_id)
+            convergence = wait_for_convergence(ec2_client, updated, nat_instance_id, context)
+            gateway_endpoints = ensure_gateway_endpoints(ec2_client, vpc_id, updated, gateway_endpoint_services, region)
+        modify_security_group(ec2_client, nat_sg_id, vpc_id)
+        disable_state_machine(sfn_client, state_machine_name, events_client, event_rule_name)
+        stop_nat_instance_source_dest_check(ec2_client, nat_instance_id)
     
-    print(f"NAT instance ID: {nat_instance_id} and security group ID: {nat_sg_id} used for operations")
+        print(f"NAT instance ID: {nat_instance_id} and security group ID: {nat_sg_id} used for operations")
     
-    return {
-        'statusCode': 200,
-        'body': json.dumps({
-            'message': 'Operations completed successfully',
-            'details': {
-                'route_tables': 'modified',
-                'security_group': 'updated',
-                'state_machine': 'disabled',
-                'source_dest_check': 'stopped'
-            }
-        })
-    }
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': 'Operations completed successfully',
+                'details': {
+                    'route_tables': 'modified',
+                    'convergence': convergence,
+                    'gateway_endpoints': gateway_endpoints,
+                    'security_group': 'updated',
+                    'state_machine': 'disabled',
+                    'source_dest_check': 'stopped'
+                }
+            })
+        }
+
+    if lock is None:
+        return natify()
+    if action == 'finalize':
+        # Completes the lease taken by list_route_tables
+        try:
+            result = natify()
+        except Exception:
+            lock.release(lock_key, execution_id)
+            raise
+        lock.complete(lock_key, execution_id, result)
+        return result
+    remaining = context.get_remaining_time_in_millis() / 1000 if context is not None else 900
+    status, result = lock.run(
+        lock_key,
+        natify,
+        lease_seconds=remaining + LEASE_MARGIN,
+        owner=getattr(context, 'aws_request_id', None)
+    )
+    if status == "in_progress":
+        return {
+            'statusCode': 202,
+            'body': json.dumps({
+                'message': 'Operations already in progress',
+                'details': {
+                    'owner': result.owner,
+                    'lease_expires_at': result.expires_at
+                }
+            })
+        }
+    return result
@@ -0,0 +1,189 @@
+"""Token bucket shared by concurrent natifylambda invocations.
+
+When natify runs against many VPCs of the same account at once, every
+invocation draws from the same bucket before each mutating EC2 call, so the
+aggregate request rate stays under the account's EC2 API limits instead of
+collapsing into throttling and retries.
+
+The bucket state lives in a DynamoDB table with a string partition key named
+BucketKey, updated with conditional writes on an integer Version attribute. LocalBucketStore is an in-memory
+stand-in with the same semantics, for tests and single-process use.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+# EC2 refills the mutating-actions bucket at 5 requests per second with a
+# burst of 200 by default; stay just under it to leave room for other callers
+DEFAULT_RATE = 4
+DEFAULT_CAPACITY = 100
+DEFAULT_BUCKET_KEY = 'ec2-mutating'
+# Shortest wait before reading the bucket again when it is empty
+MIN_WAIT = 0.005
+
+# EC2 client methods that count against the mutating-actions limit
+MUTATING_EC2_CALLS = frozenset({
+    'authorize_security_group_ingress',
+    'create_route',
+    'create_tags',
+    'create_vpc_endpoint',
+    'delete_route',
+    'delete_tags',
+    'modify_instance_attribute',
+    'modify_vpc_endpoint',
+    'replace_route',
+})
+
+BucketState = namedtuple('BucketState', ['tokens', 'updated_at', 'version'])
+
+
+class LocalBucketStore:
+    """In-memory bucket store, safe to share between threads."""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._states.get(key)
+
+    def put_if_absent(self, key, tokens, updated_at):
+        with self._lock:
+            if key in self._states:
+                return False
+            self._states[key] = BucketState(tokens, updated_at, 0)
+            return True
+
+    def compare_and_set(self, key, expected_version, tokens, updated_at):
+        with self._lock:
+            state = self._states.get(key)
+            if state is None or state.version != expected_version:
+                return False
+            self._states[key] = BucketState(tokens, updated_at, expected_version + 1)
+            return True
+
+
+class DynamoDBBucketStore:
+    """Bucket store backed by a DynamoDB table, shared by every invocation in the account."""
+
+    def __init__(self, dynamodb_client, table_name):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+
+    def get(self, key):
+        item = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={'BucketKey': {'S': key}},
+            ConsistentRead=True
+        ).get('Item')
+        if item is None:
+            return None
+        return BucketState(float(item['Tokens']['N']), float(item['UpdatedAt']['N']), int(item['Version']['N']))
+
+    def _conditional_put(self, key, tokens, updated_at, version, condition, values=None):
+        kwargs = {'ExpressionAttributeValues': values} if values else {}
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'BucketKey': {'S': key},
+                    'Tokens': {'N': repr(tokens)},
+                    'UpdatedAt': {'N': repr(updated_at)},
+                    'Version': {'N': str(version)}
+                },
+                ConditionExpression=condition,
+                **kwargs
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def put_if_absent(self, key, tokens, updated_at):
+        return self._conditional_put(key, tokens, updated_at, 0, 'attribute_not_exists(BucketKey)')
+
+    def compare_and_set(self, key, expected_version, tokens, updated_at):
+        return self._conditional_put(
+            key, tokens, updated_at, expected_version + 1, 'Version = :expected',
+            {':expected': {'N': str(expected_version)}}
+        )
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second up to `capacity`, whose state is
+    kept in a bucket store so that every process sharing the store shares the bucket.
+    """
+
+    def __init__(self, store, key=DEFAULT_BUCKET_KEY, rate=DEFAULT_RATE, capacity=DEFAULT_CAPACITY,
+                 clock=time.time, sleep=time.sleep):
+        self.store = store
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until `tokens` tokens could be taken from the bucket.
+        """
+        while True:
+            now = self.clock()
+            state = self.store.get(self.key)
+            if state is None:
+                if self.store.put_if_absent(self.key, self.capacity - tokens, now):
+                    return
+                continue
+            # Clocks of concurrent invocations may be slightly skewed
+            elapsed = max(0.0, now - state.updated_at)
+            available = min(self.capacity, state.tokens + elapsed * self.rate)
+            if available >= tokens:
+                updated_at = max(now, state.updated_at)
+                if self.store.compare_and_set(self.key, state.version, available - tokens, updated_at):
+                    return
+                # Another invocation took tokens in the meantime, read the bucket again
+                continue
+            self.sleep(max((tokens - available) / self.rate, MIN_WAIT))
+
+
+class RateLimitedClient:
+    """
+    Wraps a boto3 client so that every call in `limited_calls` first takes a token
+    from the bucket. Other attributes are passed through unchanged.
+    """
+
+    def __init__(self, client, bucket, limited_calls=MUTATING_EC2_CALLS):
+        self._client = client
+        self._bucket = bucket
+        self._limited_calls = limited_calls
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self._limited_calls:
+            return attr
+
+        def limited(*args, **kwargs):
+            self._bucket.acquire()
+            return attr(*args, **kwargs)
+        return limited
+
+
+def bucket_from_environment(dynamodb_client_factory):
+    """
+    Builds the shared bucket from the RATE_LIMIT_TABLE, RATE_LIMIT_PER_SECOND,
+    RATE_LIMIT_BURST and RATE_LIMIT_KEY environment variables.
+
+    :param dynamodb_client_factory: A callable returning a DynamoDB client.
+    :return: The TokenBucket, or None if RATE_LIMIT_TABLE is not set.
+    """
+    table_name = os.environ.get('RATE_LIMIT_TABLE')
+    if not table_name:
+        return None
+    return TokenBucket(
+        DynamoDBBucketStore(dynamodb_client_factory(), table_name),
+        key=os.environ.get('RATE_LIMIT_KEY', DEFAULT_BUCKET_KEY),
+        rate=float(os.environ.get('RATE_LIMIT_PER_SECOND', DEFAULT_RATE)),
+        capacity=float(os.environ.get('RATE_LIMIT_BURST', DEFAULT_CAPACITY))
+    )
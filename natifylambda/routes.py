@@ -0,0 +1,29 @@
+"""Reading route tables, shared by the natify and convergence modules."""
+
+# Maximum number of route table IDs per DescribeRouteTables call
+DESCRIBE_BATCH_SIZE = 100
+
+
+def get_default_route(rt):
+    """
+    Returns the default route (0.0.0.0/0) of a route table, or None if it has none.
+    """
+    return next(
+        (route for route in rt['Routes'] if route.get('DestinationCidrBlock') == '0.0.0.0/0'),
+        None
+    )
+
+
+def describe_route_tables_by_id(ec2_client, route_table_ids):
+    """
+    Reads the given route tables in batches of DESCRIBE_BATCH_SIZE.
+
+    :param ec2_client: The EC2 client to use for making AWS requests.
+    :param route_table_ids: The IDs of the route tables to read.
+    :return: A list of route tables as returned by describe_route_tables.
+    """
+    route_tables = []
+    for i in range(0, len(route_table_ids), DESCRIBE_BATCH_SIZE):
+        batch = route_table_ids[i:i + DESCRIBE_BATCH_SIZE]
+        route_tables.extend(ec2_client.describe_route_tables(RouteTableIds=batch)['RouteTables'])
+    return route_tables
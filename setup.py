@@ -33,6 +33,8 @@ install_requires_win_only = [
 extras_require = {
     "dev": dev_require,
     "test": tests_require,
+    # Offline flow log analyzer, natifylambda.flowlogs
+    "flowlogs": ["numpy"],
     # https://wheel.readthedocs.io/en/latest/#defining-conditional-dependencies
     ':sys_platform == "win32"': install_requires_win_only,
 }
@@ -57,6 +59,11 @@ setup(
     python_requires=">=3.10",
     extras_require=extras_require,
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': [
+            f'{PROJECT_NAME} = {PROJECT_NAME}.cli:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
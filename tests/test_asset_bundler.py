@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""Tests for the reproducible Lambda asset bundler."""
+
+import sys
+import zipfile
+
+import pytest
+
+from cdk import asset_bundler
+
+
+@pytest.fixture
+def lambda_interpreter(monkeypatch):
+    """Pretends the running interpreter matches the Lambda runtime."""
+    monkeypatch.setattr(asset_bundler, 'LAMBDA_PYTHON_VERSION', sys.version_info[:2])
+    monkeypatch.setattr(asset_bundler, 'LAMBDA_CACHE_TAG', sys.implementation.cache_tag)
+
+
+@pytest.fixture
+def other_interpreter(monkeypatch):
+    monkeypatch.setattr(asset_bundler, 'LAMBDA_PYTHON_VERSION', (2, 7))
+
+
+def make_package(tmp_path):
+    source_dir = tmp_path / 'natifylambda'
+    source_dir.mkdir()
+    (source_dir / '__init__.py').write_text("__version__ = '0.0.0'\n")
+    (source_dir / 'natifylambda.py').write_text("def handler(event, context):\n    return event\n")
+    (source_dir / '__pycache__').mkdir()
+    (source_dir / '__pycache__' / 'stale.cpython-312.pyc').write_bytes(b'stale')
+    return source_dir
+
+
+def test_bundle_is_deterministic(tmp_path, lambda_interpreter):
+    source_dir = make_package(tmp_path)
+    first = asset_bundler.bundle(source_dir, tmp_path / 'cache-a')
+    # Touching the files changes their mtime but must not change the bundle
+    for path in source_dir.glob('*.py'):
+        path.write_text(path.read_text())
+    second = asset_bundler.bundle(source_dir, tmp_path / 'cache-b')
+
+    with open(first, 'rb') as a, open(second, 'rb') as b:
+        assert a.read() == b.read()
+    with zipfile.ZipFile(first) as zf:
+        names = zf.namelist()
+        assert names == sorted(names)
+        assert 'natifylambda/natifylambda.py' in names
+        assert any(name.startswith('natifylambda/__pycache__/natifylambda.') for name in names)
+        assert not any('stale' in name for name in names)
+        assert {info.date_time for info in zf.infolist()} == {asset_bundler.FIXED_DATE_TIME}
+
+
+def test_bundle_reuses_cache_until_content_changes(tmp_path):
+    source_dir = make_package(tmp_path)
+    cache_dir = tmp_path / 'cache'
+    first = asset_bundler.bundle(source_dir, cache_dir)
+    assert asset_bundler.bundle(source_dir, cache_dir) == first
+
+    (source_dir / 'natifylambda.py').write_text("def handler(event, context):\n    return None\n")
+    assert asset_bundler.bundle(source_dir, cache_dir) != first
+
+
+def test_other_interpreters_bundle_sources_only(tmp_path, other_interpreter):
+    source_dir = make_package(tmp_path)
+    zip_path = asset_bundler.bundle(source_dir, tmp_path / 'cache')
+
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.namelist() == ['natifylambda/__init__.py', 'natifylambda/natifylambda.py']
+    # The hash does not depend on which non-runtime interpreter built the bundle
+    files = asset_bundler.list_source_files(source_dir)
+    digest = asset_bundler.content_hash(source_dir, files)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(asset_bundler.sys, 'implementation', type('impl', (), {'cache_tag': 'cpython-399'}))
+        assert asset_bundler.content_hash(source_dir, files) == digest
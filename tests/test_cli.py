@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""Tests for the `natifylambda` command line interface."""
+
+from natifylambda import cli
+
+from tests.test_natifylambda import FakeEc2Client, make_route_table, make_subnet
+
+
+def make_ec2():
+    return FakeEc2Client(
+        subnets=[make_subnet('subnet-1', 'Private-1A'), make_subnet('subnet-2', 'Private-1B')],
+        route_tables=[
+            make_route_table('rtb-1', ['subnet-1'], default_route=True),
+            make_route_table('rtb-2', ['subnet-2']),
+        ],
+    )
+
+
+def mutating_calls(ec2):
+    return [call for call in ec2.calls if call[0] in ('create_route', 'replace_route', 'create_tags')]
+
+
+def test_plan_does_not_change_routes(capsys):
+    ec2 = make_ec2()
+    args = cli.parse_args(['--vpc-id', 'vpc-1', '--nat-instance-id', 'i-nat', '--plan'])
+
+    actions = cli.reconcile(ec2, args)
+
+    assert actions == {'rtb-1': 'modified', 'rtb-2': 'added'}
+    assert mutating_calls(ec2) == []
+    assert 'Plan: rtb-1 (Unnamed) NatGatewayId=nat-1 -> modified' in capsys.readouterr().out
+
+
+def test_watch_only_updates_drifted_route_tables(capsys):
+    ec2 = make_ec2()
+    ec2.modify_instance_attribute = lambda **kwargs: None
+    cli.reconcile(ec2, cli.parse_args(['--vpc-id', 'vpc-1', '--nat-instance-id', 'i-nat', '--parallelism', '2']))
+    ec2.calls.clear()
+
+    cli.watch(ec2, cli.parse_args([
+        '--vpc-id', 'vpc-1', '--nat-instance-id', 'i-nat', '--watch',
+        '--interval', '0', '--iterations', '2', '--refresh', '5',
+    ]))
+
+    assert mutating_calls(ec2) == []
+    # The topology is listed once and then served from the cache
+    assert sum(1 for call in ec2.calls if call[0] == 'describe_subnets') == 1
+    assert '2 route tables, 0 drifted (topology' in capsys.readouterr().out
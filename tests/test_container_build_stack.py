@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""Assertion tests for the `ContainerBuildStack` template."""
+
+import json
+
+import pytest
+from aws_cdk import App
+from aws_cdk.assertions import Match, Template
+
+from cdk.container_build_stack import ContainerBuildStack
+
+
+@pytest.fixture(scope='module')
+def template():
+    app = App()
+    return Template.from_stack(ContainerBuildStack(app, "ContainerBuildStack"))
+
+
+def build_specs(template):
+    projects = template.find_resources('AWS::CodeBuild::Project')
+    return {
+        props['Properties']['Name']: json.loads(props['Properties']['Source']['BuildSpec'])
+        for props in projects.values()
+    }
+
+
+def test_builds_each_architecture_natively_with_local_cache(template):
+    template.resource_count_is('AWS::CodeBuild::Project', 3)
+    template.has_resource_properties('AWS::CodeBuild::Project', {
+        'Name': 'NatifyLambdaBuild-arm64',
+        'Environment': Match.object_like({'Type': 'ARM_CONTAINER', 'PrivilegedMode': True}),
+        'Cache': {'Type': 'LOCAL', 'Modes': ['LOCAL_CUSTOM_CACHE']},
+    })
+    template.has_resource_properties('AWS::CodeBuild::Project', {
+        'Name': 'NatifyLambdaBuild-amd64',
+        'Environment': Match.object_like({'Type': 'LINUX_CONTAINER', 'PrivilegedMode': True}),
+        'Cache': {'Type': 'LOCAL', 'Modes': ['LOCAL_CUSTOM_CACHE']},
+    })
+
+
+def test_build_uses_registry_cache_and_commit_sha_tags(template):
+    specs = build_specs(template)
+    for arch in ('amd64', 'arm64'):
+        commands = ' '.join(specs[f'NatifyLambdaBuild-{arch}']['phases']['build']['commands'])
+        assert f'--cache-from type=registry,ref=$REPOSITORY_URI:buildcache-{arch}' in commands
+        assert f'--cache-to type=registry,ref=$REPOSITORY_URI:buildcache-{arch}' in commands
+        assert f'$REPOSITORY_URI:$COMMIT_SHA-{arch}' in commands
+        # The BuildKit cache is persisted by the CodeBuild custom cache
+        cache_dir = ContainerBuildStack.LOCAL_BUILDKIT_CACHE_DIR
+        assert f'--cache-from type=local,src={cache_dir}' in commands
+        assert specs[f'NatifyLambdaBuild-{arch}']['cache']['paths'] == [f'{cache_dir}/**/*']
+        # The new export replaces the contents of the cached path, which is a symlink
+        assert f'rm -rf {cache_dir}/*' in commands
+        assert f'mv {cache_dir}-new/* {cache_dir}/' in commands
+        assert f'rm -rf {cache_dir} ' not in commands
+    manifest = ' '.join(specs['NatifyLambdaManifest']['phases']['build']['commands'])
+    assert '--tag $REPOSITORY_URI:$COMMIT_SHA' in manifest
+
+
+def test_does_not_use_deprecated_ecr_login(template):
+    for spec in build_specs(template).values():
+        pre_build = ' '.join(spec['phases']['pre_build']['commands'])
+        assert 'get-login-password' in pre_build
+        assert 'get-login ' not in pre_build
+
+
+def test_pipeline_passes_commit_sha_to_builds(template):
+    template.has_resource_properties('AWS::CodePipeline::Pipeline', {
+        'Stages': Match.array_with([
+            Match.object_like({
+                'Name': 'Build',
+                'Actions': Match.array_with([
+                    Match.object_like({
+                        'Configuration': Match.object_like({
+                            'EnvironmentVariables': Match.string_like_regexp('#{Source.CommitId}'),
+                        }),
+                    }),
+                ]),
+            }),
+        ]),
+    })
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""Tests for the route convergence waiter."""
+
+from natifylambda import convergence
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class EventuallyConsistentEc2Client:
+    """Returns the NAT route of each route table only after a number of reads."""
+
+    def __init__(self, reads_until_visible):
+        self.reads_until_visible = reads_until_visible
+        self.reads = dict.fromkeys(reads_until_visible, 0)
+        self.batches = []
+
+    def describe_route_tables(self, RouteTableIds):
+        self.batches.append(list(RouteTableIds))
+        route_tables = []
+        for route_table_id in RouteTableIds:
+            self.reads[route_table_id] += 1
+            target = {'InstanceId': 'i-nat', 'State': 'active'}
+            if self.reads[route_table_id] < self.reads_until_visible[route_table_id]:
+                target = {'NatGatewayId': 'nat-1', 'State': 'active'}
+            route_tables.append({
+                'RouteTableId': route_table_id,
+                'Routes': [dict(DestinationCidrBlock='0.0.0.0/0', **target)],
+            })
+        return {'RouteTables': route_tables}
+
+
+def test_waits_with_backoff_and_reports_time_per_route_table():
+    clock = FakeClock()
+    ec2 = EventuallyConsistentEc2Client({'rtb-1': 1, 'rtb-2': 3})
+
+    converged = convergence.wait_for_route_convergence(
+        ec2, ['rtb-1', 'rtb-2'], 'i-nat', timeout=10, clock=clock, sleep=clock.sleep
+    )
+
+    assert converged['rtb-1'] == 0
+    assert converged['rtb-2'] > 0
+    # Converged route tables are not read again
+    assert ec2.batches == [['rtb-1', 'rtb-2'], ['rtb-2'], ['rtb-2']]
+
+
+def test_gives_up_at_timeout():
+    clock = FakeClock()
+    ec2 = EventuallyConsistentEc2Client({'rtb-1': 1000})
+
+    converged = convergence.wait_for_route_convergence(
+        ec2, ['rtb-1'], 'i-nat', timeout=5, clock=clock, sleep=clock.sleep
+    )
+
+    assert converged == {'rtb-1': None}
+    assert clock.now == 5
+
+
+def test_probe_reachability_analyses_the_path_and_cleans_up():
+    import boto3
+    from botocore.stub import Stubber
+
+    client = boto3.client(
+        'ec2', region_name='us-west-2',
+        aws_access_key_id='testing', aws_secret_access_key='testing'
+    )
+    clock = FakeClock()
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            'create_network_insights_path',
+            {'NetworkInsightsPath': {'NetworkInsightsPathId': 'nip-1'}},
+            {'Source': 'eni-probe', 'Destination': 'i-nat', 'Protocol': 'tcp'}
+        )
+        stubber.add_response(
+            'start_network_insights_analysis',
+            {'NetworkInsightsAnalysis': {'NetworkInsightsAnalysisId': 'nia-1'}},
+            {'NetworkInsightsPathId': 'nip-1'}
+        )
+        for status in ('running', 'succeeded'):
+            stubber.add_response(
+                'describe_network_insights_analyses',
+                {'NetworkInsightsAnalyses': [{'Status': status, 'NetworkPathFound': status == 'succeeded'}]},
+                {'NetworkInsightsAnalysisIds': ['nia-1']}
+            )
+        stubber.add_response(
+            'delete_network_insights_analysis', {}, {'NetworkInsightsAnalysisId': 'nia-1'}
+        )
+        stubber.add_response(
+            'delete_network_insights_path', {}, {'NetworkInsightsPathId': 'nip-1'}
+        )
+
+        reachable, seconds = convergence.probe_reachability(
+            client, 'eni-probe', 'i-nat', clock=clock, sleep=clock.sleep
+        )
+
+        stubber.assert_no_pending_responses()
+    assert reachable is True
+    assert 0 < seconds <= 1
+
+
+def test_probe_targets_the_nat_instance(monkeypatch):
+    probes = []
+    monkeypatch.setenv('PROBE_ENI_ID', 'eni-probe')
+    monkeypatch.setattr(
+        convergence, 'probe_reachability',
+        lambda ec2_client, source, destination, timeout: probes.append((source, destination)) or (False, 1.0)
+    )
+    ec2 = EventuallyConsistentEc2Client({'rtb-1': 1})
+
+    result = convergence.wait_for_convergence(ec2, ['rtb-1'], 'i-nat')
+
+    assert probes == [('eni-probe', 'i-nat')]
+    assert result['reachability'] == {'reachable': False, 'seconds': 1.0}
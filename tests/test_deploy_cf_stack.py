@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""Tests for the change detection of `utils/deploy_cf_stack.py`."""
+
+import json
+import subprocess
+
+import pytest
+
+from utils import deploy_cf_stack
+
+TEMPLATE = """Parameters:
+  VpcName:
+    Type: String
+  NatInstanceType:
+    Type: String
+    Default: t4g.nano
+Resources: {}
+"""
+
+
+class FakeAwsCli:
+    """Answers the AWS CLI commands of deploy_stack for one deployed stack."""
+
+    def __init__(self, deployed_template, deployed_parameters, status="UPDATE_COMPLETE"):
+        self.deployed_template = deployed_template
+        self.deployed_parameters = deployed_parameters
+        self.status = status
+        self.commands = []
+
+    def __call__(self, command, **kwargs):
+        self.commands.append(command[2])
+        if command[2] == "describe-stacks" and "--query" in command:
+            return subprocess.CompletedProcess(command, 0, stdout="UPDATE_COMPLETE\n")
+        if command[2] == "describe-stacks":
+            stack = {
+                "StackName": command[4],
+                "StackStatus": self.status,
+                "Parameters": [{"ParameterKey": k, "ParameterValue": v} for k, v in self.deployed_parameters.items()],
+            }
+            return subprocess.CompletedProcess(command, 0, stdout=json.dumps({"Stacks": [stack]}))
+        if command[2] == "get-template":
+            assert command[command.index("--template-stage") + 1] == "Original"
+            return subprocess.CompletedProcess(command, 0, stdout=json.dumps({"TemplateBody": self.deployed_template}))
+        if command[2] == "get-template-summary":
+            summary = {"Parameters": [
+                {"ParameterKey": "VpcName"},
+                {"ParameterKey": "NatInstanceType", "DefaultValue": "t4g.nano"},
+            ]}
+            return subprocess.CompletedProcess(command, 0, stdout=json.dumps(summary))
+        return subprocess.CompletedProcess(command, 0, stdout="{}")
+
+
+@pytest.fixture
+def template_file(tmp_path):
+    path = tmp_path / "1_NatifyStack.yaml"
+    path.write_text(TEMPLATE)
+    return str(path)
+
+
+def deploy(monkeypatch, cli, template_file, parameters, **kwargs):
+    monkeypatch.setattr(deploy_cf_stack.subprocess, "run", cli)
+    return deploy_cf_stack.deploy_stack("NatifyStack", template_file, None, parameters=parameters, **kwargs)
+
+
+def test_unchanged_stack_is_skipped(monkeypatch, template_file):
+    # Trailing whitespace and line endings are not part of the comparison
+    cli = FakeAwsCli(TEMPLATE.replace("\n", " \r\n"), {"VpcName": "Production-VPC", "NatInstanceType": "t4g.nano"})
+
+    assert deploy(monkeypatch, cli, template_file, [{"ParameterKey": "VpcName", "ParameterValue": "Production-VPC"}])
+    assert cli.commands == ["describe-stacks", "get-template", "get-template-summary"]
+
+
+@pytest.mark.parametrize("deployed_template, deployed_parameters, kwargs", [
+    # Changed template
+    (TEMPLATE.replace("t4g.nano", "t4g.micro"), {"VpcName": "Production-VPC", "NatInstanceType": "t4g.nano"}, {}),
+    # Changed parameter value
+    (TEMPLATE, {"VpcName": "Staging-VPC", "NatInstanceType": "t4g.nano"}, {}),
+    # A previous override that is now left to the default
+    (TEMPLATE, {"VpcName": "Production-VPC", "NatInstanceType": "t4g.small"}, {}),
+    # NoEcho parameters cannot be compared
+    (TEMPLATE, {"VpcName": "****", "NatInstanceType": "t4g.nano"}, {}),
+    (TEMPLATE, {"VpcName": "Production-VPC", "NatInstanceType": "t4g.nano"}, {"force": True}),
+])
+def test_changed_stack_is_deployed(monkeypatch, template_file, deployed_template, deployed_parameters, kwargs):
+    cli = FakeAwsCli(deployed_template, deployed_parameters)
+
+    assert deploy(monkeypatch, cli, template_file, [{"ParameterKey": "VpcName", "ParameterValue": "Production-VPC"}], **kwargs)
+    assert "update-stack" in cli.commands
+
+
+def test_json_templates_are_compared_parsed():
+    template = {"Resources": {"B": {"Type": "AWS::S3::Bucket"}, "A": {"Type": "AWS::SNS::Topic"}}}
+
+    assert deploy_cf_stack.template_hash(json.dumps(template, indent=2)) == deploy_cf_stack.template_hash(template)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""Assertion tests for the `DownloaderLambdaStack` template."""
+
+import pytest
+from aws_cdk import App
+from aws_cdk.assertions import Template
+
+from cdk.downloader_lambda_stack import DownloaderLambdaStack
+from natifylambda import __version__ as natifylambda_version
+
+
+@pytest.fixture(scope='module')
+def template():
+    app = App()
+    return Template.from_stack(DownloaderLambdaStack(app, "DownloaderLambdaStack"))
+
+
+def test_downloads_once_per_version_through_a_custom_resource(template):
+    template.resource_count_is('Custom::NatifyLambdaArtifact', 1)
+    template.has_resource_properties('Custom::NatifyLambdaArtifact', {'Version': natifylambda_version})
+
+
+def test_service_token_does_not_change_with_the_version(template):
+    (function_id,) = template.find_resources('AWS::Lambda::Function').keys()
+    template.has_resource_properties('AWS::Lambda::Function', {'FunctionName': 'downloader_lambda'})
+    template.has_resource_properties('Custom::NatifyLambdaArtifact', {
+        'ServiceToken': {'Fn::GetAtt': [function_id, 'Arn']},
+    })
+
+
+def test_has_no_schedule_or_deployment_padding(template):
+    template.resource_count_is('AWS::Events::Rule', 0)
+    template.resource_count_is('AWS::StepFunctions::StateMachine', 0)
+    template.resource_count_is('AWS::S3::Bucket', 0)
+
+
+def test_inline_code_fits_cloudformation_limit(template):
+    functions = template.find_resources('AWS::Lambda::Function')
+    (function,) = functions.values()
+    code = function['Properties']['Code']['ZipFile']
+    assert 'cfnresponse.send' in code
+    assert len(code) <= 4096
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""Tests for the VPC Flow Log analyzer."""
+
+import gzip
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from natifylambda import flowlogs  # noqa: E402
+
+IP_RANGES = {
+    'prefixes': [
+        {'ip_prefix': '52.92.128.0/17', 'region': 'us-west-2', 'service': 'S3'},
+        {'ip_prefix': '52.92.160.0/24', 'region': 'us-west-2', 'service': 'S3'},
+        {'ip_prefix': '52.94.8.0/24', 'region': 'us-west-2', 'service': 'DYNAMODB'},
+        {'ip_prefix': '52.95.0.0/16', 'region': 'us-east-1', 'service': 'S3'},
+        {'ip_prefix': '3.5.0.0/16', 'region': 'us-west-2', 'service': 'AMAZON'},
+    ]
+}
+NAT_ENI = 'eni-nat'
+
+
+def record(src, dst, packets, size, start, end=None, eni=NAT_ENI, status='OK'):
+    end = start + 59 if end is None else end
+    return f"2 123456789012 {eni} {src} {dst} 44321 443 6 {packets} {size} {start} {end} ACCEPT {status}\n"
+
+
+def write_logs(path, records, header=False, compress=False):
+    text = ''.join(records)
+    if header:
+        text = ' '.join(flowlogs.DEFAULT_FIELDS) + '\n' + text
+    if compress:
+        with gzip.open(path, 'wt') as f:
+            f.write(text)
+    else:
+        path.write_text(text)
+    return str(path)
+
+
+def test_read_chunks_handles_header_gzip_and_empty_records(tmp_path):
+    records = [record('10.0.1.5', '52.92.130.1', 10, 1000, 60 * i) for i in range(5)]
+    records.insert(2, "2 123456789012 eni-nat - - - - - - - 120 179 - NODATA\n")
+    records.insert(3, "garbage\n")
+    plain = write_logs(tmp_path / 'plain.log', records)
+    compressed = write_logs(tmp_path / 'header.log.gz', records, header=True, compress=True)
+
+    for path in (plain, compressed):
+        chunks = list(flowlogs.read_chunks(path, chunk_size=2))
+        assert all(fields == flowlogs.DEFAULT_FIELDS for fields, _ in chunks)
+        assert sum(len(records) for _, records in chunks) == 5
+
+
+def test_analyzer_report(tmp_path):
+    records = [
+        # Two minutes of traffic from two instances, one of them to S3
+        record('10.0.1.5', '52.92.130.1', 600, 6000000, 0),
+        record('10.0.1.6', '93.184.216.34', 60, 60000, 0),
+        record('10.0.1.5', '52.94.8.10', 120, 120000, 60),
+        # A download coming back from S3
+        record('52.92.160.7', '10.0.1.6', 300, 3000000, 60),
+        # Same-service prefix in another region and a non gateway service
+        record('10.0.1.6', '52.95.1.1', 6, 600, 60),
+        record('10.0.1.6', '3.5.1.1', 6, 600, 60),
+        # Traffic of another interface is ignored
+        record('10.0.2.9', '52.92.130.1', 6000, 600000000, 0, eni='eni-other'),
+    ]
+    path = write_logs(tmp_path / 'flows.log', records)
+    analyzer = flowlogs.FlowLogAnalyzer(NAT_ENI, flowlogs.load_endpoint_prefixes(IP_RANGES, 'us-west-2'))
+    analyzer.add_file(path, chunk_size=3)
+
+    report = analyzer.report(top=2)
+
+    assert report['records'] == 6
+    assert report['top_talkers'] == [('10.0.1.5', 6120000), ('52.92.160.7', 3000000)]
+    assert report['top_destinations'][0] == ('52.92.130.1', 6000000)
+    assert report['gateway_endpoint_bytes'] == {'dynamodb': 120000, 's3': 9000000}
+    assert report['peak_bps'] == pytest.approx(6060000 * 8 / 60, abs=0.1)
+    assert report['peak_pps'] == pytest.approx(11.0)
+    assert report['peak_concurrent_flows'] == 4
+    # 0.8 Mbps with headroom still fits the nano baseline
+    assert report['recommended_instance_type'] == 't4g.nano'
+
+
+def test_long_records_are_spread_over_their_duration(tmp_path):
+    # A 10-minute aggregation interval: 60 MB in 600 seconds is 0.8 Mbps, not 8 Mbps
+    path = write_logs(tmp_path / 'flows.log', [record('10.0.1.5', '1.1.1.1', 6000, 60000000, 0, end=600)])
+    analyzer = flowlogs.FlowLogAnalyzer(NAT_ENI)
+    analyzer.add_file(path)
+
+    report = analyzer.report()
+
+    assert report['bytes'] == 60000000
+    assert report['peak_bps'] == pytest.approx(800000.0, abs=0.1)
+    assert report['peak_pps'] == pytest.approx(10.0)
+    assert sum(analyzer.bytes_per_minute.values()) == pytest.approx(60000000)
+
+
+def test_spread_over_minutes_splits_partial_minutes():
+    records, minutes, shares = flowlogs.spread_over_minutes(np.array([30, 120]), np.array([150, 120]))
+
+    assert records.tolist() == [0, 0, 0, 1]
+    assert minutes.tolist() == [0, 1, 2, 2]
+    assert shares.tolist() == pytest.approx([0.25, 0.5, 0.25, 1.0])
+
+
+def test_top_counter_stays_bounded():
+    counter = flowlogs.TopCounter(capacity=10)
+    for chunk in range(10):
+        keys = np.array([f'10.0.{chunk}.{i}' for i in range(15)])
+        counter.add(keys, np.arange(15))
+        assert len(counter.totals) <= 20
+    heavy = np.array(['10.9.9.9'])
+    counter.add(heavy, np.array([1000]))
+
+    assert counter.top(1) == [('10.9.9.9', 1000)]
+
+
+@pytest.mark.parametrize('peak_bps, peak_flows, expected', [
+    (10e6, 1000, 't4g.nano'),
+    (80e6, 1000, 't4g.small'),
+    (10e6, 60000, 't4g.small'),
+    (10e9, 1000, 't4g.2xlarge'),
+])
+def test_recommend_instance_type(peak_bps, peak_flows, expected):
+    assert flowlogs.recommend_instance_type(peak_bps, peak_flows) == expected
+
+
+def test_main_prints_report(tmp_path, capsys):
+    path = write_logs(tmp_path / 'flows.log.gz', [record('10.0.1.5', '1.1.1.1', 60, 6000, 0)], compress=True)
+
+    assert flowlogs.main([path, '--eni', NAT_ENI]) == 0
+    assert 'Recommended NatInstanceType: t4g.nano' in capsys.readouterr().out
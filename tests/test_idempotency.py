@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""Tests for the lease-based idempotency lock."""
+
+import threading
+
+import pytest
+
+from natifylambda import idempotency
+
+KEY = 'vpc-1#i-nat'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_duplicate_invocation_sees_in_progress_then_cached_result():
+    clock = FakeClock()
+    lock = idempotency.IdempotencyLock(idempotency.LocalLockStore(), result_ttl=60, clock=clock)
+    duplicates = []
+
+    def natify():
+        duplicates.append(lock.run(KEY, lambda: pytest.fail("ran twice"), lease_seconds=150, owner='second'))
+        return {'statusCode': 200}
+
+    status, result = lock.run(KEY, natify, lease_seconds=150, owner='first')
+
+    assert (status, result) == ('executed', {'statusCode': 200})
+    in_progress, record = duplicates[0]
+    assert in_progress == 'in_progress'
+    assert (record.owner, record.expires_at) == ('first', 1150)
+    assert lock.run(KEY, lambda: pytest.fail("ran twice"), lease_seconds=150) == ('cached', {'statusCode': 200})
+
+    # Once the cached result expires, the next invocation runs again
+    clock.now += 61
+    assert lock.run(KEY, lambda: 'again', lease_seconds=150) == ('executed', 'again')
+
+
+def test_expired_lease_of_a_crashed_invocation_is_taken_over():
+    clock = FakeClock()
+    store = idempotency.LocalLockStore()
+    lock = idempotency.IdempotencyLock(store, clock=clock)
+    assert store.acquire(KEY, 'crashed', 1150, 1000)
+
+    assert lock.run(KEY, lambda: 'late', lease_seconds=150)[0] == 'in_progress'
+    clock.now = 1151
+    assert lock.run(KEY, lambda: 'late', lease_seconds=150) == ('executed', 'late')
+    # The crashed invocation can no longer overwrite the result
+    assert not store.complete(KEY, 'crashed', 2000, 'stale')
+
+
+def test_failed_run_releases_the_lease():
+    lock = idempotency.IdempotencyLock(idempotency.LocalLockStore(), clock=FakeClock())
+
+    def fail():
+        raise RuntimeError("throttled")
+
+    with pytest.raises(RuntimeError):
+        lock.run(KEY, fail, lease_seconds=150)
+    assert lock.run(KEY, lambda: 'retried', lease_seconds=150) == ('executed', 'retried')
+
+
+def test_concurrent_invocations_run_once():
+    lock = idempotency.IdempotencyLock(idempotency.LocalLockStore())
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def natify():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return 'done'
+
+    first = threading.Thread(target=lock.run, args=(KEY, natify, 150))
+    first.start()
+    started.wait(5)
+    statuses = [lock.run(KEY, natify, 150)[0] for _ in range(5)]
+    release.set()
+    first.join()
+
+    assert runs == [1]
+    assert statuses == ['in_progress'] * 5
+
+
+@pytest.fixture
+def dynamodb():
+    import boto3
+    from botocore.stub import Stubber
+
+    client = boto3.client(
+        'dynamodb', region_name='us-west-2',
+        aws_access_key_id='testing', aws_secret_access_key='testing'
+    )
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def expected_item(status, owner, expires_at, result=None):
+    item = {
+        'LockKey': {'S': KEY},
+        'LockStatus': {'S': status},
+        'LockOwner': {'S': owner},
+        'ExpiresAt': {'N': str(expires_at)},
+    }
+    if result is not None:
+        item['Result'] = {'S': result}
+    return item
+
+
+def test_dynamodb_store_conditional_writes(dynamodb):
+    client, stubber = dynamodb
+    store = idempotency.DynamoDBLockStore(client, 'natify-idempotency')
+    stubber.add_response('put_item', {}, {
+        'TableName': 'natify-idempotency',
+        'Item': expected_item('in_progress', 'req-1', 1150),
+        'ConditionExpression': 'attribute_not_exists(LockKey) OR ExpiresAt < :now',
+        'ExpressionAttributeValues': {':now': {'N': '1000'}},
+    })
+    stubber.add_response('put_item', {}, {
+        'TableName': 'natify-idempotency',
+        'Item': expected_item('completed', 'req-1', 1060, '{"statusCode": 200}'),
+        'ConditionExpression': 'LockOwner = :owner',
+        'ExpressionAttributeValues': {':owner': {'S': 'req-1'}},
+    })
+    stubber.add_client_error('delete_item', service_error_code='ConditionalCheckFailedException', expected_params={
+        'TableName': 'natify-idempotency',
+        'Key': {'LockKey': {'S': KEY}},
+        'ConditionExpression': 'LockOwner = :owner',
+        'ExpressionAttributeValues': {':owner': {'S': 'req-1'}},
+    })
+
+    assert store.acquire(KEY, 'req-1', 1150, 1000)
+    assert store.complete(KEY, 'req-1', 1060, {'statusCode': 200})
+    assert not store.release(KEY, 'req-1')
+
+
+def test_dynamodb_store_reads_cached_result(dynamodb):
+    client, stubber = dynamodb
+    store = idempotency.DynamoDBLockStore(client, 'natify-idempotency')
+    stubber.add_response(
+        'get_item',
+        {'Item': expected_item('completed', 'req-1', 1060, '{"statusCode": 200}')},
+        {'TableName': 'natify-idempotency', 'Key': {'LockKey': {'S': KEY}}, 'ConsistentRead': True},
+    )
+
+    assert store.get(KEY) == idempotency.LockRecord('completed', 'req-1', 1060, {'statusCode': 200})
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""Tests for the NAT instance forwarding metrics agent."""
+
+import subprocess
+from pathlib import Path
+
+from natifylambda import nat_agent
+
+FIXTURES = Path(__file__).parent / 'fixtures' / 'nat_agent'
+PROC = FIXTURES / 'proc'
+
+
+def ethtool(args, **kwargs):
+    assert args == ['ethtool', '-S', 'ens5']
+    return subprocess.CompletedProcess(args, 0, stdout=(FIXTURES / 'ethtool_ens5.txt').read_text())
+
+
+def test_parse_proc_fixtures():
+    assert nat_agent.parse_default_interface((PROC / 'net/route').read_text()) == 'ens5'
+    assert nat_agent.parse_net_dev((PROC / 'net/dev').read_text())['ens5'] == {
+        'rx_packets': 8123456, 'rx_drop': 37, 'tx_packets': 7987654, 'tx_drop': 4,
+    }
+    assert nat_agent.parse_softnet_stat((PROC / 'net/softnet_stat').read_text()) == [
+        {'processed': 0x79a0bf, 'dropped': 3, 'time_squeeze': 0x1c},
+        {'processed': 0x65d411, 'dropped': 0, 'time_squeeze': 9},
+    ]
+    assert nat_agent.parse_softirqs((PROC / 'softirqs').read_text()) == [4021337, 3876120]
+    assert nat_agent.parse_ethtool_stats((FIXTURES / 'ethtool_ens5.txt').read_text()) == {
+        'bw_in_allowance_exceeded': 12,
+        'bw_out_allowance_exceeded': 0,
+        'pps_allowance_exceeded': 3,
+        'conntrack_allowance_exceeded': 0,
+        'linklocal_allowance_exceeded': 0,
+    }
+
+
+def test_read_sample():
+    gauges, counters = nat_agent.read_sample('ens5', proc=PROC, run=ethtool)
+
+    assert gauges == {
+        ('ConntrackCount', None): 12873,
+        ('ConntrackMax', None): 65536,
+        ('ConntrackUsedPercent', None): 19.64,
+    }
+    assert counters[('RxDropped', None)] == 37
+    assert counters[('SoftnetDropped', '0')] == 3
+    assert counters[('NetRxSoftirqs', '1')] == 3876120
+    assert counters[('PpsAllowanceExceeded', None)] == 3
+
+
+def test_read_sample_without_ethtool():
+    def missing(args, **kwargs):
+        raise FileNotFoundError('ethtool')
+
+    _, counters = nat_agent.read_sample('ens5', proc=PROC, run=missing)
+
+    assert ('PpsAllowanceExceeded', None) not in counters
+    assert counters[('TxDropped', None)] == 4
+
+
+def test_counter_deltas_skip_resets_and_new_counters():
+    previous = {('RxDropped', None): 37, ('PpsAllowanceExceeded', None): 3}
+    current = {('RxDropped', None): 40, ('PpsAllowanceExceeded', None): 0, ('NetRxSoftirqs', '0'): 5}
+
+    assert nat_agent.counter_deltas(previous, current) == {('RxDropped', None): 3}
+
+
+class RecordingCloudWatch:
+    def __init__(self):
+        self.calls = []
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.calls.append((Namespace, MetricData))
+
+
+def test_run_publishes_high_resolution_deltas_in_batches(monkeypatch):
+    monkeypatch.setattr(nat_agent, 'MAX_METRICS_PER_CALL', 10)
+    samples = iter([
+        ({('ConntrackCount', None): 10}, {('RxDropped', None): 37, ('NetRxSoftirqs', '0'): 100}),
+        ({('ConntrackCount', None): 12}, {('RxDropped', None): 39, ('NetRxSoftirqs', '0'): 160}),
+    ] + [({('ConntrackCount', None): 12}, {('RxDropped', None): 39, ('NetRxSoftirqs', '0'): 160})] * 4)
+    now = [0.0]
+    cloudwatch = RecordingCloudWatch()
+
+    nat_agent.run(
+        cloudwatch, 'i-nat', 'ens5', sample_interval=1, flush_interval=60,
+        sample=lambda interface: next(samples), clock=lambda: now[0],
+        sleep=lambda seconds: now.__setitem__(0, now[0] + seconds), iterations=6
+    )
+
+    # 6 gauges and 5 x 2 counter deltas, flushed once at the end in batches of 10
+    assert [len(metric_data) for _, metric_data in cloudwatch.calls] == [10, 6]
+    metric_data = [item for _, batch in cloudwatch.calls for item in batch]
+    assert {namespace for namespace, _ in cloudwatch.calls} == {nat_agent.NAMESPACE}
+    assert all(item['StorageResolution'] == 1 for item in metric_data)
+    second_rx = [item for item in metric_data if item['MetricName'] == 'NetRxSoftirqs'][0]
+    assert second_rx['Value'] == 60
+    assert second_rx['Timestamp'] == 1.0
+    assert second_rx['Dimensions'] == [{'Name': 'InstanceId', 'Value': 'i-nat'}, {'Name': 'Cpu', 'Value': '0'}]
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""Assertion tests for the `NatifyStack` template."""
+
+import pytest
+from aws_cdk import App
+from aws_cdk.assertions import Match, Template
+
+from cdk.natify_stack import NatifyStack
+
+
+@pytest.fixture(scope='module')
+def template():
+    app = App()
+    return Template.from_stack(NatifyStack(app, "NatifyStack"))
+
+
+def state_machine_definition(template):
+    (state_machine,) = template.find_resources('AWS::StepFunctions::StateMachine').values()
+    return state_machine['Properties']['DefinitionString']['Fn::Join'][1]
+
+
+def test_distributed_map_mode_has_its_own_timeout(template):
+    template.has_parameter('DistributedMapTimeoutSeconds', {'Type': 'Number', 'Default': 3600})
+    template.has_condition('IsDistributedMapMode', {
+        'Fn::Equals': [{'Ref': 'RouteUpdateMode'}, 'DistributedMap'],
+    })
+    parts = state_machine_definition(template)
+    index = next(i for i, part in enumerate(parts) if isinstance(part, str) and part.endswith('"TimeoutSeconds":'))
+    assert parts[index + 1] == {'Fn::If': ['IsDistributedMapMode', {'Ref': 'DistributedMapTimeoutSeconds'}, 300]}
+
+
+def test_nat_agent_is_installed_without_user_data(template):
+    (instance,) = template.find_resources('AWS::EC2::Instance').values()
+    # Only the default shebang, so existing NAT instances are not stopped to change it
+    assert instance['Properties']['UserData'] == {'Fn::Base64': '#!/bin/bash'}
+
+    (document,) = template.find_resources('AWS::SSM::Document').values()
+    (step,) = document['Properties']['Content']['mainSteps']
+    assert 'def run(cloudwatch_client' in '\n'.join(str(line) for line in step['inputs']['runCommand'])
+    (document_id,) = template.find_resources('AWS::SSM::Document').keys()
+    (instance_id,) = template.find_resources('AWS::EC2::Instance').keys()
+    template.has_resource_properties('AWS::SSM::Association', {
+        'Name': {'Ref': document_id},
+        'Targets': [{'Key': 'InstanceIds', 'Values': [{'Ref': instance_id}]}],
+    })
+
+
+def test_distributed_map_execution_passes_its_id_for_the_lease(template):
+    definition = ''.join(part for part in state_machine_definition(template) if isinstance(part, str))
+    for action in ('list_route_tables', 'finalize', 'release_lock'):
+        assert f'{{"action":"{action}","execution_id.$":"$$.Execution.Id"}}' in definition
+    assert '"Variable":"$.List.LockStatus"' in definition
+    template.has_resource_properties('AWS::Lambda::Function', {
+        'Handler': 'natifylambda.natifylambda.handler',
+        'Environment': {'Variables': Match.object_like({
+            'DISTRIBUTED_MAP_TIMEOUT': {'Ref': 'DistributedMapTimeoutSeconds'},
+        })},
+    })
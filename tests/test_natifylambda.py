@@ -2,10 +2,13 @@
 
 """Tests for `natifylambda` package."""
 
+import copy
+import json
+
 import pytest
 
 
-from natifylambda import natifylambda
+from natifylambda import idempotency, natifylambda, routes
 
 
 @pytest.fixture
@@ -22,3 +25,523 @@ def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
+
+
+class FakePaginator:
+    """Splits the result of a describe call into pages of page_size items."""
+
+    def __init__(self, describe, result_key, page_size):
+        self.describe = describe
+        self.result_key = result_key
+        self.page_size = page_size
+
+    def paginate(self, **kwargs):
+        items = self.describe(**kwargs)[self.result_key]
+        for i in range(0, max(len(items), 1), self.page_size):
+            yield {self.result_key: items[i:i + self.page_size]}
+
+
+class FakeEc2Client:
+    """Minimal in-memory stand-in for the EC2 client calls used by natifylambda."""
+
+    def __init__(self, subnets, route_tables, page_size=1000):
+        self.subnets = subnets
+        self.route_tables = route_tables
+        self.page_size = page_size
+        self.vpc_endpoints = []
+        self.calls = []
+
+    def get_paginator(self, operation_name):
+        self.calls.append(('get_paginator', operation_name))
+        result_key = {'describe_subnets': 'Subnets', 'describe_route_tables': 'RouteTables'}[operation_name]
+        return FakePaginator(getattr(self, operation_name), result_key, self.page_size)
+
+    def describe_subnets(self, Filters=None, SubnetIds=None):
+        self.calls.append(('describe_subnets', SubnetIds))
+        subnets = self.subnets
+        if SubnetIds is not None:
+            subnets = [s for s in subnets if s['SubnetId'] in SubnetIds]
+        return {'Subnets': subnets}
+
+    def describe_route_tables(self, Filters=None, RouteTableIds=None):
+        self.calls.append(('describe_route_tables', RouteTableIds))
+        route_tables = self.route_tables
+        if RouteTableIds is not None:
+            route_tables = [rt for rt in route_tables if rt['RouteTableId'] in RouteTableIds]
+        for f in Filters or []:
+            if f['Name'] == 'association.subnet-id':
+                route_tables = [
+                    rt for rt in route_tables
+                    if any(a.get('SubnetId') in f['Values'] for a in rt.get('Associations', []))
+                ]
+            elif f['Name'] == 'association.main':
+                route_tables = [
+                    rt for rt in route_tables
+                    if any(a.get('Main') for a in rt.get('Associations', []))
+                ]
+            elif f['Name'] == 'vpc-id':
+                route_tables = [rt for rt in route_tables if rt['VpcId'] in f['Values']]
+            elif f['Name'] == 'tag-key':
+                route_tables = [
+                    rt for rt in route_tables
+                    if any(t['Key'] in f['Values'] for t in rt.get('Tags', []))
+                ]
+        return {'RouteTables': copy.deepcopy(route_tables)}
+
+    def describe_vpc_endpoints(self, Filters):
+        self.calls.append(('describe_vpc_endpoints', None))
+        filters = {f['Name']: f['Values'] for f in Filters}
+        return {'VpcEndpoints': copy.deepcopy([
+            endpoint for endpoint in self.vpc_endpoints
+            if endpoint['VpcId'] in filters['vpc-id']
+            and endpoint['ServiceName'] in filters['service-name']
+            and endpoint['VpcEndpointType'] in filters['vpc-endpoint-type']
+        ])}
+
+    def create_vpc_endpoint(self, VpcEndpointType, VpcId, ServiceName, RouteTableIds):
+        endpoint_id = f'vpce-{len(self.vpc_endpoints) + 1}'
+        self.calls.append(('create_vpc_endpoint', endpoint_id))
+        endpoint = {
+            'VpcEndpointId': endpoint_id, 'VpcEndpointType': VpcEndpointType, 'VpcId': VpcId,
+            'ServiceName': ServiceName, 'RouteTableIds': list(RouteTableIds), 'State': 'available',
+        }
+        self.vpc_endpoints.append(endpoint)
+        return {'VpcEndpoint': copy.deepcopy(endpoint)}
+
+    def modify_vpc_endpoint(self, VpcEndpointId, AddRouteTableIds):
+        self.calls.append(('modify_vpc_endpoint', VpcEndpointId))
+        endpoint = next(e for e in self.vpc_endpoints if e['VpcEndpointId'] == VpcEndpointId)
+        endpoint['RouteTableIds'] += AddRouteTableIds
+        return {'Return': True}
+
+    def describe_vpcs(self, VpcIds):
+        return {'Vpcs': [{'VpcId': vpc_id, 'CidrBlock': '10.0.0.0/16'} for vpc_id in VpcIds]}
+
+    def authorize_security_group_ingress(self, GroupId, IpPermissions):
+        self.calls.append(('authorize_security_group_ingress', GroupId))
+
+    def modify_instance_attribute(self, InstanceId, SourceDestCheck):
+        self.calls.append(('modify_instance_attribute', InstanceId))
+
+    def _route_table(self, route_table_id):
+        return next(rt for rt in self.route_tables if rt['RouteTableId'] == route_table_id)
+
+    def _set_default_route(self, name, RouteTableId, DestinationCidrBlock, **target):
+        self.calls.append((name, RouteTableId))
+        rt = self._route_table(RouteTableId)
+        rt['Routes'] = [r for r in rt['Routes'] if r['DestinationCidrBlock'] != DestinationCidrBlock]
+        if target:
+            rt['Routes'].append(dict(DestinationCidrBlock=DestinationCidrBlock, **target))
+
+    def replace_route(self, **kwargs):
+        self._set_default_route('replace_route', **kwargs)
+
+    def create_route(self, **kwargs):
+        self._set_default_route('create_route', **kwargs)
+
+    def delete_route(self, **kwargs):
+        self._set_default_route('delete_route', **kwargs)
+
+    def create_tags(self, Resources, Tags):
+        for resource in Resources:
+            self.calls.append(('create_tags', resource))
+            rt = self._route_table(resource)
+            rt['Tags'] = rt.get('Tags', []) + Tags
+
+    def delete_tags(self, Resources, Tags):
+        keys = {t['Key'] for t in Tags}
+        for resource in Resources:
+            self.calls.append(('delete_tags', resource))
+            rt = self._route_table(resource)
+            rt['Tags'] = [t for t in rt.get('Tags', []) if t['Key'] not in keys]
+
+
+class FakeSfnClient:
+    def list_state_machines(self):
+        return {'stateMachines': []}
+
+
+class FakeContext:
+    aws_request_id = 'request-1'
+
+    def get_remaining_time_in_millis(self):
+        return 120000
+
+
+def make_subnet(subnet_id, name, vpc_id='vpc-1'):
+    return {'SubnetId': subnet_id, 'VpcId': vpc_id, 'Tags': [{'Key': 'Name', 'Value': name}]}
+
+
+def make_route_table(route_table_id, subnet_ids, default_route=False, vpc_id='vpc-1'):
+    routes = [{'DestinationCidrBlock': '10.0.0.0/16', 'GatewayId': 'local'}]
+    if default_route:
+        routes.append({'DestinationCidrBlock': '0.0.0.0/0', 'NatGatewayId': 'nat-1'})
+    return {
+        'RouteTableId': route_table_id,
+        'VpcId': vpc_id,
+        'Routes': routes,
+        'Associations': [{'SubnetId': s} for s in subnet_ids],
+    }
+
+
+def make_main_route_table(route_table_id, default_target=None, vpc_id='vpc-1'):
+    rt = make_route_table(route_table_id, [], vpc_id=vpc_id)
+    rt['Associations'] = [{'Main': True}]
+    if default_target:
+        rt['Routes'].append(dict(DestinationCidrBlock='0.0.0.0/0', **default_target))
+    return rt
+
+
+def cloudtrail_event(event_name, request=None, response=None):
+    return {
+        'detail-type': 'AWS API Call via CloudTrail',
+        'source': 'aws.ec2',
+        'detail': {
+            'eventName': event_name,
+            'requestParameters': request,
+            'responseElements': response,
+        },
+    }
+
+
+def test_reconcile_from_associate_route_table_event():
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet('subnet-1', 'App-Private-1A'), make_subnet('subnet-2', 'App-Public-1A')],
+        route_tables=[make_route_table('rtb-1', ['subnet-1'], default_route=True)],
+    )
+    event = cloudtrail_event(
+        'AssociateRouteTable',
+        request={'routeTableId': 'rtb-1', 'subnetId': 'subnet-1'},
+    )
+
+    assert natifylambda.is_reconcile_event(event)
+    updated = natifylambda.reconcile_from_event(ec2, event, 'vpc-1', 'i-nat')
+
+    assert updated == ['rtb-1']
+    assert ('replace_route', 'rtb-1') in ec2.calls
+    # Only the affected route table and its subnets are read
+    assert ('describe_route_tables', ['rtb-1']) in ec2.calls
+    assert ('describe_subnets', ['subnet-1']) in ec2.calls
+
+
+def test_reconcile_skips_public_subnet_and_other_vpc():
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet('subnet-2', 'App-Public-1A'), make_subnet('subnet-3', 'Private', vpc_id='vpc-2')],
+        route_tables=[make_route_table('rtb-2', ['subnet-2']), make_route_table('rtb-3', ['subnet-3'])],
+    )
+
+    assert natifylambda.reconcile_subnet(ec2, 'vpc-1', 'subnet-2', 'i-nat') == []
+    assert natifylambda.reconcile_subnet(ec2, 'vpc-1', 'subnet-3', 'i-nat') == []
+    assert natifylambda.reconcile_route_table(ec2, 'vpc-1', 'rtb-2', 'i-nat') == []
+    assert not [c for c in ec2.calls if c[0] in ('create_route', 'replace_route')]
+
+
+def test_reconcile_from_create_subnet_event_uses_main_route_table():
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet('subnet-9', 'App-Private-1C')],
+        route_tables=[make_main_route_table('rtb-main', {'NatGatewayId': 'nat-1'})],
+    )
+    event = cloudtrail_event(
+        'CreateSubnet',
+        response={'subnet': {'subnetId': 'subnet-9', 'vpcId': 'vpc-1'}},
+    )
+
+    assert natifylambda.is_reconcile_event(event)
+    assert natifylambda.reconcile_from_event(ec2, event, 'vpc-1', 'i-nat') == ['rtb-main']
+    assert ('replace_route', 'rtb-main') in ec2.calls
+
+
+def test_reconcile_leaves_main_route_table_to_internet_gateway():
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet('subnet-9', 'App-Private-1C')],
+        route_tables=[make_main_route_table('rtb-main', {'GatewayId': 'igw-1'})],
+    )
+    event = cloudtrail_event(
+        'CreateSubnet',
+        response={'subnet': {'subnetId': 'subnet-9', 'vpcId': 'vpc-1'}},
+    )
+
+    assert natifylambda.reconcile_from_event(ec2, event, 'vpc-1', 'i-nat') == []
+    assert not [c for c in ec2.calls if c[0] in ('create_route', 'replace_route')]
+
+
+def test_reconcile_from_create_tags_event_on_renamed_subnet():
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet('subnet-1', 'App-Private-1A')],
+        route_tables=[make_route_table('rtb-1', ['subnet-1'])],
+    )
+    event = cloudtrail_event(
+        'CreateTags',
+        request={
+            'resourcesSet': {'items': [{'resourceId': 'subnet-1'}]},
+            'tagSet': {'items': [{'key': 'Name', 'value': 'App-Private-1A'}]},
+        },
+    )
+
+    assert natifylambda.reconcile_from_event(ec2, event, 'vpc-1', 'i-nat') == ['rtb-1']
+    assert ('create_route', 'rtb-1') in ec2.calls
+
+    event['detail']['requestParameters']['tagSet']['items'] = [{'key': 'Owner', 'value': 'private-team'}]
+    assert natifylambda.get_reconcile_targets(event) == ([], [])
+
+
+def test_create_route_table_is_not_a_reconcile_event():
+    # A new route table has no associations yet; AssociateRouteTable covers it
+    event = cloudtrail_event(
+        'CreateRouteTable',
+        response={'routeTable': {'routeTableId': 'rtb-new', 'vpcId': 'vpc-1'}},
+    )
+
+    assert not natifylambda.is_reconcile_event(event)
+
+
+def test_reconcile_ignores_failed_api_calls():
+    event = cloudtrail_event('CreateSubnet')
+    event['detail']['errorCode'] = 'Client.UnauthorizedOperation'
+
+    assert natifylambda.get_reconcile_targets(event) == ([], [])
+
+
+def test_restore_replays_route_journal():
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet('subnet-1', 'Private-1A'), make_subnet('subnet-2', 'Private-1B')],
+        route_tables=[
+            make_route_table('rtb-1', ['subnet-1'], default_route=True),
+            make_route_table('rtb-2', ['subnet-2']),
+        ],
+    )
+    original_routes = {rt['RouteTableId']: copy.deepcopy(rt['Routes']) for rt in ec2.route_tables}
+
+    natifylambda.modify_route_tables(ec2, 'vpc-1', 'i-nat')
+    # A second run must not overwrite the journal with the NAT instance itself
+    natifylambda.modify_route_tables(ec2, 'vpc-1', 'i-nat')
+    journal = {
+        rt['RouteTableId']: [t['Value'] for t in rt['Tags'] if t['Key'] == natifylambda.JOURNAL_TAG_KEY]
+        for rt in ec2.route_tables
+    }
+    assert journal == {'rtb-1': ['NatGatewayId=nat-1'], 'rtb-2': ['none']}
+
+    restored = natifylambda.restore_route_tables(ec2, 'vpc-1')
+
+    assert restored == {'rtb-1': 'restored', 'rtb-2': 'deleted'}
+    for rt in ec2.route_tables:
+        assert rt['Routes'] == original_routes[rt['RouteTableId']]
+        assert not rt['Tags']
+
+
+def test_list_and_update_route_table_batches():
+    ec2 = FakeEc2Client(
+        subnets=[
+            make_subnet('subnet-1', 'Private-1A'),
+            make_subnet('subnet-2', 'Private-1B'),
+            make_subnet('subnet-3', 'Public-1A'),
+        ],
+        route_tables=[
+            make_route_table('rtb-2', ['subnet-2']),
+            make_route_table('rtb-1', ['subnet-1', 'subnet-2'], default_route=True),
+            make_route_table('rtb-3', ['subnet-3'], default_route=True),
+        ],
+    )
+
+    route_table_ids = natifylambda.list_private_route_tables(ec2, 'vpc-1')
+    assert route_table_ids == ['rtb-1', 'rtb-2']
+
+    updated = natifylambda.update_route_tables(ec2, 'vpc-1', route_table_ids, 'i-nat')
+    assert sorted(updated) == ['rtb-1', 'rtb-2']
+    assert ('replace_route', 'rtb-1') in ec2.calls
+    assert ('create_route', 'rtb-2') in ec2.calls
+    assert natifylambda.update_route_tables(ec2, 'vpc-1', [], 'i-nat') == []
+
+
+def test_list_private_route_tables_reads_every_page():
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet(f'subnet-{i}', f'Private-{i}') for i in range(5)],
+        route_tables=[make_route_table(f'rtb-{i}', [f'subnet-{i}']) for i in range(5)],
+        page_size=2,
+    )
+
+    assert natifylambda.list_private_route_tables(ec2, 'vpc-1') == [f'rtb-{i}' for i in range(5)]
+
+
+def test_restore_reads_every_page_of_the_journal():
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet(f'subnet-{i}', f'Private-{i}') for i in range(5)],
+        route_tables=[make_route_table(f'rtb-{i}', [f'subnet-{i}']) for i in range(5)],
+        page_size=2,
+    )
+    natifylambda.modify_route_tables(ec2, 'vpc-1', 'i-nat')
+    ec2.calls.clear()
+
+    restored = natifylambda.restore_route_tables(ec2, 'vpc-1')
+
+    assert restored == {f'rtb-{i}': 'deleted' for i in range(5)}
+    assert ec2.calls[0] == ('get_paginator', 'describe_route_tables')
+
+
+def test_update_route_tables_describes_in_batches():
+    count = routes.DESCRIBE_BATCH_SIZE + 1
+    ec2 = FakeEc2Client(
+        subnets=[],
+        route_tables=[make_route_table(f'rtb-{i}', []) for i in range(count)],
+    )
+
+    updated = natifylambda.update_route_tables(ec2, 'vpc-1', [f'rtb-{i}' for i in range(count)], 'i-nat')
+
+    assert len(updated) == count
+    describes = [ids for name, ids in ec2.calls if name == 'describe_route_tables']
+    assert [len(ids) for ids in describes] == [routes.DESCRIBE_BATCH_SIZE, 1]
+
+
+@pytest.fixture
+def handler_environment(monkeypatch):
+    for name, value in {
+        'VPC_ID': 'vpc-1', 'NAT_INSTANCE_ID': 'i-nat', 'NAT_SG_ID': 'sg-nat', 'AWS_REGION': 'us-west-2',
+    }.items():
+        monkeypatch.setenv(name, value)
+    for name in ('RATE_LIMIT_TABLE', 'IDEMPOTENCY_TABLE', 'GATEWAY_ENDPOINTS', 'PROBE_ENI_ID'):
+        monkeypatch.delenv(name, raising=False)
+
+    def use_clients(**clients):
+        monkeypatch.setattr(natifylambda.boto3, 'client', lambda service_name: clients.get(service_name))
+    return use_clients
+
+
+def test_distributed_map_batches_share_the_gateway_endpoints(handler_environment):
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet(f'subnet-{i}', f'Private-{i}') for i in range(4)],
+        route_tables=[make_route_table(f'rtb-{i}', [f'subnet-{i}']) for i in range(4)],
+    )
+    handler_environment(ec2=ec2)
+
+    listed = natifylambda.handler({'action': 'list_route_tables'}, None)
+    listing_calls = len(ec2.calls)
+    for batch in (listed['RouteTableIds'][:2], listed['RouteTableIds'][2:]):
+        natifylambda.handler({'action': 'update_route_tables', 'route_table_ids': batch}, None)
+
+    # Concurrent batches that looked the endpoints up would each create one
+    assert not [name for name, _ in ec2.calls[listing_calls:] if 'vpc_endpoint' in name]
+    assert [(e['ServiceName'], sorted(e['RouteTableIds'])) for e in ec2.vpc_endpoints] == [
+        ('com.amazonaws.us-west-2.s3', [f'rtb-{i}' for i in range(4)]),
+        ('com.amazonaws.us-west-2.dynamodb', [f'rtb-{i}' for i in range(4)]),
+    ]
+    assert [name for name, _ in ec2.calls].count('create_vpc_endpoint') == 2
+
+
+@pytest.fixture
+def locked_handler(handler_environment, monkeypatch):
+    ec2 = FakeEc2Client(
+        subnets=[make_subnet(f'subnet-{i}', f'Private-{i}') for i in range(2)],
+        route_tables=[make_route_table(f'rtb-{i}', [f'subnet-{i}']) for i in range(2)],
+    )
+    handler_environment(ec2=ec2, stepfunctions=FakeSfnClient())
+    store = idempotency.LocalLockStore()
+    clock = lambda: 1000.0  # noqa: E731
+    monkeypatch.setattr(
+        natifylambda, 'lock_from_environment', lambda factory: idempotency.IdempotencyLock(store, clock=clock)
+    )
+    return ec2, store
+
+
+def test_full_run_is_locked_on_the_vpc_and_nat_instance(locked_handler):
+    ec2, store = locked_handler
+
+    result = natifylambda.handler({'mode': 'Lambda'}, FakeContext())
+
+    assert result['statusCode'] == 200
+    assert ('create_route', 'rtb-0') in ec2.calls
+    record = store.get('vpc-1#i-nat')
+    assert (record.status, record.owner, record.result) == (idempotency.COMPLETED, 'request-1', result)
+
+    # A duplicate within the result TTL gets the same result without changing anything
+    ec2.calls.clear()
+    assert natifylambda.handler({'mode': 'Lambda'}, FakeContext()) == result
+    assert not ec2.calls
+
+
+def test_duplicate_full_run_reports_the_run_in_progress(locked_handler):
+    ec2, store = locked_handler
+    assert store.acquire('vpc-1#i-nat', 'other-request', 1150, 1000)
+
+    result = natifylambda.handler({'mode': 'Lambda'}, FakeContext())
+
+    assert result['statusCode'] == 202
+    assert json.loads(result['body'])['details'] == {'owner': 'other-request', 'lease_expires_at': 1150}
+    assert not ec2.calls
+
+
+def test_distributed_map_execution_holds_the_lease_until_finalize(locked_handler, monkeypatch):
+    ec2, store = locked_handler
+    monkeypatch.setenv('DISTRIBUTED_MAP_TIMEOUT', '600')
+
+    listed = natifylambda.handler({'action': 'list_route_tables', 'execution_id': 'exec-1'}, None)
+
+    assert (listed['LockStatus'], listed['RouteTableIds']) == ('acquired', ['rtb-0', 'rtb-1'])
+    record = store.get('vpc-1#i-nat')
+    assert (record.status, record.owner) == (idempotency.IN_PROGRESS, 'exec-1')
+    assert record.expires_at == 1000 + 600 + idempotency.LEASE_MARGIN
+
+    # An overlapping execution skips the map, and so does one right after finalize
+    overlapping = natifylambda.handler({'action': 'list_route_tables', 'execution_id': 'exec-2'}, None)
+    assert (overlapping['LockStatus'], overlapping['RouteTableIds']) == ('in_progress', [])
+    natifylambda.handler({'action': 'update_route_tables', 'route_table_ids': listed['RouteTableIds']}, None)
+    finalized = natifylambda.handler({'action': 'finalize', 'execution_id': 'exec-1'}, None)
+    assert finalized['statusCode'] == 200
+    assert store.get('vpc-1#i-nat').status == idempotency.COMPLETED
+    next_execution = natifylambda.handler({'action': 'list_route_tables', 'execution_id': 'exec-3'}, None)
+    assert next_execution['LockStatus'] == 'cached'
+
+
+def test_failed_distributed_map_releases_the_lease(locked_handler):
+    ec2, store = locked_handler
+    natifylambda.handler({'action': 'list_route_tables', 'execution_id': 'exec-1'}, None)
+
+    natifylambda.handler({'action': 'release_lock', 'execution_id': 'exec-1'}, None)
+
+    assert store.get('vpc-1#i-nat') is None
+
+
+def test_gateway_endpoints_are_created_then_reused():
+    ec2 = FakeEc2Client(subnets=[], route_tables=[])
+
+    created = natifylambda.ensure_gateway_endpoints(ec2, 'vpc-1', ['rtb-1', 'rtb-2'], ['s3', 'dynamodb'], 'us-west-2')
+
+    assert created == {
+        's3': {'VpcEndpointId': 'vpce-1', 'action': 'created'},
+        'dynamodb': {'VpcEndpointId': 'vpce-2', 'action': 'created'},
+    }
+    assert ec2.vpc_endpoints[0]['ServiceName'] == 'com.amazonaws.us-west-2.s3'
+    assert ec2.vpc_endpoints[0]['RouteTableIds'] == ['rtb-1', 'rtb-2']
+
+    again = natifylambda.ensure_gateway_endpoints(ec2, 'vpc-1', ['rtb-2', 'rtb-3'], ['s3'], 'us-west-2')
+
+    assert again == {'s3': {'VpcEndpointId': 'vpce-1', 'action': 'attached'}}
+    assert ec2.vpc_endpoints[0]['RouteTableIds'] == ['rtb-1', 'rtb-2', 'rtb-3']
+    assert natifylambda.ensure_gateway_endpoints(ec2, 'vpc-1', ['rtb-3'], ['s3'], 'us-west-2') == {
+        's3': {'VpcEndpointId': 'vpce-1', 'action': 'unchanged'}
+    }
+
+
+def test_gateway_endpoint_skips_route_tables_of_other_endpoints():
+    ec2 = FakeEc2Client(subnets=[], route_tables=[])
+    service_name = 'com.amazonaws.us-west-2.s3'
+    for endpoint_id, route_table_ids, state in (
+        ('vpce-old', ['rtb-1'], 'deleted'),
+        ('vpce-a', [], 'available'),
+        ('vpce-b', ['rtb-2'], 'available'),
+    ):
+        ec2.vpc_endpoints.append({
+            'VpcEndpointId': endpoint_id, 'VpcEndpointType': 'Gateway', 'VpcId': 'vpc-1',
+            'ServiceName': service_name, 'RouteTableIds': route_table_ids, 'State': state,
+        })
+
+    assert natifylambda.ensure_gateway_endpoint(ec2, 'vpc-1', service_name, ['rtb-1', 'rtb-2']) == ('vpce-a', 'attached')
+    assert ec2.vpc_endpoints[1]['RouteTableIds'] == ['rtb-1']
+
+
+def test_gateway_endpoint_services_from_environment(monkeypatch):
+    monkeypatch.delenv('GATEWAY_ENDPOINTS', raising=False)
+    assert natifylambda.get_gateway_endpoint_services() == ['s3', 'dynamodb']
+    monkeypatch.setenv('GATEWAY_ENDPOINTS', 's3')
+    assert natifylambda.get_gateway_endpoint_services() == ['s3']
+    monkeypatch.setenv('GATEWAY_ENDPOINTS', '')
+    assert natifylambda.get_gateway_endpoint_services() == []
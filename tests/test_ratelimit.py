@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""Tests for the shared EC2 API token bucket."""
+
+import threading
+
+import pytest
+
+from natifylambda import ratelimit
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+
+def test_bucket_allows_burst_then_refill_rate():
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(
+        ratelimit.LocalBucketStore(), rate=2, capacity=5, clock=clock, sleep=clock.sleep
+    )
+
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.now == 1000.0
+
+    for _ in range(4):
+        bucket.acquire()
+    # Four more tokens at two tokens per second
+    assert clock.now == pytest.approx(1002.0, abs=1e-3)
+
+
+def test_concurrent_takers_share_one_bucket():
+    store = ratelimit.LocalBucketStore()
+    clock = FakeClock()
+    buckets = [
+        ratelimit.TokenBucket(store, rate=10, capacity=10, clock=clock, sleep=clock.sleep)
+        for _ in range(4)
+    ]
+
+    def take(bucket):
+        for _ in range(10):
+            bucket.acquire()
+
+    threads = [threading.Thread(target=take, args=(bucket,)) for bucket in buckets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 40 tokens with a burst of 10 need at least 3 seconds of refill
+    assert clock.now >= 1003.0
+
+
+def test_rate_limited_client_only_limits_mutating_calls():
+    class Bucket:
+        acquired = 0
+
+        def acquire(self):
+            self.acquired += 1
+
+    class Client:
+        exceptions = object()
+
+        def describe_route_tables(self, **kwargs):
+            return 'described'
+
+        def replace_route(self, **kwargs):
+            return 'replaced'
+
+    bucket = Bucket()
+    client = ratelimit.RateLimitedClient(Client(), bucket)
+
+    assert client.describe_route_tables() == 'described'
+    assert bucket.acquired == 0
+    assert client.replace_route(RouteTableId='rtb-1') == 'replaced'
+    assert bucket.acquired == 1
+    assert client.exceptions is Client.exceptions
+
+
+@pytest.fixture
+def dynamodb():
+    import boto3
+    from botocore.stub import Stubber
+
+    client = boto3.client(
+        'dynamodb', region_name='us-west-2',
+        aws_access_key_id='testing', aws_secret_access_key='testing'
+    )
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def expected_put(tokens, updated_at, version, condition, values=None):
+    params = {
+        'TableName': 'natify-rate-limit',
+        'Item': {
+            'BucketKey': {'S': 'ec2-mutating'},
+            'Tokens': {'N': repr(tokens)},
+            'UpdatedAt': {'N': repr(updated_at)},
+            'Version': {'N': str(version)},
+        },
+        'ConditionExpression': condition,
+    }
+    if values:
+        params['ExpressionAttributeValues'] = values
+    return params
+
+
+def test_dynamodb_store_conditional_writes(dynamodb):
+    client, stubber = dynamodb
+    store = ratelimit.DynamoDBBucketStore(client, 'natify-rate-limit')
+    stubber.add_response(
+        'put_item', {}, expected_put(9.0, 1000.0, 0, 'attribute_not_exists(BucketKey)')
+    )
+    stubber.add_response(
+        'put_item', {}, expected_put(8.0, 1001.0, 4, 'Version = :expected', {':expected': {'N': '3'}})
+    )
+
+    assert store.put_if_absent('ec2-mutating', 9.0, 1000.0)
+    assert store.compare_and_set('ec2-mutating', 3, 8.0, 1001.0)
+
+
+def test_dynamodb_store_conditional_check_failure_returns_false(dynamodb):
+    client, stubber = dynamodb
+    store = ratelimit.DynamoDBBucketStore(client, 'natify-rate-limit')
+    for params in (
+        expected_put(9.0, 1000.0, 0, 'attribute_not_exists(BucketKey)'),
+        expected_put(8.0, 1001.0, 4, 'Version = :expected', {':expected': {'N': '3'}}),
+    ):
+        stubber.add_client_error(
+            'put_item', service_error_code='ConditionalCheckFailedException', expected_params=params
+        )
+
+    assert not store.put_if_absent('ec2-mutating', 9.0, 1000.0)
+    assert not store.compare_and_set('ec2-mutating', 3, 8.0, 1001.0)
+
+
+def test_dynamodb_store_reads_version(dynamodb):
+    client, stubber = dynamodb
+    store = ratelimit.DynamoDBBucketStore(client, 'natify-rate-limit')
+    stubber.add_response(
+        'get_item',
+        {'Item': {'BucketKey': {'S': 'ec2-mutating'}, 'Tokens': {'N': '2.5'},
+                  'UpdatedAt': {'N': '1000.5'}, 'Version': {'N': '7'}}},
+        {'TableName': 'natify-rate-limit', 'Key': {'BucketKey': {'S': 'ec2-mutating'}}, 'ConsistentRead': True},
+    )
+
+    assert store.get('ec2-mutating') == ratelimit.BucketState(2.5, 1000.5, 7)
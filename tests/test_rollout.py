@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""Tests for the cross-account rollout orchestrator."""
+
+import json
+import threading
+
+from utils import rollout
+
+
+def make_accounts(count):
+    return [{'AccountId': f'11111111111{i}', 'Region': 'us-west-2'} for i in range(count)]
+
+
+class RecordingSteps:
+    """Rollout steps recording what ran, failing once for the accounts in fail_once."""
+
+    def __init__(self, fail_once=()):
+        self.fail_once = set(fail_once)
+        self.ran = []
+        self._lock = threading.Lock()
+
+    def step(self, name):
+        def run(account, credentials):
+            assert credentials == {'AccessKeyId': account['AccountId']}
+            with self._lock:
+                target = rollout.rollout_target(account)
+                if name == 'NatifyStack' and target in self.fail_once:
+                    self.fail_once.remove(target)
+                    raise RuntimeError("Stack NatifyStack was not deployed")
+                self.ran.append((target, name))
+        return name, run
+
+    def steps(self):
+        return [self.step('DownloaderLambdaStack'), self.step('NatifyStack'), self.step(rollout.RECONCILE_STEP)]
+
+
+def assume(account_id):
+    return {'AccessKeyId': account_id}
+
+
+def test_rollout_checkpoints_every_account(tmp_path):
+    state_file = tmp_path / 'state.json'
+    accounts = make_accounts(5)
+    steps = RecordingSteps()
+
+    results = rollout.rollout(accounts, rollout.Checkpoint(str(state_file)), steps.steps(), assume, concurrency=3)
+
+    assert set(results.values()) == {'done'}
+    assert len(steps.ran) == 15
+    state = json.loads(state_file.read_text())['targets']
+    assert [(target['AccountId'], target['Region']) for target in state] == list(results)
+    for target in state:
+        assert target['progress']['status'] == 'done'
+        assert target['progress']['completed'] == ['DownloaderLambdaStack', 'NatifyStack', 'reconcile']
+    assert [path.name for path in tmp_path.iterdir()] == ['state.json']
+
+
+def test_rollout_resumes_failed_accounts_from_their_last_step(tmp_path):
+    state_file = str(tmp_path / 'state.json')
+    accounts = make_accounts(3)
+    failing = rollout.rollout_target(accounts[1])
+    steps = RecordingSteps(fail_once=[failing])
+
+    results = rollout.rollout(accounts, rollout.Checkpoint(state_file), steps.steps(), assume)
+
+    assert results[failing] == 'failed'
+    checkpoint = rollout.Checkpoint(state_file)
+    assert checkpoint.targets[failing]['completed'] == ['DownloaderLambdaStack']
+    assert checkpoint.targets[failing]['error'] == 'NatifyStack: Stack NatifyStack was not deployed'
+
+    steps.ran.clear()
+    results = rollout.rollout(accounts, checkpoint, steps.steps(), assume)
+
+    assert results == {
+        rollout.rollout_target(accounts[0]): 'skipped', failing: 'done', rollout.rollout_target(accounts[2]): 'skipped'
+    }
+    assert steps.ran == [(failing, 'NatifyStack'), (failing, 'reconcile')]
+
+
+def test_each_region_of_an_account_is_rolled_out(tmp_path):
+    state_file = str(tmp_path / 'state.json')
+    accounts = [
+        {'AccountId': '111111111110', 'Region': 'us-west-2'},
+        {'AccountId': '111111111110', 'Region': 'ca-central-1'},
+    ]
+    steps = RecordingSteps(fail_once=[('111111111110', 'ca-central-1')])
+
+    results = rollout.rollout(accounts, rollout.Checkpoint(state_file), steps.steps(), assume)
+
+    assert results == {('111111111110', 'us-west-2'): 'done', ('111111111110', 'ca-central-1'): 'failed'}
+    checkpoint = rollout.Checkpoint(state_file)
+    assert checkpoint.targets[('111111111110', 'us-west-2')]['status'] == 'done'
+    assert checkpoint.targets[('111111111110', 'ca-central-1')]['completed'] == ['DownloaderLambdaStack']
+
+    steps.ran.clear()
+    results = rollout.rollout(accounts, checkpoint, steps.steps(), assume)
+
+    assert results == {('111111111110', 'us-west-2'): 'skipped', ('111111111110', 'ca-central-1'): 'done'}
+    assert steps.ran == [(('111111111110', 'ca-central-1'), 'NatifyStack'), (('111111111110', 'ca-central-1'), 'reconcile')]
+
+
+def test_failed_assume_role_is_checkpointed(tmp_path):
+    def deny(account_id):
+        raise RuntimeError("AccessDenied")
+
+    checkpoint = rollout.Checkpoint(str(tmp_path / 'state.json'))
+    results = rollout.rollout(make_accounts(1), checkpoint, RecordingSteps().steps(), deny)
+
+    assert results == {('111111111110', 'us-west-2'): 'failed'}
+    assert checkpoint.targets[('111111111110', 'us-west-2')] == {
+        'completed': [], 'status': 'failed', 'error': 'assume role: AccessDenied'
+    }
@@ -1,15 +1,22 @@
+import hashlib
 import subprocess
 import time
 import json
 import click
 import requests
 
+# Stack statuses from which an unchanged stack can be skipped
+STABLE_STACK_STATUSES = ["CREATE_COMPLETE", "UPDATE_COMPLETE"]
+# Value shown by CloudFormation for NoEcho parameters, which can never be compared
+MASKED_PARAMETER_VALUE = "****"
+
 @click.command()
 @click.option('--profile', default='default', help='AWS CLI profile to use for deployment.')
-def main(profile):
+@click.option('--force', is_flag=True, help='Deploy the stacks even if their template and parameters are unchanged.')
+def main(profile, force):
     if wait_for_github_actions():
-        deploy_stack("DownloaderLambdaStack", "cdk.out/0_DownloaderLambdaStack.yaml", profile)
-        deploy_stack("NatifyStack", "cdk.out/1_NatifyStack.yaml", profile, parameters=[
+        deploy_stack("DownloaderLambdaStack", "cdk.out/0_DownloaderLambdaStack.yaml", profile, force=force)
+        deploy_stack("NatifyStack", "cdk.out/1_NatifyStack.yaml", profile, force=force, parameters=[
             {"ParameterKey": "VpcName", "ParameterValue": "Production-VPC"},
             {"ParameterKey": "NatInstanceType", "ParameterValue": "t4g.nano"},
             {"ParameterKey": "AvailabilityZone", "ParameterValue": "us-west-2a"},
@@ -48,27 +55,117 @@ def wait_for_github_actions():
     print("Unable to verify GitHub Actions completion after maximum attempts. Aborting deployment.")
     return False
 
-def deploy_stack(stack_name, template_file, profile, parameters=None):
+def template_hash(template):
+    """
+    Hash a CloudFormation template, either its text or the parsed JSON template returned by
+    the AWS CLI, so that the same template gives the same hash locally and once deployed.
+    
+    :param template: The template body, as a string or a dict.
+    :return: The hex SHA-256 digest.
+    """
+    if isinstance(template, str):
+        try:
+            template = json.loads(template)
+        except ValueError:
+            # YAML templates are stored as sent, only line endings and trailing spaces may differ
+            template = "\n".join(line.rstrip() for line in template.strip().splitlines())
+    if not isinstance(template, str):
+        template = json.dumps(template, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(template.encode()).hexdigest()
+
+def stack_hash(template, parameters):
+    """
+    Hash a template together with the values of all of its parameters.
+    
+    :param template: The template body, as a string or a dict.
+    :param parameters: A dict mapping each parameter key to its value.
+    :return: The hex SHA-256 digest.
+    """
+    digest = hashlib.sha256(template_hash(template).encode())
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def run_aws_json(command, profile_cli, env):
+    """
+    Run an AWS CLI command and return its parsed JSON output.
+    """
+    result = subprocess.run(command + profile_cli + ["--output", "json"], check=True, capture_output=True, text=True, env=env)
+    return json.loads(result.stdout)
+
+def is_stack_unchanged(stack, template_file, parameters, profile_cli, env):
+    """
+    Compare the synthesized template and parameters with the template and parameters
+    stored by CloudFormation for the deployed stack.
+    
+    :param stack: The deployed stack as returned by describe-stacks.
+    :param template_file: Path to the CloudFormation template file.
+    :param parameters: The parameters in the format [{"ParameterKey": "key", "ParameterValue": "value"}], or None.
+    :param profile_cli: The AWS CLI profile arguments.
+    :param env: Environment of the AWS CLI commands.
+    :return: True if deploying would not change the stack.
+    """
+    stack_name = stack["StackName"]
+    with open(template_file) as f:
+        local_template = f.read()
+    deployed_template = run_aws_json([
+        "aws", "cloudformation", "get-template",
+        "--stack-name", stack_name,
+        "--template-stage", "Original"
+    ], profile_cli, env)["TemplateBody"]
+    if template_hash(local_template) != template_hash(deployed_template):
+        return False
+
+    deployed_parameters = {p["ParameterKey"]: p["ParameterValue"] for p in stack.get("Parameters", [])}
+    if MASKED_PARAMETER_VALUE in deployed_parameters.values():
+        return False
+    # The templates are identical, so parameters that are not passed take the defaults of the deployed template
+    summary = run_aws_json([
+        "aws", "cloudformation", "get-template-summary",
+        "--stack-name", stack_name
+    ], profile_cli, env)
+    expected_parameters = {
+        p["ParameterKey"]: p.get("DefaultValue", "") for p in summary.get("Parameters", [])
+    }
+    expected_parameters.update({p["ParameterKey"]: p["ParameterValue"] for p in parameters or []})
+    return stack_hash(local_template, expected_parameters) == stack_hash(deployed_template, deployed_parameters)
+
+def deploy_stack(stack_name, template_file, profile, parameters=None, env=None, force=False):
     """
     Deploy or update a CloudFormation stack and poll its status until completion.
+    Stacks whose deployed template and parameters match the ones to deploy are skipped.
     
     :param stack_name: Name of the CloudFormation stack to deploy or update.
     :param template_file: Path to the CloudFormation template file.
-    :param profile: AWS CLI profile to use for deployment.
+    :param profile: AWS CLI profile to use for deployment, or None to use the credentials in env.
     :param parameters: A list of parameters to pass to the stack in the format [{"ParameterKey": "key", "ParameterValue": "value"}].
+    :param env: Environment of the AWS CLI commands, e.g. with assumed role credentials. Defaults to the current environment.
+    :param force: Deploy the stack even if it is unchanged.
+    :return: True if the stack reached a complete status, False if it could not be deployed or polled.
     """
+    profile_cli = ["--profile", profile] if profile else []
+
     # Check if stack exists
     check_stack_command = [
         "aws", "cloudformation", "describe-stacks",
-        "--stack-name", stack_name,
-        "--profile", profile
-    ]
+        "--stack-name", stack_name
+    ] + profile_cli
     
-    stack_exists = True
+    stack = None
     try:
-        subprocess.run(check_stack_command, check=True, capture_output=True, text=True)
+        stack = run_aws_json(check_stack_command, [], env)["Stacks"][0]
     except subprocess.CalledProcessError:
-        stack_exists = False
+        pass
+    stack_exists = stack is not None
+
+    if stack_exists and not force and stack["StackStatus"] in STABLE_STACK_STATUSES:
+        try:
+            unchanged = is_stack_unchanged(stack, template_file, parameters, profile_cli, env)
+        except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+            print(f"Failed to compare stack {stack_name} with {template_file}, deploying it: {e}")
+            unchanged = False
+        if unchanged:
+            print(f"Stack {stack_name} is unchanged, skipping deployment.")
+            return True
     
     # Prepare parameters for CLI command if any
     parameters_cli = []
@@ -80,13 +177,12 @@ def deploy_stack(stack_name, template_file, profile, parameters=None):
         "aws", "cloudformation", action,
         "--stack-name", stack_name,
         "--template-body", f"file://{template_file}",
-        "--capabilities", "CAPABILITY_IAM",
-        "--profile", profile
-    ] + parameters_cli
+        "--capabilities", "CAPABILITY_IAM"
+    ] + profile_cli + parameters_cli
     
     try:
         # Execute the deployment command
-        result = subprocess.run(deploy_command, check=True, capture_output=True, text=True)
+        result = subprocess.run(deploy_command, check=True, capture_output=True, text=True, env=env)
         if stack_exists:
             print(f"Stack {stack_name} update initiated.")
         else:
@@ -97,31 +193,30 @@ def deploy_stack(stack_name, template_file, profile, parameters=None):
             print(f"No updates to perform on stack {stack_name}.")
         else:
             print(f"Failed to initiate stack {stack_name} update or creation: {e}. Error: {e.stderr}")
-            return
+            return False
     
     # Poll stack status
     while True:
         status_command = [
             "aws", "cloudformation", "describe-stacks",
             "--stack-name", stack_name,
-            "--profile", profile,
             "--query", "Stacks[0].StackStatus",
             "--output", "text"
-        ]
+        ] + profile_cli
         
         try:
-            result = subprocess.run(status_command, check=True, capture_output=True, text=True)
+            result = subprocess.run(status_command, check=True, capture_output=True, text=True, env=env)
             status = result.stdout.strip()
             print(f"Current status of stack {stack_name}: {status}")
             
             if status in ["UPDATE_COMPLETE", "CREATE_COMPLETE"]:
                 print(f"Stack {stack_name} update or creation completed successfully.")
-                break
+                return True
             elif "FAILED" in status or "ROLLBACK" in status:
                 raise Exception(f"Stack {stack_name} update or creation failed with status: {status}")
         except subprocess.CalledProcessError as e:
             print(f"Failed to get status of stack {stack_name}: {e}")
-            break
+            return False
         
         time.sleep(10)
 
@@ -0,0 +1,247 @@
+"""
+Roll natifylambda out to many accounts of a Landing Zone Accelerator estate.
+
+For each target account, a role is assumed from the base profile, the
+DownloaderLambdaStack and NatifyStack templates are deployed with the assumed
+credentials and the private route tables of the VPC are reconciled to the NAT
+instance. Accounts are processed by a bounded thread pool and the completed
+steps of each account and region are checkpointed to a local state file, so
+running the same command again after an interruption resumes where it stopped.
+
+Run from the repository root:
+
+    python -m utils.rollout --accounts-file accounts.json --profile management
+
+The accounts file is a JSON list of
+{"AccountId": "111111111111", "Region": "us-west-2", "Parameters": {"VpcName": ...}},
+where Parameters are the NatifyStack parameters of the account. An account may
+be listed once per region it is rolled out to.
+"""
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import click
+
+from natifylambda import cli as natify_cli
+from utils.deploy_cf_stack import deploy_stack
+
+DEFAULT_ROLE_NAME = 'AWSControlTowerExecution'
+DEFAULT_STATE_FILE = 'rollout-state.json'
+DEFAULT_CONCURRENCY = 8
+STACKS = (
+    ("DownloaderLambdaStack", "cdk.out/0_DownloaderLambdaStack.yaml"),
+    ("NatifyStack", "cdk.out/1_NatifyStack.yaml"),
+)
+RECONCILE_STEP = 'reconcile'
+
+
+def rollout_target(account):
+    """
+    Returns the (account ID, region) tuple identifying an entry of the accounts file.
+    """
+    return account['AccountId'], account['Region']
+
+
+class Checkpoint:
+    """
+    Rollout progress per (account ID, region) target, saved to a JSON state file after
+    every change. The file is replaced atomically, so an interrupted rollout never leaves
+    it half written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.targets = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.targets = {
+                    (state['AccountId'], state['Region']): state['progress'] for state in json.load(f).get('targets', [])
+                }
+
+    def completed_steps(self, target):
+        with self._lock:
+            return list(self.targets.get(target, {}).get('completed', []))
+
+    def complete(self, target, step, done=False):
+        with self._lock:
+            state = self.targets.setdefault(target, {'completed': []})
+            state.update(completed=state['completed'] + [step], status='done' if done else 'in_progress', error=None)
+            self._save()
+
+    def fail(self, target, step, error):
+        with self._lock:
+            state = self.targets.setdefault(target, {'completed': []})
+            state.update(status='failed', error=f"{step}: {error}")
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        targets = [
+            {'AccountId': account_id, 'Region': region, 'progress': progress}
+            for (account_id, region), progress in sorted(self.targets.items())
+        ]
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'targets': targets}, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def assume_role(session, account_id, role_name):
+    """
+    Assumes the rollout role in the target account.
+
+    :param session: The boto3 session of the base profile.
+    :param account_id: The ID of the target account.
+    :param role_name: The name of the role to assume in the target account.
+    :return: The temporary credentials returned by STS.
+    """
+    return session.client('sts').assume_role(
+        RoleArn=f"arn:aws:iam::{account_id}:role/{role_name}",
+        RoleSessionName='natifylambda-rollout'
+    )['Credentials']
+
+
+def credentials_env(credentials, region):
+    """
+    Returns the environment for AWS CLI commands run with the assumed role credentials.
+    """
+    env = {key: value for key, value in os.environ.items() if key != 'AWS_PROFILE'}
+    env.update({
+        'AWS_ACCESS_KEY_ID': credentials['AccessKeyId'],
+        'AWS_SECRET_ACCESS_KEY': credentials['SecretAccessKey'],
+        'AWS_SESSION_TOKEN': credentials['SessionToken'],
+        'AWS_DEFAULT_REGION': region,
+        'AWS_REGION': region,
+    })
+    return env
+
+
+def credentials_session(credentials, region):
+    return boto3.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'],
+        region_name=region
+    )
+
+
+def deploy_step(stack_name, template_file, force=False):
+    """
+    Returns a rollout step deploying the stack with the assumed role credentials.
+    Unchanged stacks are skipped by deploy_stack unless force is True.
+    """
+    def deploy(account, credentials):
+        parameters = None
+        if stack_name == "NatifyStack" and account.get('Parameters'):
+            parameters = [
+                {"ParameterKey": key, "ParameterValue": value}
+                for key, value in account['Parameters'].items()
+            ]
+        env = credentials_env(credentials, account['Region'])
+        if not deploy_stack(stack_name, template_file, None, parameters=parameters, env=env, force=force):
+            raise RuntimeError(f"Stack {stack_name} was not deployed")
+    return deploy
+
+
+def reconcile_step(account, credentials):
+    """
+    Points the private route tables of the account's VPC to the NAT instance deployed
+    by NatifyStack. The VPC ID is read from the accelerator's SSM parameter, as NatifyStack does.
+    """
+    session = credentials_session(credentials, account['Region'])
+    vpc_name = account['Parameters']['VpcName']
+    vpc_id = session.client('ssm').get_parameter(
+        Name=f"/accelerator/network/vpc/{vpc_name}/id"
+    )['Parameter']['Value']
+    outputs = session.client('cloudformation').describe_stacks(StackName="NatifyStack")['Stacks'][0]['Outputs']
+    nat_instance_id = next(output['OutputValue'] for output in outputs if output['OutputKey'] == 'NatInstanceId')
+    natify_cli.reconcile(
+        session.client('ec2'),
+        natify_cli.parse_args(['--vpc-id', vpc_id, '--nat-instance-id', nat_instance_id])
+    )
+
+
+def rollout_account(account, checkpoint, steps, assume):
+    """
+    Runs the steps of one account and region that are not checkpointed yet, in order.
+
+    :param account: The account entry of the accounts file.
+    :param checkpoint: The Checkpoint of the rollout.
+    :param steps: A list of (step name, callable taking the account and credentials).
+    :param assume: A callable returning the credentials of an account ID.
+    :return: "skipped" if every step was already done, "done" or "failed".
+    """
+    target = rollout_target(account)
+    label = f"Account {target[0]} in {target[1]}"
+    completed = checkpoint.completed_steps(target)
+    pending = [(name, step) for name, step in steps if name not in completed]
+    if not pending:
+        print(f"{label}: already rolled out, skipping")
+        return "skipped"
+    name = None
+    try:
+        credentials = assume(account['AccountId'])
+        for name, step in pending:
+            print(f"{label}: running {name}")
+            step(account, credentials)
+            checkpoint.complete(target, name, done=name == pending[-1][0])
+    except Exception as e:
+        print(f"{label}: {name or 'assume role'} failed: {e}")
+        checkpoint.fail(target, name or 'assume role', e)
+        return "failed"
+    print(f"{label}: rolled out")
+    return "done"
+
+
+def rollout(accounts, checkpoint, steps, assume, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Rolls out every account and region, up to `concurrency` of them at the same time.
+
+    :return: A dict mapping each (account ID, region) tuple to the result of rollout_account.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = executor.map(lambda account: rollout_account(account, checkpoint, steps, assume), accounts)
+        return dict(zip((rollout_target(account) for account in accounts), results))
+
+
+@click.command()
+@click.option('--accounts-file', required=True, type=click.Path(exists=True), help='JSON list of the target accounts.')
+@click.option('--profile', default='default', help='AWS CLI profile allowed to assume the rollout role.')
+@click.option('--role-name', default=DEFAULT_ROLE_NAME, help='Role assumed in each target account.')
+@click.option('--state-file', default=DEFAULT_STATE_FILE, help='Checkpoint file used to resume an interrupted rollout.')
+@click.option('--concurrency', default=DEFAULT_CONCURRENCY, type=click.IntRange(min=1),
+              help='Maximum number of accounts rolled out at the same time.')
+@click.option('--skip-reconcile', is_flag=True, help='Only deploy the stacks.')
+@click.option('--force', is_flag=True, help='Deploy the stacks even if their template and parameters are unchanged.')
+def main(accounts_file, profile, role_name, state_file, concurrency, skip_reconcile, force):
+    with open(accounts_file) as f:
+        accounts = json.load(f)
+    session = boto3.Session(profile_name=profile)
+    steps = [(stack_name, deploy_step(stack_name, template_file, force)) for stack_name, template_file in STACKS]
+    if not skip_reconcile:
+        steps.append((RECONCILE_STEP, reconcile_step))
+    results = rollout(
+        accounts,
+        Checkpoint(state_file),
+        steps,
+        lambda account_id: assume_role(session, account_id, role_name),
+        concurrency
+    )
+    failed = sorted(f"{account_id} in {region}" for (account_id, region), result in results.items() if result == "failed")
+    print(f"Rolled out {len(results) - len(failed)} of {len(results)} accounts and regions, state saved to {state_file}")
+    if failed:
+        print(f"Failed: {', '.join(failed)}. Run the same command again to resume them.")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()